@@ -1,6 +1,6 @@
 import logging
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
 from flask_babel import Babel
 from flask_bootstrap import Bootstrap
 
@@ -41,6 +41,14 @@ def history():
     return render_template('history.html')
 
 
+@app.route('/metrics', methods = ['GET'])
+def metrics():
+    from server.metrics import registry
+
+    return Response(registry.render(),
+                    mimetype = 'text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     from server import init_app
 
@@ -0,0 +1,454 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import socketserver
+import stat
+import struct
+import subprocess
+import threading
+import time
+
+from config import MM_DB_DIR, MM_RES_DIR, MM_DB_ENCODE_NAME
+
+TEMP_PATH = '/data/local/tmp'  # 同AdbSync.TEMP_PATH
+RES_FOLDERS = ['avatar', 'emoji', 'sfs', 'voice2', 'image2', 'video']
+
+# 设备上用到的命令在本地的替身，busybox直接执行其后的命令
+_BIN = {
+    'busybox': '#!/bin/sh\nexec "$@"\n',
+    'whoami': '#!/bin/sh\necho root\n',
+    'getprop': '#!/bin/sh\n'
+               'echo "[ro.product.model]: [Fake ADB]"\n'
+               'echo "[ro.build.version.release]: [9]"\n',
+}
+
+
+class FakeDevice:
+    """模拟的已Root设备
+
+    在本地目录中生成微信的数据库目录和资源目录，设备上的绝对路径按前缀
+    映射到本地目录。生成的内容只由参数和随机种子决定，参数不变时复用
+    已生成的目录
+    """
+
+    def __init__(self, root, serial = 'fake-0001', uin = '1234567890',
+                 imei = '867530900000001', bus = '1'):
+        """
+        :param root: 本地目录
+        :param serial: 序列号
+        :param uin: 微信UIN
+        :param imei: IMEI
+        :param bus: USB总线编号
+        """
+        self.root = os.path.abspath(root)
+        self.serial = serial
+        self.uin = uin
+        self.imei = imei
+        self.bus = bus
+        self.user = hashlib.md5(f'mm{uin}'.encode()).hexdigest()
+        self.password = hashlib.md5(
+            f'{imei}{uin}'.encode()).hexdigest()[:7]
+        self.bin_dir = f'{self.root}/bin'
+        self._mapping = sorted({MM_DB_DIR: f'{self.root}/db',
+                                MM_RES_DIR: f'{self.root}/res',
+                                TEMP_PATH: f'{self.root}/tmp'}.items(),
+                               key = lambda item: -len(item[0]))
+
+    @property
+    def db_path(self):
+        return f'{self.root}/db/MicroMsg/{self.user}/'\
+               f'{MM_DB_ENCODE_NAME}.db'
+
+    @property
+    def res_path(self):
+        return f'{self.root}/res/{self.user}'
+
+    def map_path(self, path):
+        for remote, local in self._mapping:
+            if path == remote or path.startswith(remote + '/'):
+                return local + path[len(remote):]
+        return path
+
+    def map_cmd(self, cmd):
+        for remote, local in self._mapping:
+            cmd = cmd.replace(remote, local)
+        return cmd
+
+    def generate(self, db_byte, res_files, res_byte, seed = 1):
+        """生成设备上的数据
+
+        :param db_byte: 数据库的目标大小
+        :param res_files: 资源文件数
+        :param res_byte: 资源的目标总大小
+        :param seed: 随机种子
+        :return: 无
+        """
+        params = {'db_byte': db_byte, 'res_files': res_files,
+                  'res_byte': res_byte, 'seed': seed, 'uin': self.uin,
+                  'imei': self.imei}
+        params_path = f'{self.root}/params.json'
+        try:
+            with open(params_path, 'r') as f:
+                if json.load(f) == params:
+                    return
+        except (OSError, ValueError):
+            pass
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        self.prepare()
+        rng = random.Random(seed)
+        os.makedirs(os.path.dirname(self.db_path))
+        generate_db(self.db_path, self.password, db_byte, rng)
+        generate_res(self.res_path, res_files, res_byte, rng)
+        with open(params_path, 'w') as f:
+            json.dump(params, f)
+
+    def prepare(self):
+        """建立设备的目录和命令替身，不生成数据库和资源
+
+        :return: 无
+        """
+        for name in ('db', 'res', 'tmp', 'bin'):
+            os.makedirs(f'{self.root}/{name}')
+        for name, script in _BIN.items():
+            path = f'{self.bin_dir}/{name}'
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+        self._write_service()
+        self._write_prefs()
+
+    def _write_service(self):
+        # service call iphonesubinfo 1的输出，每个字符后跟一个点
+        chars = ''.join(f'{c}.' for c in self.imei)
+        lines = [f"  0x{i * 16:08x}: 00000000 00000000 00000000 "
+                 f"'{chars[i * 16:(i + 1) * 16]}'"
+                 for i in range(-(-len(chars) // 16))]
+        path = f'{self.bin_dir}/service'
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\ncat <<EOF\nResult: Parcel(\n' +
+                    '\n'.join(lines) + ')\nEOF\n')
+        os.chmod(path, 0o755)
+
+    def _write_prefs(self):
+        os.makedirs(f'{self.root}/db/shared_prefs')
+        with open(f'{self.root}/db/shared_prefs/system_config_prefs.xml',
+                  'w') as f:
+            f.write("<?xml version='1.0' encoding='utf-8' "
+                    "standalone='yes' ?>\n<map>\n"
+                    f'    <int name="default_uin" value="{self.uin}" />\n'
+                    '</map>\n')
+
+
+def generate_db(path, password, db_byte, rng):
+    """生成微信格式的加密数据库
+
+    建立message、rcontact和chatroom表，不断写入消息直到文件达到目标大小
+
+    :param path: 数据库路径
+    :param password: 密码
+    :param db_byte: 目标大小
+    :param rng: 随机数发生器
+    :return: 消息数
+    """
+    from server.android.decrypt import open_encrypted
+
+    conn = open_encrypted(path, password)
+    conn.execute("CREATE TABLE rcontact (username TEXT PRIMARY KEY, "
+                 "alias TEXT, conRemark TEXT, nickname TEXT, "
+                 "type INTEGER);")
+    conn.execute("CREATE TABLE chatroom (chatroomname TEXT PRIMARY KEY, "
+                 "memberlist TEXT, displayname TEXT, roomowner TEXT);")
+    conn.execute("CREATE TABLE message (msgId INTEGER PRIMARY KEY, "
+                 "msgSvrId INTEGER, type INTEGER, status INTEGER, "
+                 "isSend INTEGER, createTime INTEGER, talker TEXT, "
+                 "content TEXT, imgPath TEXT);")
+    conn.execute("CREATE INDEX messageCreateTimeIndex "
+                 "ON message (createTime);")
+    contacts = [f'wxid_{rng.getrandbits(48):012x}' for _ in range(200)]
+    conn.execute("BEGIN;")
+    conn.executemany("INSERT INTO rcontact VALUES (?, ?, ?, ?, ?);",
+                     [(name, '', '', f'user{i}', 3)
+                      for i, name in enumerate(contacts)])
+    rooms = [f'{rng.getrandbits(40)}@chatroom' for _ in range(20)]
+    conn.executemany("INSERT INTO chatroom VALUES (?, ?, ?, ?);",
+                     [(room, ';'.join(rng.sample(contacts, 10)), '',
+                       contacts[0]) for room in rooms])
+    conn.execute("COMMIT;")
+    words = ['hello', 'ok', '晚上', '吃饭', '明天', '见', 'photo',
+             'meeting', '收到', '谢谢', 'weekend', '好的']
+    count, created = 0, 1500000000
+    while os.path.getsize(path) < db_byte:
+        rows = []
+        for _ in range(2000):
+            count = count + 1
+            created = created + rng.randint(1, 600)
+            rows.append((count, rng.getrandbits(62), 1, 3,
+                         rng.randint(0, 1), created * 1000,
+                         rng.choice(contacts + rooms),
+                         ' '.join(rng.choice(words) for _ in
+                                  range(rng.randint(2, 40))), ''))
+        conn.execute("BEGIN;")
+        conn.executemany("INSERT INTO message VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+        conn.execute("COMMIT;")
+    conn.close()
+    return count
+
+
+def generate_res(root, res_files, res_byte, rng):
+    """生成资源目录
+
+    文件分布在各资源目录的两级子目录下，大小按对数均匀分布后缩放到目标
+    总大小，内容为随机数据(与图片、视频一样基本不可压缩)
+
+    :param root: 用户资源目录
+    :param res_files: 文件数
+    :param res_byte: 目标总大小
+    :param rng: 随机数发生器
+    :return: 无
+    """
+    weights = [rng.uniform(10, 22) for _ in range(res_files)]
+    sizes = [2 ** w for w in weights]
+    scale = res_byte / sum(sizes) if sizes else 0
+    mtime = 1600000000
+    for i, size in enumerate(sizes):
+        folder = RES_FOLDERS[i % len(RES_FOLDERS)]
+        digest = hashlib.md5(f'res-{i}'.encode()).hexdigest()
+        path = f'{root}/{folder}/{digest[:2]}/{digest[2:4]}/{digest}'
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(max(1, int(size * scale))))
+        os.utime(path, (mtime + i, mtime + i))
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """处理一个adb连接
+
+    连接先接受host请求，host:transport切换到设备后再接受一个设备服务
+    请求(shell、exec或sync)
+    """
+
+    def handle(self):
+        device = self.server.device
+        while True:
+            request = self._read_request()
+            if request is None:
+                return
+            if request.startswith('host:transport:'):
+                if request[15:] != device.serial:
+                    return self._fail(f"device '{request[15:]}' not found")
+                self._okay()
+            elif request in ('host:transport-any', 'host:transport-usb'):
+                self._okay()
+            elif request == 'host:version':
+                self._okay()
+                self._message('0029')
+            elif request == 'host:devices':
+                self._okay()
+                self._message(f'{device.serial}\tdevice\n')
+            elif request == 'host:devices-l':
+                self._okay()
+                self._message(f'{device.serial}  device usb:{device.bus}-1 '
+                              f'product:fake model:Fake_ADB device:fake\n')
+            elif request == 'host:track-devices':
+                self._okay()
+                self._message(f'{device.serial}\tdevice\n')
+                # 设备列表不会变化，保持连接直到客户端关闭
+                while self.request.recv(4096):
+                    pass
+                return
+            elif request.startswith('shell:'):
+                self._okay()
+                return self._run(request[6:], pty = True)
+            elif request.startswith('exec:'):
+                self._okay()
+                return self._run(request[5:], pty = False)
+            elif request == 'sync:':
+                self._okay()
+                return self._sync()
+            else:
+                return self._fail(f'unknown request: {request}')
+
+    def _recv(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+    def _send(self, data):
+        self.server.throttle(len(data))
+        self.request.sendall(data)
+
+    def _read_request(self):
+        length = self._recv(4)
+        if not length:
+            return None
+        return self._recv(int(length, 16)).decode('utf-8')
+
+    def _okay(self):
+        self.request.sendall(b'OKAY')
+
+    def _fail(self, message):
+        data = message.encode('utf-8')
+        self.request.sendall(b'FAIL' + b'%04x' % len(data) + data)
+
+    def _message(self, message):
+        data = message.encode('utf-8')
+        self.request.sendall(b'%04x' % len(data) + data)
+
+    def _run(self, cmd, pty):
+        """在本地执行设备命令并把输出传回
+
+        :param cmd: 设备命令
+        :param pty: 是否模拟pty，模拟时换行转换为\\r\\n
+        :return: 无
+        """
+        device = self.server.device
+        env = dict(os.environ,
+                   PATH = f'{device.bin_dir}:{os.environ.get("PATH", "")}')
+        process = subprocess.Popen(['sh', '-c', device.map_cmd(cmd)],
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.DEVNULL,
+                                   stdin = subprocess.DEVNULL, env = env)
+        try:
+            for chunk in iter(lambda: process.stdout.read1(65536), b''):
+                self._send(chunk.replace(b'\n', b'\r\n') if pty else chunk)
+        except OSError:
+            # 客户端提前关闭连接
+            process.kill()
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def _sync(self):
+        device = self.server.device
+        while True:
+            header = self._recv(8)
+            if not header:
+                return
+            id_, length = header[:4], struct.unpack('<I', header[4:])[0]
+            if id_ == b'QUIT':
+                return
+            data = self._recv(length).decode('utf-8')
+            if id_ == b'STAT':
+                try:
+                    st = os.stat(device.map_path(data))
+                    result = (st.st_mode, st.st_size, int(st.st_mtime))
+                except OSError:
+                    result = (0, 0, 0)
+                self.request.sendall(b'STAT' + struct.pack('<III', *result))
+            elif id_ == b'LIST':
+                self._sync_list(device.map_path(data))
+            elif id_ == b'RECV':
+                self._sync_recv(device.map_path(data))
+            elif id_ == b'SEND':
+                path, mode = data.rsplit(',', 1)
+                self._sync_send(device.map_path(path), int(mode))
+            else:
+                return self._sync_fail(f'unknown sync id: {id_!r}')
+
+    def _sync_fail(self, message):
+        data = message.encode('utf-8')
+        self.request.sendall(b'FAIL' + struct.pack('<I', len(data)) + data)
+
+    def _sync_list(self, path):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                st = os.lstat(f'{path}/{name}')
+            except OSError:
+                continue
+            data = name.encode('utf-8')
+            self.request.sendall(b'DENT' + struct.pack(
+                '<IIII', st.st_mode, st.st_size, int(st.st_mtime),
+                len(data)) + data)
+        self.request.sendall(b'DONE' + bytes(16))
+
+    def _sync_recv(self, path):
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            return self._sync_fail(str(e))
+        with f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                self._send(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+        self.request.sendall(b'DONE' + bytes(4))
+
+    def _sync_send(self, path, mode):
+        with open(path, 'wb') as f:
+            while True:
+                header = self._recv(8)
+                if not header:
+                    return
+                id_, length = header[:4], struct.unpack('<I', header[4:])[0]
+                if id_ == b'DONE':
+                    break
+                f.write(self._recv(length))
+        os.chmod(path, stat.S_IMODE(mode))
+        os.utime(path, (length, length))
+        self.request.sendall(b'OKAY' + bytes(4))
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """模拟的adb服务
+
+    实现AndroidDevice、AdbSync和资源拉取用到的host协议、shell和exec服务
+    以及sync协议，设备命令在本地的sh中执行。可限制传输带宽以模拟USB连接
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, device, host = '127.0.0.1', port = 0,
+                 bandwidth = None):
+        """
+        :param device: 模拟设备
+        :param host: 监听地址
+        :param port: 监听端口，为0时自动分配
+        :param bandwidth: 传输带宽(字节/秒)，为空时不限
+        """
+        super().__init__((host, port), _Handler)
+        self.device = device
+        self.bandwidth = bandwidth
+        self._thread = None
+        self._lock = threading.Lock()
+        self._next_time = 0  # 带宽限制下下一次传输可开始的时间
+
+    def throttle(self, length):
+        """按带宽等待，所有连接共用同一带宽
+
+        :param length: 本次传输的字节数
+        :return: 无
+        """
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + length / self.bandwidth
+            delay = self._next_time - now
+        time.sleep(delay)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target = self.serve_forever,
+                                        name = 'Fake adb server',
+                                        daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,271 @@
+"""基准测试
+
+在本地启动模拟的adb服务和设备，按实际的任务流程测量数据库拉取、资源
+拉取、数据库解密的吞吐量以及守护线程的调度延迟，不需要真实的手机。
+生成的数据只由参数和随机种子决定，相同参数的结果可以直接比较
+
+    python -m benchmarks.run --db-mb 64 --res-files 2000 --res-mb 256
+    python -m benchmarks.run --only db,schedule --repeat 5 --json out.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import time
+from threading import Event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server  # noqa: E402
+from server.android import AndroidDevice, DbPullRunner,\
+    DbDecryptRunner, ResPullRunner  # noqa: E402
+from server.task import TaskDaemon, TaskRunner, ProgressTicker  # noqa: E402
+
+from benchmarks.fakeadb import FakeDevice, FakeAdbServer  # noqa: E402
+
+MB = 1024 * 1024
+BENCHMARKS = ('db', 'res', 'decrypt', 'schedule')
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def tree_stat(path):
+    files, byte = 0, 0
+    for folder, _, names in os.walk(path):
+        for name in names:
+            files = files + 1
+            byte = byte + os.path.getsize(f'{folder}/{name}')
+    return files, byte
+
+
+class Bench:
+    """基准测试环境
+
+    在工作目录中启动守护线程和进度推送(推送内容丢弃)，任务经守护线程
+    运行，与服务中的调度方式一致
+    """
+
+    def __init__(self, device, port):
+        self.device = device
+        self.client = AndroidDevice(port = port)
+        self.daemon = TaskDaemon()
+        self.daemon.daemon = True
+        self.daemon.start()
+        server._daemon = self.daemon
+        server._ticker = ProgressTicker(self.daemon,
+                                        lambda channel, items: None)
+
+    def run_task(self, class_, name, params):
+        """运行任务直到结束
+
+        :param class_: 任务类
+        :param name: 任务名称
+        :param params: 任务参数
+        :return: 耗时秒数
+        """
+        params = dict(params, device = self.client,
+                      serial = self.device.serial)
+        start = time.perf_counter()
+        assert self.daemon.add_task(class_, name, params = params)
+        while self.daemon.has_task(name):
+            time.sleep(0.005)
+        return time.perf_counter() - start
+
+    def reset(self, name):
+        shutil.rmtree(f'data/{name}', ignore_errors = True)
+        shutil.rmtree('data/.store', ignore_errors = True)
+
+    def bench_db(self, mode, warm = False):
+        name = f'db-{mode}'
+        if not warm:
+            self.reset(name)
+        seconds = self.run_task(DbPullRunner, name,
+                                {'user': self.device.user, 'mode': mode})
+        dest = f'data/{name}/EnMicroMsg.db'
+        assert os.path.exists(dest) and\
+            file_md5(dest) == file_md5(self.device.db_path),\
+            f'{name} pulled database differs from the source'
+        byte = os.path.getsize(dest)
+        return {'seconds': seconds, 'MB/s': byte / MB / seconds}
+
+    def bench_res(self, output, workers, store = False):
+        name = f'res-{output}-{workers}'
+        self.reset(name)
+        seconds = self.run_task(ResPullRunner, name,
+                                {'user': self.device.user,
+                                 'output': output,
+                                 'workers': workers,
+                                 'incremental': False,
+                                 'store': store})
+        files, byte = tree_stat(self.device.res_path)
+        if output == 'files':
+            pulled = tree_stat(f'data/{name}/Resource')
+            assert pulled == (files, byte),\
+                f'{name} pulled {pulled}, expected {(files, byte)}'
+        return {'seconds': seconds,
+                'MB/s': byte / MB / seconds,
+                'files/s': files / seconds}
+
+    def bench_decrypt(self, executor, index):
+        name = f'decrypt-{executor}'
+        self.reset(name)
+        os.makedirs(f'data/{name}')
+        shutil.copyfile(self.device.db_path, f'data/{name}/EnMicroMsg.db')
+        seconds = self.run_task(DbDecryptRunner, name,
+                                {'password': self.device.password,
+                                 'executor': executor,
+                                 'index': index})
+        assert os.path.getsize(f'data/{name}/DeMicroMsg.db') > 0,\
+            f'{name} produced no plaintext database'
+        byte = os.path.getsize(self.device.db_path)
+        return {'seconds': seconds, 'MB/s': byte / MB / seconds}
+
+    def bench_schedule(self, events = 2000, tasks = 50):
+        """测量守护线程的调度延迟
+
+        事件延迟为定时事件实际执行时间与到期时间之差，任务延迟为加入任务
+        到任务运行循环开始的时间
+
+        :param events: 定时事件数
+        :param tasks: 任务数
+        :return: 各延迟的分位数(毫秒)
+        """
+        lags = []
+        done = Event()
+
+        def on_event(due):
+            lags.append(time.monotonic() - due)
+            if len(lags) == events:
+                done.set()
+
+        for i in range(events):
+            delay = (i % 100) / 1000
+            self.daemon.call_later(delay, on_event,
+                                   time.monotonic() + delay)
+        done.wait()
+
+        starts = []
+
+        class _Probe(TaskRunner):
+            def _on_before_runloop(self):
+                starts.append(time.perf_counter() - self._added)
+                self.stop()
+
+            def is_kill_when_stop(self):
+                return True
+
+        for i in range(tasks):
+            self.daemon.add_task(_Probe, f'probe-{i}',
+                                 params = {'added': time.perf_counter()})
+        while len(starts) < tasks or self.daemon.has_task_running():
+            time.sleep(0.005)
+        return dict(_percentiles('event', lags),
+                    **_percentiles('task', starts))
+
+    def close(self):
+        self.daemon.exit()
+
+
+def _percentiles(prefix, samples):
+    samples = sorted(samples)
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]\
+            * 1000
+
+    return {f'{prefix} p50 ms': at(0.5), f'{prefix} p95 ms': at(0.95),
+            f'{prefix} p99 ms': at(0.99), f'{prefix} max ms': at(1)}
+
+
+def _median(runs):
+    return {key: statistics.median(run[key] for run in runs)
+            for key in runs[0]}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark wechatBackup against a fake ADB server')
+    parser.add_argument('--work', default = os.path.join(ROOT, 'data',
+                                                         '.bench'),
+                        help = 'working directory (default data/.bench)')
+    parser.add_argument('--db-mb', type = float, default = 32)
+    parser.add_argument('--res-files', type = int, default = 1000)
+    parser.add_argument('--res-mb', type = float, default = 128)
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--bandwidth', type = float, default = None,
+                        help = 'simulated link speed in MB/s')
+    parser.add_argument('--workers', type = int, nargs = '+',
+                        default = [1, 4])
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--only', default = ','.join(BENCHMARKS),
+                        help = 'comma separated subset of '
+                               f'{",".join(BENCHMARKS)}')
+    parser.add_argument('--json', help = 'write results to this file')
+    args = parser.parse_args(argv)
+    only = set(args.only.split(','))
+    output = os.path.abspath(args.json) if args.json else None
+
+    os.makedirs(args.work, exist_ok = True)
+    os.chdir(args.work)
+    device = FakeDevice('device')
+    print(f'generating device data in {os.path.abspath("device")} ...')
+    device.generate(int(args.db_mb * MB), args.res_files,
+                    int(args.res_mb * MB), args.seed)
+    adb = FakeAdbServer(device, bandwidth = args.bandwidth * MB
+                        if args.bandwidth else None).start()
+    bench = Bench(device, adb.port)
+
+    cases = []
+    if 'db' in only:
+        for mode in ('chunked', 'snapshot', 'sync'):
+            cases.append((f'db pull {mode}',
+                          lambda mode = mode: bench.bench_db(mode)))
+        cases.append(('db pull snapshot (unchanged)',
+                      lambda: bench.bench_db('snapshot', warm = True)))
+    if 'res' in only:
+        for workers in args.workers:
+            cases.append((f'res pull files x{workers}',
+                          lambda w = workers: bench.bench_res('files', w)))
+        cases.append((f'res pull archive x{args.workers[-1]}',
+                      lambda: bench.bench_res('archive',
+                                              args.workers[-1])))
+    if 'decrypt' in only:
+        for executor in ('thread', 'process'):
+            cases.append((f'decrypt {executor}',
+                          lambda e = executor: bench.bench_decrypt(
+                              e, False)))
+        cases.append(('decrypt + index',
+                      lambda: bench.bench_decrypt('process', True)))
+    if 'schedule' in only:
+        cases.append(('daemon scheduling', bench.bench_schedule))
+
+    results = {}
+    try:
+        for title, case in cases:
+            runs = [case() for _ in range(args.repeat)]
+            results[title] = _median(runs)
+            print(f'{title:<32}' + '  '.join(
+                f'{key} {value:.2f}'
+                for key, value in results[title].items()))
+    finally:
+        bench.close()
+        adb.stop()
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'params': vars(args), 'results': results}, f,
+                      indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -24,3 +24,113 @@ DEVICE_IP = '127.0.0.1'
 DEVICE_PORT = 5037
 
 LOG_NAME = 'wechatBackup'
+
+# resource pull mode: stream (raw exec tar stream) or base64 (legacy)
+RES_PULL_MODE = 'stream'
+# only pull resource files that are new or changed since the last pull
+RES_PULL_INCREMENTAL = True
+# number of adb connections pulling resources at the same time
+RES_PULL_WORKERS = 4
+# upper bounds of one resource shard (one tar stream)
+RES_PULL_SHARD_BYTE = 64 * 1024 * 1024
+RES_PULL_SHARD_FILES = 2000
+# content-addressed store shared by all projects: files of at least
+# RES_STORE_MIN_BYTE are hashed on the device first and hardlinked from
+# the store instead of pulled when their content is already known
+RES_STORE = True
+RES_STORE_DIR = 'data/.store'
+RES_STORE_MIN_BYTE = 64 * 1024
+# resource output: files (one file per member under Resource) or archive
+# (members appended to pack files under Resource.pack with an index)
+RES_OUTPUT = 'files'
+RES_ARCHIVE_PACK_BYTE = 1024 * 1024 * 1024
+# compression of resource tar streams: auto (sample each folder and keep
+# the encoding with the best end-to-end rate) or one of none, gzip-fast,
+# gzip, gzip-strong and xz
+RES_PULL_ENCODING = 'auto'
+# bytes and files sampled per folder; folders with less changed data than
+# RES_ENCODING_MIN_BYTE are not sampled; negotiated encodings are kept in
+# RES_ENCODING_FILE per device and folder for RES_ENCODING_TTL seconds
+RES_ENCODING_SAMPLE_BYTE = 4 * 1024 * 1024
+RES_ENCODING_SAMPLE_FILES = 32
+RES_ENCODING_MIN_BYTE = 32 * 1024 * 1024
+RES_ENCODING_FILE = 'data/encodings.json'
+RES_ENCODING_TTL = 7 * 24 * 3600
+
+# project catalog caching project info and backup sizes; size updates
+# are batched and written every CATALOG_FLUSH_INTERVAL seconds
+CATALOG_DB = 'data/catalog.db'
+CATALOG_FLUSH_INTERVAL = 30
+
+# database pull mode: chunked (verified, resumable), snapshot (changed
+# blocks only, versioned) or sync (legacy)
+DB_PULL_MODE = 'chunked'
+DB_PULL_CHUNK_BYTE = 8 * 1024 * 1024
+# retries of one chunk before the pull is given up
+DB_PULL_RETRIES = 3
+# snapshot mode: the database is hashed on the device in blocks and only
+# blocks missing from the project's block store are pulled; every run is
+# kept as a snapshot that can be restored, the oldest beyond
+# DB_SNAPSHOT_KEEP are pruned
+DB_SNAPSHOT_BLOCK_BYTE = 1024 * 1024
+DB_SNAPSHOT_KEEP = 30
+
+# database decrypt mode: single (one pass, page progress) or migrate (legacy)
+DECRYPT_MODE = 'single'
+# cipher settings of the WeChat database
+DECRYPT_CIPHER_COMPATIBILITY = 1
+DECRYPT_CIPHER_PAGE_SIZE = 1024
+DECRYPT_KDF_ITER = 4000
+# page size of the decrypted database
+DECRYPT_PAGE_SIZE = 4096
+# page cache used while decrypting, negative values are KiB
+DECRYPT_CACHE_SIZE = -65536
+# rows copied per transaction, progress is reported after each batch
+DECRYPT_BATCH_ROWS = 5000
+# build a full-text index of messages after decrypting (single mode only)
+DECRYPT_BUILD_INDEX = True
+SEARCH_DB_NAME = 'SearchMicroMsg'
+SEARCH_BATCH_ROWS = 20000
+SEARCH_PAGE_SIZE = 20
+# run single mode decrypt jobs in a process pool (process) or in the
+# task thread (thread); the pool size defaults to the number of cores
+DECRYPT_EXECUTOR = 'process'
+DECRYPT_WORKERS = None
+# seconds between progress reads of a job running in the pool
+DECRYPT_POLL_INTERVAL = 0.5
+# password candidates (every IMEI with every UIN spelling) are checked
+# against the database in parallel before decrypting; WeChat uses the
+# fallback IMEI when the device IMEI is not available
+DECRYPT_KEY_WORKERS = 8
+DECRYPT_FALLBACK_IMEI = ('1234567890ABCDEF',)
+
+# export of decrypted messages, contacts and chat rooms: jsonl, csv or
+# html (static pages of at most EXPORT_HTML_PAGE_ROWS rows); rows are
+# read EXPORT_BATCH_ROWS at a time and group senders are looked up
+# through an LRU cache of EXPORT_CONTACT_CACHE contacts
+EXPORT_FORMAT = 'jsonl'
+EXPORT_BATCH_ROWS = 1000
+EXPORT_HTML_PAGE_ROWS = 2000
+EXPORT_CONTACT_CACHE = 4096
+
+# device session cache (seconds)
+DEVICE_SESSION_TTL = 300
+DEVICE_ROOT_TTL = 10
+# device list cache while track-devices is not available
+DEVICE_LIST_TTL = 2
+DEVICE_TRACK_RETRY = 5
+
+# progress ticker interval (seconds)
+PROGRESS_TICK_INTERVAL = 1
+
+# task execution mode: 'thread' runs every task in its own thread,
+# 'asyncio' runs heartbeat, once and db pull tasks on one event loop
+TASK_EXECUTION_MODE = 'thread'
+
+# seconds between cancellation checks inside long SQLite statements,
+# checked every TASK_CANCEL_CHECK_OPS virtual machine instructions
+TASK_CANCEL_CHECK_INTERVAL = 0.05
+TASK_CANCEL_CHECK_OPS = 10000
+
+# concurrent task limits: whole host, per device and per USB bus
+TASK_SLOT_LIMITS = {'fleet': 8, 'device': 2, 'bus': 4}
@@ -7,13 +7,17 @@ from flask_babel import gettext as _
 from flask_socketio import SocketIO, Namespace, leave_room
 
 from config import LOG_NAME
-from .android import AndroidDevice, DbPullRunner, DbDecryptRunner,\
-    ResPullRunner, DBPullRunnerInitError, DbDecryptRunnerInitError,\
-    ResPullRunnerInitError
+from . import metrics
+from .android import AndroidDevice, DbPullRunner, AsyncDbPullRunner,\
+    DbDecryptRunner, ResPullRunner, ExportRunner, DBPullRunnerInitError,\
+    DbDecryptRunnerInitError, ResPullRunnerInitError, ExportRunnerInitError
+from .metrics import MetricsRegistry
 from .task import TaskDaemon, TaskRunner, HeartbeatRunner, OnceRunner,\
-    HeartbeatInitError, OnceInitError
+    AsyncTaskRunner, AsyncHeartbeatRunner, AsyncOnceRunner,\
+    ProgressTicker, CancelToken, HeartbeatInitError, OnceInitError
 
 _daemon = None
+_ticker = None
 
 logger = logging.getLogger(LOG_NAME)
 
@@ -34,6 +38,7 @@ class GeneralNamespace(Namespace):
             name: #[必选]名称
             channel: #[必选]信道
             command: #[必选]命令名
+            serial: #[可选]设备序列号，为空时使用第一台设备
             params: #[可选]参数
         }
 
@@ -58,7 +63,10 @@ class GeneralNamespace(Namespace):
                 f'server.{data["channel"]}.device')
             client = getattr(channel_device, '_client')
             command = getattr(client, f'cmd_{data["command"]}')
-            result = command(data["name"], **data.get('params', {}))
+            params = dict(data.get('params', None) or {})
+            if data.get('serial', None):
+                params.setdefault('serial', data['serial'])
+            result = command(data["name"], **params)
             # noinspection PyTypeChecker
             return (data['command'],
                     data.get('name', None)) + result
@@ -75,6 +83,7 @@ class GeneralNamespace(Namespace):
             name: #[必选]名称
             channel: #[必选]信道
             category: #[必选]类别
+            serial: #[可选]设备序列号，为空时使用第一台设备
             params: #[可选]参数
         }
 
@@ -103,7 +112,9 @@ class GeneralNamespace(Namespace):
             client = getattr(channel_device, '_client')
             runner = categories.get(data["category"], None)
             assert runner
-            params = data.get("params", None)
+            params = dict(data.get("params", None) or {})
+            if data.get('serial', None):
+                params.setdefault('serial', data['serial'])
             params["device"] = client
             result = _daemon.add_task(runner, data["name"],
                                       params = params,
@@ -135,6 +146,19 @@ class GeneralNamespace(Namespace):
                     data.get('name', None),
                     False, None, _('Kill task error'))
 
+    def on_query_metrics(self, *args):
+        """查询性能指标
+
+        指标按以下格式返回
+        {
+            指标名称: [{labels: 标签, value: 值}], #直方图只有次数和总和
+        }
+
+        :param args:
+        :return: 性能指标
+        """
+        return metrics.registry.snapshot()
+
     def task_response(self, channel, data):
         """
         任务执行回调
@@ -157,6 +181,22 @@ class GeneralNamespace(Namespace):
                   namespace = '/general',
                   room = channel)
 
+    def task_batch_response(self, channel, items):
+        """
+        任务进度合并回调
+
+        一次返回同一信道多个任务的进度，每项格式同task_response，
+        其中业务数据只包含与上次相比有变化的字段
+
+        :param channel: 信道
+        :param items: 返回数据列表
+        :return: 无
+        """
+        self.emit('task_batch_response',
+                  items,
+                  namespace = '/general',
+                  room = channel)
+
 
 def exit_running_daemon_by_atexit():
     logger.debug('exit by atexit')
@@ -172,13 +212,16 @@ def exit_running_daemon_by_signal(signum, frame):
 
 def init_app(app):
     _socketio = SocketIO(app)
-    _socketio.on_namespace(GeneralNamespace('/general'))
+    namespace = GeneralNamespace('/general')
+    _socketio.on_namespace(namespace)
 
     # 启动任务守护线程
-    global _daemon
+    global _daemon, _ticker
     _daemon = TaskDaemon()
     _daemon.setDaemon(True)
     _daemon.start()
+    # 进度推送由守护线程调度
+    _ticker = ProgressTicker(_daemon, namespace.task_batch_response)
 
     # 程序退出时退出任务守护线程
     atexit.register(exit_running_daemon_by_atexit)
@@ -196,11 +239,20 @@ __all__ = (
     'TaskRunner',
     'HeartbeatRunner',
     'OnceRunner',
+    'AsyncTaskRunner',
+    'AsyncHeartbeatRunner',
+    'AsyncOnceRunner',
+    'ProgressTicker',
+    'CancelToken',
     'DbPullRunner',
+    'AsyncDbPullRunner',
     'DbDecryptRunner',
     'ResPullRunner',
+    'ExportRunner',
     # socket class
     'GeneralNamespace',
+    # metrics class
+    'MetricsRegistry',
     # device class
     'AndroidDevice',
     # errot class
@@ -209,4 +261,5 @@ __all__ = (
     'DBPullRunnerInitError',
     'DbDecryptRunnerInitError',
     'ResPullRunnerInitError',
+    'ExportRunnerInitError',
 )
@@ -1,14 +1,17 @@
 from .device import AndroidDevice
-from .task import DbPullRunner, DbDecryptRunner, ResPullRunner,\
-    DBPullRunnerInitError, DbDecryptRunnerInitError,\
-    ResPullRunnerInitError
+from .task import DbPullRunner, AsyncDbPullRunner, DbDecryptRunner,\
+    ResPullRunner, ExportRunner, DBPullRunnerInitError,\
+    DbDecryptRunnerInitError, ResPullRunnerInitError, ExportRunnerInitError
 
 __all__ = (
     'AndroidDevice',
     'DbPullRunner',
+    'AsyncDbPullRunner',
     'DbDecryptRunner',
     'ResPullRunner',
+    'ExportRunner',
     'DBPullRunnerInitError',
     'DbDecryptRunnerInitError',
     'ResPullRunnerInitError',
+    'ExportRunnerInitError',
 )
@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+
+from config import LOG_NAME
+from ..metrics import adb_request_seconds
+
+logger = logging.getLogger(LOG_NAME)
+
+
+class AsyncAdbError(RuntimeError):
+    pass
+
+
+class AsyncConnection:
+    """adb服务的异步连接
+
+    按adb的host协议发送请求，请求为4位十六进制长度加内容，
+    服务端以OKAY或FAIL应答
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._loop = asyncio.get_running_loop()
+        self._aborted = False
+
+    async def send(self, cmd):
+        data = cmd.encode('utf-8')
+        self._writer.write(b'%04x' % len(data) + data)
+        await self._writer.drain()
+        await self._check_status()
+
+    async def _check_status(self):
+        status = await self.read(4)
+        if status == b'FAIL':
+            raise AsyncAdbError(await self.read_message())
+        if status != b'OKAY':
+            raise AsyncAdbError(f'unexpected status: {status!r}')
+
+    async def read(self, length):
+        try:
+            return await self._reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            raise AsyncAdbError('connection closed') from e
+
+    async def read_chunk(self, length = 65536):
+        """读取一块数据
+
+        :param length: 最大长度
+        :return: 数据，连接关闭时为空
+        """
+        data = await self._reader.read(length)
+        if not data and self._aborted:
+            # 被中止的连接不能当作正常结束
+            raise InterruptedError('connection aborted')
+        return data
+
+    async def read_line(self):
+        """读取一行
+
+        :return: 包含换行符的一行，连接关闭时为空
+        """
+        line = await self._reader.readline()
+        if not line and self._aborted:
+            raise InterruptedError('connection aborted')
+        return line
+
+    async def read_all(self):
+        data = bytearray()
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return bytes(data)
+            data.extend(chunk)
+
+    async def read_message(self):
+        length = int(await self.read(4), 16)
+        return (await self.read(length)).decode('utf-8', 'replace')
+
+    async def write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def abort(self):
+        """中止连接，可在其他线程调用，阻塞中的读取抛出InterruptedError
+
+        :return: 无
+        """
+        self._aborted = True
+        self._loop.call_soon_threadsafe(self._writer.transport.abort)
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class AsyncSync:
+    """adb的sync协议
+
+    请求和应答均为4字节标识加4字节小端长度，文件数据按DATA块传输，
+    单块不超过64KB
+    """
+
+    DATA_MAX = 64 * 1024
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    async def _request(self, id_, path):
+        data = path.encode('utf-8')
+        await self._connection.write(
+            id_ + struct.pack('<I', len(data)) + data)
+
+    async def _response(self):
+        header = await self._connection.read(8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    async def stat(self, path):
+        """读取设备文件的状态
+
+        :param path: 设备上的文件路径
+        :return: (模式, 大小, 修改时间)，文件不存在时模式为0
+        """
+        await self._request(b'STAT', path)
+        id_ = await self._connection.read(4)
+        if id_ != b'STAT':
+            raise AsyncAdbError(f'unexpected sync id: {id_!r}')
+        return struct.unpack('<III', await self._connection.read(12))
+
+    async def pull(self, src, dest, progress = None):
+        """拉取设备文件
+
+        :param src: 设备上的文件路径
+        :param dest: 本地文件对象，需以二进制方式打开
+        :param progress: 进度回调，参数为本次已写入的字节数
+        :return: 写入的字节数
+        """
+        await self._request(b'RECV', src)
+        total = 0
+        while True:
+            id_, length = await self._response()
+            if id_ == b'DONE':
+                return total
+            if id_ == b'FAIL':
+                raise AsyncAdbError((await self._connection.read(length))
+                                    .decode('utf-8', 'replace'))
+            if id_ != b'DATA':
+                raise AsyncAdbError(f'unexpected sync id: {id_!r}')
+            data = await self._connection.read(length)
+            dest.write(data)
+            total = total + length
+            if progress:
+                progress(total)
+
+    async def push(self, src, dest, mode = 0o644, mtime = None):
+        """推送本地文件到设备
+
+        :param src: 本地文件对象，需以二进制方式打开
+        :param dest: 设备上的文件路径
+        :param mode: 文件权限
+        :param mtime: 修改时间，为空时取当前时间
+        :return: 无
+        """
+        await self._request(b'SEND', f'{dest},{mode | 0o100000}')
+        while True:
+            data = src.read(self.DATA_MAX)
+            if not data:
+                break
+            await self._connection.write(
+                b'DATA' + struct.pack('<I', len(data)) + data)
+        mtime = int(mtime if mtime is not None else time.time())
+        await self._connection.write(b'DONE' + struct.pack('<I', mtime))
+        id_, length = await self._response()
+        if id_ == b'FAIL':
+            raise AsyncAdbError((await self._connection.read(length))
+                                .decode('utf-8', 'replace'))
+
+
+class AsyncAdbClient:
+    """异步adb客户端
+
+    实现adb服务的host协议、设备transport上的shell和exec服务以及sync
+    协议，每个请求使用独立的连接，可在一个事件循环中并发驱动多个传输
+    """
+
+    def __init__(self, host = '127.0.0.1', port = 5037):
+        self.host = host
+        self.port = port
+
+    async def create_connection(self, timeout = None):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout)
+        return AsyncConnection(reader, writer)
+
+    async def devices(self):
+        """获取设备列表
+
+        :return: (序列号, 状态)列表
+        """
+        async with await self.create_connection() as conn:
+            await conn.send('host:devices')
+            lines = await conn.read_message()
+        return [tuple(line.split('\t', 1))
+                for line in lines.splitlines() if line]
+
+    async def transport(self, serial, timeout = None):
+        """建立到设备的连接
+
+        :param serial: 序列号
+        :param timeout: 连接超时
+        :return: 已切换到设备transport的连接
+        """
+        with adb_request_seconds.time(request = 'connect'):
+            conn = await self.create_connection(timeout)
+            try:
+                await conn.send(f'host:transport:{serial}')
+            except Exception:
+                await conn.close()
+                raise
+        return conn
+
+    async def shell(self, serial, cmd, timeout = None):
+        """在设备上执行shell命令
+
+        :param serial: 序列号
+        :param cmd: 命令
+        :param timeout: 连接超时
+        :return: 命令输出
+        """
+        with adb_request_seconds.time(request = 'shell'):
+            async with await self.transport(serial, timeout) as conn:
+                await conn.send(f'shell:{cmd}')
+                return (await conn.read_all()).decode('utf-8', 'replace')
+
+    async def exec_out(self, serial, cmd, timeout = None):
+        """打开设备命令的二进制输出流
+
+        输出不经过pty转换，由调用方按块读取并负责关闭连接
+
+        :param serial: 序列号
+        :param cmd: 命令
+        :param timeout: 连接超时
+        :return: 连接
+        """
+        with adb_request_seconds.time(request = 'exec'):
+            conn = await self.transport(serial, timeout)
+            try:
+                await conn.send(f'exec:{cmd}')
+            except Exception:
+                await conn.close()
+                raise
+        logger.debug(f'async exec stream open: {cmd}')
+        return conn
+
+    async def sync(self, serial, timeout = None):
+        """打开设备的sync连接
+
+        :param serial: 序列号
+        :param timeout: 连接超时
+        :return: (连接, sync协议)
+        """
+        conn = await self.transport(serial, timeout)
+        try:
+            await conn.send('sync:')
+        except Exception:
+            await conn.close()
+            raise
+        return conn, AsyncSync(conn)
+
+    async def pull(self, serial, src, dest, progress = None):
+        """拉取设备文件到本地
+
+        :param serial: 序列号
+        :param src: 设备上的文件路径
+        :param dest: 本地文件路径
+        :param progress: 进度回调，参数为已写入的字节数
+        :return: 写入的字节数
+        """
+        conn, sync = await self.sync(serial)
+        async with conn:
+            with open(dest, 'wb') as f:
+                return await sync.pull(src, f, progress)
+
+    async def push(self, serial, src, dest, mode = 0o644):
+        """推送本地文件到设备
+
+        :param serial: 序列号
+        :param src: 本地文件路径
+        :param dest: 设备上的文件路径
+        :param mode: 文件权限
+        :return: 无
+        """
+        conn, sync = await self.sync(serial)
+        async with conn:
+            with open(src, 'rb') as f:
+                await sync.push(f, dest, mode,
+                                int(os.stat(src).st_mtime))
@@ -0,0 +1,181 @@
+import logging
+import os
+import shutil
+import sqlite3
+import uuid
+from threading import Lock, local
+
+from config import LOG_NAME, RES_ARCHIVE_PACK_BYTE
+
+logger = logging.getLogger(LOG_NAME)
+
+_HIGH = '\U0010ffff'  # 前缀查询的上界，大于任何路径字符
+
+
+class PackArchive:
+    """资源归档
+
+    资源文件依次追加到少数几个大的包文件中，成员的位置记录在SQLite索引
+    (index.db)中。查找、列出、统计和删除成员都只操作索引，不再遍历
+    大量小文件。每个写入线程使用各自的包文件，并发写入时只在更新索引时
+    加锁；包文件超过pack_byte后换用新的包文件
+    """
+
+    INDEX_NAME = 'index.db'
+    COMMIT_ROWS = 1000  # 每批提交的索引行数
+
+    def __init__(self, root, pack_byte = RES_ARCHIVE_PACK_BYTE):
+        """
+        :param root: 归档目录
+        :param pack_byte: 单个包文件的大小上限
+        """
+        os.makedirs(root, exist_ok = True)
+        self._root = root
+        self._pack_byte = pack_byte
+        self._conn = sqlite3.connect(f'{root}/{self.INDEX_NAME}',
+                                     isolation_level = None,
+                                     check_same_thread = False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS member ("
+                           "path TEXT PRIMARY KEY, pack TEXT NOT NULL, "
+                           "offset INTEGER NOT NULL, "
+                           "size INTEGER NOT NULL, "
+                           "mtime INTEGER NOT NULL);")
+        self._lock = Lock()
+        self._local = local()
+        self._writers = []  # 所有打开的包文件
+        self._pending = 0  # 未提交的索引行数
+
+    def add(self, path, fileobj, size, mtime):
+        """追加成员，同路径的旧成员被替换
+
+        :param path: 成员路径
+        :param fileobj: 成员内容的文件对象
+        :param size: 成员大小
+        :param mtime: 修改时间
+        :return: 无
+        """
+        pack, f = self._writer()
+        offset = f.tell()
+        shutil.copyfileobj(fileobj, f, 1024 * 1024)
+        f.flush()
+        if f.tell() - offset != size:
+            raise OSError(f'archive member {path} truncated')
+        with self._lock:
+            if self._pending == 0:
+                self._conn.execute("BEGIN;")
+            self._conn.execute("INSERT OR REPLACE INTO member "
+                               "VALUES (?, ?, ?, ?, ?);",
+                               (path, pack, offset, size, mtime))
+            self._pending = self._pending + 1
+            if self._pending >= self.COMMIT_ROWS:
+                self._commit()
+
+    def _writer(self):
+        writer = getattr(self._local, 'writer', None)
+        if writer is None or writer[1].tell() >= self._pack_byte:
+            pack = f'pack-{uuid.uuid4().hex[:12]}.bin'
+            writer = (pack, open(f'{self._root}/{pack}', 'ab'))
+            self._local.writer = writer
+            with self._lock:
+                self._writers.append(writer[1])
+        return writer
+
+    def _commit(self):
+        if self._pending:
+            self._conn.execute("COMMIT;")
+            self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            for f in self._writers:
+                f.close()
+            self._writers = []
+            self._commit()
+            self._conn.close()
+
+    def __contains__(self, path):
+        return self._query_one("SELECT 1 FROM member WHERE path = ?;",
+                               (path,)) is not None
+
+    def read(self, path):
+        """读取成员内容
+
+        :param path: 成员路径
+        :return: 内容
+        """
+        row = self._query_one("SELECT pack, offset, size FROM member "
+                              "WHERE path = ?;", (path,))
+        if row is None:
+            raise FileNotFoundError(path)
+        pack, offset, size = row
+        with open(f'{self._root}/{pack}', 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def extract(self, path, dest):
+        with open(dest, 'wb') as f:
+            f.write(self.read(path))
+
+    def list(self, prefix = '', limit = -1, offset = 0):
+        """列出成员
+
+        :param prefix: 路径前缀
+        :param limit: 最多返回的条数，-1为不限
+        :param offset: 跳过的条数
+        :return: (路径, 大小, 修改时间)列表，按路径排序
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT path, size, mtime FROM member WHERE path >= ? "
+                "AND path < ? ORDER BY path LIMIT ? OFFSET ?;",
+                (prefix, prefix + _HIGH, limit, offset)).fetchall()
+
+    def stat(self, prefix = ''):
+        """统计成员
+
+        :param prefix: 路径前缀
+        :return: (成员数, 总字节数)
+        """
+        count, total = self._query_one(
+            "SELECT count(*), coalesce(sum(size), 0) FROM member "
+            "WHERE path >= ? AND path < ?;", (prefix, prefix + _HIGH))
+        return count, total
+
+    def remove(self, prefix):
+        """删除成员，只删除索引，包文件中的内容不再被引用
+
+        :param prefix: 路径前缀
+        :return: 删除的成员数
+        """
+        with self._lock:
+            self._commit()
+            return self._conn.execute(
+                "DELETE FROM member WHERE path >= ? AND path < ?;",
+                (prefix, prefix + _HIGH)).rowcount
+
+    def prune(self):
+        """删除不再被任何成员引用的包文件，本实例正在写入的包文件保留
+
+        :return: 删除的包文件数
+        """
+        with self._lock:
+            self._commit()
+            keep = {row[0] for row in self._conn.execute(
+                "SELECT DISTINCT pack FROM member;")}
+            keep.update(os.path.basename(f.name) for f in self._writers)
+        removed = 0
+        for name in os.listdir(self._root):
+            if name.startswith('pack-') and name.endswith('.bin') and\
+                    name not in keep:
+                os.remove(f'{self._root}/{name}')
+                removed = removed + 1
+        logger.debug(f'archive {self._root} pruned {removed} packs')
+        return removed
+
+    def _query_one(self, sql, args):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchone()
@@ -0,0 +1,271 @@
+import atexit
+import configparser
+import glob
+import logging
+import os
+import sqlite3
+import time
+from threading import Lock
+
+from config import LOG_NAME, CATALOG_DB, CATALOG_FLUSH_INTERVAL
+
+logger = logging.getLogger(LOG_NAME)
+
+
+def read_conf(file):
+    """读取项目配置文件
+
+    :param file: backup.conf路径
+    :return: (名称, 用户, 密码, 资源字节数)
+    """
+    cf = configparser.ConfigParser()
+    cf.read(file)
+    return cf.get('project', 'name'), cf.get('project', 'user'),\
+        cf.get('project', 'password'),\
+        int(cf.get('size', 'resource', fallback = '0'))
+
+
+def write_conf(file, name, user, password, resource_byte = 0):
+    cf = configparser.ConfigParser()
+    cf.add_section('project')
+    cf.set('project', 'name', name)
+    cf.set('project', 'user', user)
+    cf.set('project', 'password', password)
+    cf.add_section('size')
+    cf.set('size', 'resource', str(resource_byte))
+    with open(file, 'w') as f:
+        cf.write(f)
+
+
+class ProjectCatalog:
+    """项目目录
+
+    项目信息和各备份文件的大小缓存在SQLite索引(catalog.db)中，列出项目
+    时只查询索引，不再遍历data目录、读取配置文件和统计文件。拉取过程中
+    的大小更新先记在内存中，每隔flush_interval秒批量写入索引；资源大小
+    同时写回项目的backup.conf，索引丢失时可据此重建
+    """
+
+    def __init__(self, path = CATALOG_DB,
+                 flush_interval = CATALOG_FLUSH_INTERVAL):
+        """
+        :param path: 索引文件
+        :param flush_interval: 批量写入的间隔秒数
+        """
+        self._path = path
+        self._flush_interval = flush_interval
+        self._conn = None
+        self._lock = Lock()
+        self._pending = {}  # (项目, 文件) -> 未写入的字节数，None为删除
+        self._flushed_at = time.time()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path) or '.',
+                        exist_ok = True)
+            conn = sqlite3.connect(self._path, isolation_level = None,
+                                   check_same_thread = False)
+            conn.execute("CREATE TABLE IF NOT EXISTS project ("
+                         "name TEXT PRIMARY KEY, user TEXT NOT NULL, "
+                         "password TEXT NOT NULL);")
+            conn.execute("CREATE TABLE IF NOT EXISTS file ("
+                         "project TEXT NOT NULL, path TEXT NOT NULL, "
+                         "byte INTEGER NOT NULL, "
+                         "PRIMARY KEY (project, path));")
+            # 校验和不能由data目录重建，重建索引时保留
+            conn.execute("CREATE TABLE IF NOT EXISTS checksum ("
+                         "project TEXT NOT NULL, path TEXT NOT NULL, "
+                         "byte INTEGER NOT NULL, md5 TEXT NOT NULL, "
+                         "PRIMARY KEY (project, path));")
+            self._conn = conn
+            if not conn.execute("SELECT 1 FROM project;").fetchone():
+                self._rebuild()
+        return self._conn
+
+    def _rebuild(self):
+        """按data目录重建索引
+
+        :return: 项目数
+        """
+        projects, files = [], []
+        for conf in glob.glob('data/*/backup.conf'):
+            try:
+                name, user, password, resource_byte = read_conf(conf)
+            except (configparser.Error, ValueError) as e:
+                logger.debug(f'catalog skip {conf}: {e!r}')
+                continue
+            projects.append((name, user, password))
+            files.extend((name, f, os.stat(f).st_size) for f in
+                         glob.glob(f'data/{name}/??MicroMsg.db'))
+            files.extend((name, f, resource_byte) for f in
+                         glob.glob(f'data/{name}/Resource') +
+                         glob.glob(f'data/{name}/Resource.pack'))
+        self._conn.execute("BEGIN;")
+        self._conn.execute("DELETE FROM project;")
+        self._conn.execute("DELETE FROM file;")
+        self._conn.executemany("INSERT OR REPLACE INTO project "
+                               "VALUES (?, ?, ?);", projects)
+        self._conn.executemany("INSERT OR REPLACE INTO file "
+                               "VALUES (?, ?, ?);", files)
+        self._conn.execute("COMMIT;")
+        logger.debug(f'catalog rebuilt: {len(projects)} projects')
+        return len(projects)
+
+    def rebuild(self):
+        """丢弃未写入的更新并按data目录重建索引
+
+        :return: 项目数
+        """
+        with self._lock:
+            self._pending = {}
+            self._connect()
+            return self._rebuild()
+
+    def create(self, name, user, password):
+        """创建项目
+
+        :param name: 项目名称
+        :param user: 用户
+        :param password: 密码
+        :return: 无
+        """
+        os.makedirs(f'data/{name}', exist_ok = True)
+        write_conf(f'data/{name}/backup.conf', name, user, password)
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO project "
+                                    "VALUES (?, ?, ?);",
+                                    (name, user, password))
+
+    def set_password(self, project, password):
+        """更新项目的密码
+
+        解密时确认的密码只保存在索引和项目的backup.conf中，不随进度推送
+
+        :param project: 项目名称
+        :param password: 密码
+        :return: 无
+        """
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT user FROM project WHERE name = ?;",
+                               (project,)).fetchone()
+            if not row:
+                return
+            conn.execute("UPDATE project SET password = ? WHERE name = ?;",
+                         (password, project))
+            conf = f'data/{project}/backup.conf'
+            try:
+                resource_byte = read_conf(conf)[3]
+            except (configparser.Error, ValueError):
+                resource_byte = 0
+            try:
+                write_conf(conf, project, row[0], password,
+                           resource_byte = resource_byte)
+            except OSError as e:
+                logger.debug(f'catalog write {project} conf: {e!r}')
+
+    def set_size(self, project, path, byte):
+        """记录备份文件大小，延迟批量写入
+
+        :param project: 项目名称
+        :param path: 文件或目录路径
+        :param byte: 字节数
+        :return: 无
+        """
+        with self._lock:
+            self._pending[(project, path)] = byte
+            if time.time() - self._flushed_at >= self._flush_interval:
+                self._flush()
+
+    def remove(self, project, path):
+        with self._lock:
+            self._pending[(project, path)] = None
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._flushed_at = time.time()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        conn = self._connect()
+        conn.execute("BEGIN;")
+        conn.executemany("INSERT OR REPLACE INTO file VALUES (?, ?, ?);",
+                         [(project, path, byte) for (project, path), byte
+                          in pending.items() if byte is not None])
+        removed = [key for key, byte in pending.items() if byte is None]
+        conn.executemany("DELETE FROM file WHERE project = ? "
+                         "AND path = ?;", removed)
+        conn.executemany("DELETE FROM checksum WHERE project = ? "
+                         "AND path = ?;", removed)
+        conn.execute("COMMIT;")
+        for (project, path), byte in pending.items():
+            if os.path.basename(path).startswith('Resource'):
+                self._write_resource_byte(project, byte or 0)
+
+    def _write_resource_byte(self, project, byte):
+        row = self._conn.execute("SELECT user, password FROM project "
+                                 "WHERE name = ?;", (project,)).fetchone()
+        if row:
+            try:
+                write_conf(f'data/{project}/backup.conf', project, *row,
+                           resource_byte = byte)
+            except OSError as e:
+                logger.debug(f'catalog write {project} conf: {e!r}')
+
+    def set_checksum(self, project, path, byte, md5):
+        """记录备份文件的校验和
+
+        :param project: 项目名称
+        :param path: 文件路径
+        :param byte: 字节数
+        :param md5: 十六进制md5
+        :return: 无
+        """
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO checksum "
+                                    "VALUES (?, ?, ?, ?);",
+                                    (project, path, byte, md5))
+
+    def checksum(self, project, path):
+        """
+        :param project: 项目名称
+        :param path: 文件路径
+        :return: (字节数, 十六进制md5)，没有记录时为None
+        """
+        with self._lock:
+            return self._connect().execute(
+                "SELECT byte, md5 FROM checksum WHERE project = ? "
+                "AND path = ?;", (project, path)).fetchone()
+
+    def projects(self):
+        """列出所有项目
+
+        :return: {项目名称: {'user', 'password', 'files'}}
+        """
+        with self._lock:
+            conn = self._connect()
+            projects = {name: {'user': user,
+                               'password': password,
+                               'files': {}}
+                        for name, user, password in conn.execute(
+                            "SELECT name, user, password FROM project;")}
+            for project, path, byte in conn.execute(
+                    "SELECT project, path, byte FROM file "
+                    "ORDER BY path;"):
+                if project in projects:
+                    projects[project]['files'][path] = byte
+            for (project, path), byte in self._pending.items():
+                if project not in projects:
+                    continue
+                if byte is None:
+                    projects[project]['files'].pop(path, None)
+                else:
+                    projects[project]['files'][path] = byte
+        for project in projects.values():
+            project['files'] = sorted(project['files'].items())
+        return projects
@@ -0,0 +1,190 @@
+import logging
+import os
+
+from config import LOG_NAME, DECRYPT_CIPHER_COMPATIBILITY,\
+    DECRYPT_CIPHER_PAGE_SIZE, DECRYPT_KDF_ITER, DECRYPT_PAGE_SIZE,\
+    DECRYPT_CACHE_SIZE, DECRYPT_BATCH_ROWS, TASK_CANCEL_CHECK_OPS
+from .pool import interrupt_handler
+
+logger = logging.getLogger(LOG_NAME)
+
+try:
+    from pysqlcipher3 import dbapi2 as sqlite
+except ImportError:
+    # 只有解密需要pysqlcipher3，未安装时其他功能照常使用
+    sqlite = None
+
+# 加密格式：微信使用的旧版格式，以及migrate模式迁移后的SQLCipher 4格式
+CIPHERS = ('legacy', 'sqlcipher4')
+CIPHER4_PAGE_SIZE = 4096
+CIPHER4_KDF_ITER = 256000
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def open_encrypted(path, password, cache_size = DECRYPT_CACHE_SIZE,
+                   cipher = 'legacy'):
+    """按加密格式打开加密数据库
+
+    只做一次密钥派生，不迁移也不改写源文件
+
+    :param path: 加密数据库路径
+    :param password: 密码
+    :param cache_size: 页缓存大小，同PRAGMA cache_size
+    :param cipher: 加密格式，微信使用的旧版格式legacy或已迁移的sqlcipher4
+    :return: 数据库连接
+    """
+    assert cipher in CIPHERS
+    if sqlite is None:
+        raise ImportError('pysqlcipher3 is not installed')
+    conn = sqlite.connect(path)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA key = '" + password + "';")
+    if cipher == 'legacy':
+        cursor.execute(f"PRAGMA cipher_compatibility = "
+                       f"{DECRYPT_CIPHER_COMPATIBILITY};")
+        cursor.execute("PRAGMA cipher_use_hmac = OFF;")
+        cursor.execute(
+            f"PRAGMA cipher_page_size = {DECRYPT_CIPHER_PAGE_SIZE};")
+        cursor.execute(f"PRAGMA kdf_iter = {DECRYPT_KDF_ITER};")
+    else:
+        cursor.execute(f"PRAGMA cipher_page_size = {CIPHER4_PAGE_SIZE};")
+        cursor.execute(f"PRAGMA kdf_iter = {CIPHER4_KDF_ITER};")
+    cursor.execute(f"PRAGMA cache_size = {int(cache_size)};")
+    cursor.close()
+    return conn
+
+
+def export_plaintext(src, dest, password, page_size = DECRYPT_PAGE_SIZE,
+                     cache_size = DECRYPT_CACHE_SIZE,
+                     batch_rows = DECRYPT_BATCH_ROWS, progress = None,
+                     cancelled = None, cipher = 'legacy'):
+    """单遍解密数据库
+
+    直接按旧版格式读取加密数据库，逐表按rowid分批复制到明文数据库，
+    数据复制完后再建索引、触发器和视图。每批复制后按明文库已写入的页数
+    换算出已处理的源库页数并回调进度。取消后正在执行的语句被中止并
+    抛出异常
+
+    :param src: 加密数据库路径
+    :param dest: 明文数据库路径，已存在时会被覆盖
+    :param password: 密码
+    :param page_size: 明文数据库的页大小
+    :param cache_size: 页缓存大小，同PRAGMA cache_size
+    :param batch_rows: 每批复制的行数
+    :param progress: 进度回调，参数为(已处理页数, 总页数)
+    :param cancelled: 返回是否已取消的方法
+    :param cipher: 源库的加密格式
+    :return: 总页数
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    conn = open_encrypted(src, password, cache_size, cipher)
+    _interruptible(conn, cancelled)
+    cursor = conn.cursor()
+    try:
+        total = cursor.execute("PRAGMA page_count;").fetchone()[0]
+        schema = cursor.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE sql NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY rowid;").fetchall()
+        user_version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+
+        # 在明文库中先只建表，索引等数据复制完后再建
+        plain = sqlite.connect(dest)
+        plain.execute(f"PRAGMA page_size = {int(page_size)};")
+        for type_, name, sql in schema:
+            if type_ == 'table':
+                _execute_schema(plain, name, sql)
+        plain.execute(f"PRAGMA user_version = {int(user_version)};")
+        plain.commit()
+        plain.close()
+
+        cursor.execute(f"ATTACH DATABASE '{dest}' AS db KEY '';")
+        cursor.execute("PRAGMA db.journal_mode = OFF;")
+        cursor.execute("PRAGMA db.synchronous = OFF;")
+        ratio = page_size / (DECRYPT_CIPHER_PAGE_SIZE
+                             if cipher == 'legacy' else CIPHER4_PAGE_SIZE)
+
+        def report():
+            if progress:
+                done = cursor.execute("PRAGMA db.page_count;").fetchone()[0]
+                progress(min(int(done * ratio), total), total)
+
+        for type_, name, sql in schema:
+            if type_ == 'table' and not sql.upper().startswith(
+                    'CREATE VIRTUAL'):
+                _copy_table(cursor, name, batch_rows, report)
+        if cursor.execute("SELECT 1 FROM main.sqlite_master WHERE "
+                          "name = 'sqlite_sequence';").fetchone():
+            cursor.execute("DELETE FROM db.sqlite_sequence;")
+            cursor.execute("INSERT INTO db.sqlite_sequence "
+                           "SELECT * FROM main.sqlite_sequence;")
+        cursor.execute("DETACH DATABASE db;")
+    finally:
+        cursor.close()
+        conn.close()
+
+    plain = sqlite.connect(dest)
+    _interruptible(plain, cancelled)
+    for type_, name, sql in schema:
+        if type_ != 'table':
+            _execute_schema(plain, name, sql)
+    plain.commit()
+    plain.close()
+    if cancelled and cancelled():
+        # 建索引的语句被中止时只记录日志，在此统一结束
+        raise sqlite.OperationalError('interrupted')
+    if progress:
+        progress(total, total)
+    return total
+
+
+def _interruptible(conn, cancelled):
+    if cancelled:
+        conn.set_progress_handler(interrupt_handler(cancelled),
+                                  TASK_CANCEL_CHECK_OPS)
+
+
+def _execute_schema(conn, name, sql):
+    try:
+        conn.execute(sql)
+    except sqlite.Error as e:
+        logger.debug(f'decrypt skip schema {name}: {e}')
+
+
+def _copy_table(cursor, name, batch_rows, report):
+    table = _quote(name)
+    columns = ', '.join(
+        _quote(row[1])
+        for row in cursor.execute(f"PRAGMA main.table_info({table});"))
+    try:
+        low = cursor.execute(
+            f"SELECT min(rowid) FROM main.{table};").fetchone()[0]
+    except sqlite.Error:
+        # WITHOUT ROWID表只能整表复制
+        cursor.execute("BEGIN;")
+        cursor.execute(f"INSERT INTO db.{table} SELECT * FROM main.{table};")
+        cursor.execute("COMMIT;")
+        report()
+        return
+    insert = f"INSERT INTO db.{table} (rowid, {columns}) "\
+             f"SELECT rowid, {columns} FROM main.{table} WHERE rowid >= ?"
+    while low is not None:
+        # 按rowid取下一批的起点，rowid不连续时批次大小也保持不变
+        row = cursor.execute(
+            f"SELECT rowid FROM main.{table} WHERE rowid >= ? "
+            f"ORDER BY rowid LIMIT 1 OFFSET ?;",
+            (low, batch_rows)).fetchone()
+        high = row[0] if row else None
+        cursor.execute("BEGIN;")
+        if high is None:
+            cursor.execute(f"{insert};", (low,))
+        else:
+            cursor.execute(f"{insert} AND rowid < ?;", (low, high))
+        cursor.execute("COMMIT;")
+        low = high
+        report()
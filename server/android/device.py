@@ -1,17 +1,21 @@
-import configparser
-import glob
 import json
 import logging
 import os
 import re
 import shutil
-import time
+import sqlite3
+from threading import Lock
 
 from adb.client import Client as AdbClient
 from flask_babel import gettext as _
 
 from config import LOG_NAME, DEVICE_IP, DEVICE_PORT, MM_DB_DIR,\
-    MM_RES_DIR
+    MM_RES_DIR, SEARCH_DB_NAME, SEARCH_PAGE_SIZE, DEVICE_ROOT_TTL
+from .archive import PackArchive
+from .catalog import ProjectCatalog
+from .session import SessionCache
+from .snapshot import Snapshots
+from .store import BlobStore
 
 logger = logging.getLogger(LOG_NAME)
 
@@ -19,61 +23,120 @@ logger = logging.getLogger(LOG_NAME)
 class AndroidDevice(AdbClient):
     def __init__(self, host = DEVICE_IP, port = DEVICE_PORT):
         super().__init__(host, port)
+        self._sessions = SessionCache(self)
+        self._catalog = ProjectCatalog()
+
+    @property
+    def catalog(self):
+        return self._catalog
 
     @property
     def current_device(self):
-        return self._get_first_device()
+        return self.device()
 
-    def _save_conf_size(self, project, type, byte):
-        cf = configparser.ConfigParser()
-        file = f'data/{project}/backup.conf'
-        cf.read(file)
-        cf.set("size", type, byte)
-        cf.write(open(file, "w"))
+    def device(self, serial = None):
+        """获取在线设备
 
-    def _get_first_device(self):
+        :param serial: 序列号，为空时取第一台设备
+        :return: adb设备，设备不在线时为None
+        """
         try:
-            devices = self.devices()
-            assert len(devices) > 0
-            device = self.devices()[0]
-            return device
-        except AssertionError:
+            session = self._get_session(serial)
+            assert session
+            return session.device
+        except (AssertionError, RuntimeError, OSError):
+            return None
+
+    def device_bus(self, serial):
+        """获取设备所在的USB总线
+
+        :param serial: 序列号
+        :return: USB总线编号，非USB连接或设备不在线时为None
+        """
+        try:
+            session = self._get_session(serial)
+            assert session
+            return session.get('bus',
+                               lambda device: self._parse_bus(serial))
+        except (AssertionError, RuntimeError, OSError):
             return None
 
-    def _is_root(self):
+    def _save_size(self, project, path, byte, flush = False):
+        """记录项目目录中的备份文件大小
+
+        :param project: 项目名称
+        :param path: 文件或目录路径
+        :param byte: 字节数
+        :param flush: 是否立即写入
+        :return: 无
+        """
+        try:
+            self._catalog.set_size(project, path, byte)
+            if flush:
+                self._catalog.flush()
+        except (OSError, sqlite3.Error) as e:
+            logger.debug(f'save size of {path} failed: {e!r}')
+
+    def _get_session(self, serial = None):
+        return self._sessions.session(serial)
+
+    def _is_root(self, serial = None):
         try:
-            device = self._get_first_device()
-            assert device
-            assert device.shell("whoami").rstrip() == "root"
+            session = self._get_session(serial)
+            assert session
+            assert session.get(
+                'root',
+                lambda device: device.shell("whoami").rstrip() == "root",
+                ttl = DEVICE_ROOT_TTL)
             return True
-        except AssertionError:
+        except (AssertionError, RuntimeError, OSError):
             return False
 
-    def _is_insecure_installed(self):
+    def _is_insecure_installed(self, serial = None):
         try:
-            device = self._get_first_device()
-            assert device
-            assert device.is_installed('eu.chainfire.adbd')
+            session = self._get_session(serial)
+            assert session
+            assert session.get(
+                'insecure',
+                lambda device: device.is_installed('eu.chainfire.adbd'),
+                ttl = DEVICE_ROOT_TTL)
             return True
-        except AssertionError:
+        except (AssertionError, RuntimeError, OSError):
             return False
 
-    def _parse_serial(self):
+    def _parse_serial(self, serial = None):
         try:
-            device = self._get_first_device()
-            assert device
-            return device.serial
-        except AssertionError:
+            session = self._get_session(serial)
+            assert session
+            return session.serial
+        except (AssertionError, RuntimeError, OSError):
             return ''
 
-    def _parse_properties(self):
+    def _parse_properties(self, serial = None):
         try:
-            device = self._get_first_device()
-            assert device
-            return device.get_properties()
-        except AssertionError:
+            session = self._get_session(serial)
+            assert session
+            return session.get('properties',
+                               lambda device: device.get_properties())
+        except (AssertionError, RuntimeError, OSError):
             return ''
 
+    def _parse_bus(self, serial):
+        """从devices -l的输出中解析设备的USB总线
+
+        USB设备的连接信息形如usb:1-1.2，横线前为总线编号
+
+        :param serial: 序列号
+        :return: USB总线编号，非USB连接时为None
+        """
+        for line in self._execute_cmd('host:devices-l').splitlines():
+            fields = line.split()
+            if fields and fields[0] == serial:
+                for field in fields[2:]:
+                    if field.startswith('usb:'):
+                        return field[4:].split('-', 1)[0]
+        return None
+
     def _parse_imei(self, imei_str):
         regex = r"'([^']*)'"
         matches = re.finditer(regex, imei_str, re.MULTILINE)
@@ -93,37 +156,71 @@ class AndroidDevice(AdbClient):
         else:
             return ''
 
+    def cmd_list_devices(self, *args, **kwargs):
+        """获取在线设备列表命令
+
+        :param args:
+        :param kwargs:
+        :return: 设备列表，每项包含serial,state,bus
+        """
+        try:
+            return True, [{'serial': session.serial,
+                           'state': session.state,
+                           'bus': self.device_bus(session.serial)}
+                          for session in self._sessions.sessions()], None
+        except (RuntimeError, OSError):
+            return False, [], _('Failed to list devices')
+
     def cmd_check_device(self, *args, **kwargs):
-        return True, self._parse_serial(), None
+        return True, self._parse_serial(kwargs.get('serial', None)), None
 
     def cmd_check_root(self, *args, **kwargs):
-        return True, self._is_root(), None
+        return True, self._is_root(kwargs.get('serial', None)), None
 
     def cmd_check_insecure(self, *args, **kwargs):
-        return True, self._is_insecure_installed(), None
+        return True, self._is_insecure_installed(
+            kwargs.get('serial', None)), None
 
     def cmd_install_insecure(self, *args, **kwargs):
         from adb import InstallError
         try:
-            device = self._get_first_device()
-            assert device
-            if self._is_insecure_installed():
-                assert device.install('resource/adbd-Insecure2.0.apk',
-                                      reinstall = True)
+            session = self._get_session(kwargs.get('serial', None))
+            assert session
+            if self._is_insecure_installed(session.serial):
+                assert session.device.install(
+                    'resource/adbd-Insecure2.0.apk', reinstall = True)
             else:
-                assert device.install('resource/adbd-Insecure2.0.apk')
+                assert session.device.install(
+                    'resource/adbd-Insecure2.0.apk')
+            session.invalidate('insecure')
             return True, True, _(
                 'ADB Insecure has been installed successfully')
         except (AssertionError, InstallError, FileNotFoundError):
             return False, False, _('ADB Insecure installation failed')
 
+    def key_sources(self, serial = None):
+        """获取计算数据库密码所需的IMEI和UIN
+
+        :param serial: 序列号
+        :return: (IMEI列表, UIN列表)，取不到时为空列表
+        """
+        try:
+            _, imeis, _ = self.cmd_get_imei(serial = serial)
+            _, uin, _ = self.cmd_get_uin(serial = serial)
+            return imeis, [uin] if uin else []
+        except (RuntimeError, OSError) as e:
+            logger.debug(f'get key sources failed: {e!r}')
+            return [], []
+
     def cmd_get_device_properties(self, *args, **kwargs):
-        return True, self._parse_properties(), None
+        return True, self._parse_properties(kwargs.get('serial', None)),\
+            None
 
     def cmd_get_users(self, *args, **kwargs):
         try:
-            assert self._is_root()
-            device = self._get_first_device()
+            serial = kwargs.get('serial', None)
+            assert self._is_root(serial)
+            device = self.device(serial)
             users = [f for f in
                      device.shell(f'ls {MM_RES_DIR}').split('\r\n') if
                      len(f) == 32]
@@ -142,9 +239,11 @@ class AndroidDevice(AdbClient):
 
     def cmd_get_imei(self, *args, **kwargs):
         try:
-            assert self._is_root()
-            device = self._get_first_device()
-            imei = device.shell(f'service call iphonesubinfo 1')
+            serial = kwargs.get('serial', None)
+            assert self._is_root(serial)
+            imei = self._get_session(serial).get(
+                'imei',
+                lambda device: device.shell('service call iphonesubinfo 1'))
             assert imei
             imei = self._parse_imei(imei)
             return True, imei,\
@@ -154,10 +253,12 @@ class AndroidDevice(AdbClient):
 
     def cmd_get_uin(self, *args, **kwargs):
         try:
-            assert self._is_root()
-            device = self._get_first_device()
-            uin = device.shell(
-                f'cat {MM_DB_DIR}/shared_prefs/system_config_prefs.xml')
+            serial = kwargs.get('serial', None)
+            assert self._is_root(serial)
+            uin = self._get_session(serial).get(
+                'uin',
+                lambda device: device.shell(
+                    f'cat {MM_DB_DIR}/shared_prefs/system_config_prefs.xml'))
             assert uin
             uin = self._parse_uin(uin)
             return True, uin,\
@@ -170,18 +271,36 @@ class AndroidDevice(AdbClient):
         type = kwargs['type']
         path = kwargs['path']
         try:
-            if os.path.exists(path):
+            if type == 'Re' and os.path.exists(
+                    f'{path}/{PackArchive.INDEX_NAME}'):
+                # 归档只删除索引中的成员，再删除不再被引用的包文件
+                archive = PackArchive(path)
+                try:
+                    archive.remove('')
+                    archive.prune()
+                finally:
+                    archive.close()
+            elif os.path.exists(path):
                 if os.path.isdir(path):
                     shutil.rmtree(path)
                 else:
                     os.remove(path)
+            self._catalog.remove(taskname, path)
+            if type == 'De':
+                index = f'data/{taskname}/{SEARCH_DB_NAME}.db'
+                if os.path.exists(index):
+                    os.remove(index)
             if type == 'Re':
-                self._save_conf_size(taskname, 'resource', '0')
+                manifest = f'data/{taskname}/manifest.json'
+                if os.path.exists(manifest):
+                    os.remove(manifest)
+                # 删除不再被任何项目引用的存储内容
+                BlobStore().prune()
             return True, {'projectName': taskname,
                           'type': type,
                           'success': True}, _(
                 '{} was deleted').format(path)
-        except OSError as e:
+        except (OSError, sqlite3.Error) as e:
             return False, {'projectName': taskname,
                            'type': type,
                            'success': False}, _(
@@ -203,32 +322,18 @@ class AndroidDevice(AdbClient):
     def cmd_get_exist_projects(self, *args, **kwargs):
         """获取已存在项目命令
 
+        从项目目录中读取，不遍历data目录
+
         :param args:
-        :param kwargs:
+        :param kwargs: 包含[refresh]键值对，为真时先按data目录重建目录
         :return: 获取结果
         """
-
-        def folder_size(path):
-            import subprocess
-            return int(
-                subprocess.check_output(['du', '-sk', path]).split()[
-                    0].decode('utf-8')) * 1024
-
-        projects = {}
-        cf = configparser.ConfigParser()
-        for conf in glob.glob(f'data/*/backup.conf'):
-            cf.read(conf)
-            name = cf.get('project', 'name')
-            projects[name] = {
-                'user': cf.get('project', "user"),
-                'password': cf.get('project', 'password'),
-                'files': [(f, os.stat(f).st_size) for f in
-                          glob.glob(f'data/{name}/??MicroMsg.db')] + [
-                             (f, int(cf.get('size', 'resource'))) for f
-                             in
-                             glob.glob(f'data/{name}/Resource')]
-            }
-        return True, json.dumps(projects), None
+        try:
+            if kwargs.get('refresh'):
+                self._catalog.rebuild()
+            return True, json.dumps(self._catalog.projects()), None
+        except (OSError, sqlite3.Error):
+            return False, None, _('Failed to read projects')
 
     def cmd_create_project(self, *args, **kwargs):
         """创建备份项目命令
@@ -239,20 +344,107 @@ class AndroidDevice(AdbClient):
         """
         try:
             name = args[0]
-            if not os.path.exists(f'data/{name}'):
-                os.makedirs(f'data/{name}')
-            cf = configparser.ConfigParser()
-            cf.add_section("project")
-            cf.set("project", "name", name)
-            cf.set("project", "user", kwargs["user"])
-            cf.set("project", "password", kwargs["password"])
-            cf.add_section("size")
-            cf.set("size", "resource", "0")
-            cf.write(open(f'data/{name}/backup.conf', "w"))
+            self._catalog.create(name, kwargs["user"], kwargs["password"])
             return True, name, _('Project create...')
-        except OSError as e:
+        except (OSError, sqlite3.Error) as e:
             return False, None, _('Failed to create project')
 
+    def cmd_search_messages(self, *args, **kwargs):
+        """检索消息命令
+
+        在项目解密时建立的全文索引中分页检索消息
+
+        :param args: 包含项目名称
+        :param kwargs: 包含keyword,[talker],[page],[page_size]键值对
+        :return: 检索结果，包含total,page,page_size,items
+        """
+        from .search import search
+
+        name = args[0]
+        index = f'data/{name}/{SEARCH_DB_NAME}.db'
+        try:
+            assert kwargs.get('keyword', None)
+            assert os.path.exists(index)
+            result = search(index, kwargs['keyword'],
+                            talker = kwargs.get('talker', None),
+                            page = kwargs.get('page', 1),
+                            page_size = kwargs.get('page_size',
+                                                   SEARCH_PAGE_SIZE))
+            return True, result, _('{} messages have been found').format(
+                result['total'])
+        except (AssertionError, ValueError, sqlite3.Error):
+            return False, None, _('Search index is not available')
+
+    def cmd_list_snapshots(self, *args, **kwargs):
+        """获取数据库快照列表命令
+
+        :param args: 包含项目名称
+        :param kwargs:
+        :return: 快照列表，每项包含name,src_byte,src_mtime
+        """
+        name = args[0]
+        try:
+            snapshots = Snapshots(f'data/{name}/snapshots')
+            result = []
+            for snapshot in snapshots.names():
+                data = snapshots.load(snapshot)
+                result.append({'name': snapshot,
+                               'src_byte': data['src_byte'],
+                               'src_mtime': data['src_mtime']})
+            return True, result, None
+        except (OSError, ValueError, KeyError, AssertionError):
+            return False, [], _('Failed to read snapshots')
+
+    def cmd_restore_snapshot(self, *args, **kwargs):
+        """还原数据库快照命令
+
+        把快照拼出的数据库保存为项目目录下的snapshots/<快照名称>.db
+
+        :param args: 包含项目名称
+        :param kwargs: 包含snapshot键值对
+        :return: 还原结果，为还原出的文件路径
+        """
+        name = args[0]
+        try:
+            snapshot = kwargs['snapshot']
+            snapshots = Snapshots(f'data/{name}/snapshots')
+            assert snapshot in snapshots.names()
+            dest = f'data/{name}/snapshots/{snapshot}.db'
+            snapshots.restore(snapshot, dest)
+            return True, dest, _('Snapshot {} has been restored').format(
+                snapshot)
+        except (OSError, ValueError, KeyError, AssertionError):
+            return False, None, _('Failed to restore snapshot')
+
+    def cmd_list_resources(self, *args, **kwargs):
+        """列出归档资源命令
+
+        只查询归档索引，不遍历文件
+
+        :param args: 包含项目名称
+        :param kwargs: 包含[prefix],[limit],[offset]键值对
+        :return: 列出结果，包含total,byte,items
+        """
+        name = args[0]
+        root = f'data/{name}/Resource.pack'
+        try:
+            assert os.path.exists(f'{root}/{PackArchive.INDEX_NAME}')
+            archive = PackArchive(root)
+            try:
+                prefix = kwargs.get('prefix', '')
+                total, byte = archive.stat(prefix)
+                items = [{'path': path, 'size': size, 'mtime': mtime}
+                         for path, size, mtime in archive.list(
+                             prefix, int(kwargs.get('limit', 100)),
+                             int(kwargs.get('offset', 0)))]
+            finally:
+                archive.close()
+            return True, {'total': total,
+                          'byte': byte,
+                          'items': items}, None
+        except (AssertionError, ValueError, OSError, sqlite3.Error):
+            return False, None, _('Resource archive is not available')
+
     def cmd_check_db_size(self, *args, **kwargs):
         """检查数据库拉取命令
 
@@ -263,7 +455,13 @@ class AndroidDevice(AdbClient):
         :return: 检查结果
         """
         progress = kwargs['progress']
-        return True, progress(), None
+        data = progress()
+        if not data:
+            return False, None, _('Failed to check database size')
+        if data['progress'] == 1:
+            self._save_size(data['projectName'], data['path'],
+                            data['dest_byte'], flush = True)
+        return True, data, None
 
     def alive_check_db_size(self, *args, **kwargs):
         """检查数据库拉取存活状态
@@ -274,8 +472,7 @@ class AndroidDevice(AdbClient):
         """
         progress = kwargs['progress']
         data = progress()
-        if data['progress'] == 1:
-            time.sleep(kwargs["interval"])
+        if not data or data['progress'] == 1 or data['progress'] < 0:
             return False
         else:
             return True
@@ -290,7 +487,11 @@ class AndroidDevice(AdbClient):
         :return: 检查结果
         """
         progress = kwargs['progress']
-        return True, progress(), None
+        data = progress()
+        if data['progress'] == 1:
+            self._save_size(data['projectName'], data['path'],
+                            data['byte'], flush = True)
+        return True, data, None
 
     def alive_check_decrypt_progress(self, *args, **kwargs):
         """检查数据库解密存活状态
@@ -301,8 +502,7 @@ class AndroidDevice(AdbClient):
         """
         progress = kwargs['progress']
         data = progress()
-        if data['progress'] == 1:
-            time.sleep(kwargs["interval"])
+        if data['progress'] == 1 or data['progress'] < 0:
             return False
         else:
             return True
@@ -318,8 +518,10 @@ class AndroidDevice(AdbClient):
         """
         progress = kwargs['progress']
         data = progress()
-        self._save_conf_size(data['projectName'], 'resource',
-                             str(data['current'] * 1024))
+        if data['path']:
+            self._save_size(data['projectName'], data['path'],
+                            data['current'] * 1024,
+                            flush = data['progress'] == 1)
         return True, data, None
 
     def alive_check_resource_progress(self, *args, **kwargs):
@@ -331,11 +533,54 @@ class AndroidDevice(AdbClient):
         """
         progress = kwargs['progress']
         data = progress()
-        if data['progress'] == 1:
-            time.sleep(kwargs["interval"])
+        if data['progress'] == 1 or data['progress'] < 0:
+            return False
+        else:
+            return True
+
+    def cmd_check_export_progress(self, *args, **kwargs):
+        """检查消息导出进度命令
+
+        用于导出消息时检查进度
+
+        :param args:
+        :param kwargs: 包含progress为检查进度的方法
+        :return: 检查结果
+        """
+        progress = kwargs['progress']
+        return True, progress(), None
+
+    def alive_check_export_progress(self, *args, **kwargs):
+        """检查消息导出存活状态
+
+        :param args:
+        :param kwargs: 包含progress为检查进度的方法
+        :return: 是否存活
+        """
+        progress = kwargs['progress']
+        data = progress()
+        if data['progress'] == 1 or data['progress'] < 0:
             return False
         else:
             return True
 
 
-_client = AndroidDevice()
+_client_lock = Lock()
+
+
+def __getattr__(name):
+    """首次访问_client时才创建共用的客户端
+
+    进程池的工作进程反序列化作业时会导入本模块，只有服务进程需要客户端
+    及其设备会话监听线程和项目目录
+
+    :param name: 属性名
+    :return: 客户端
+    """
+    if name != '_client':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with _client_lock:
+        if '_client' not in globals():
+            globals()['_client'] = AndroidDevice()
+            logger.debug('android client created')
+        return globals()['_client']
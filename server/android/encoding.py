@@ -0,0 +1,165 @@
+import gzip
+import json
+import logging
+import lzma
+import os
+import time
+from threading import Lock
+
+from config import LOG_NAME, RES_ENCODING_SAMPLE_BYTE,\
+    RES_ENCODING_SAMPLE_FILES, RES_ENCODING_FILE, RES_ENCODING_TTL
+from .transfer import exec_out, push_lines
+
+logger = logging.getLogger(LOG_NAME)
+
+# 编码 -> 设备上的压缩命令，为空时不压缩
+ENCODINGS = {
+    'none': None,
+    'gzip-fast': 'busybox gzip -1',
+    'gzip': 'busybox gzip',
+    'gzip-strong': 'busybox gzip -9',
+    'xz': 'xz -6',
+}
+# 未协商时使用的编码，与原来的tar czf相同
+DEFAULT_ENCODING = 'gzip'
+
+_DECOMPRESS = {'none': bytes, 'gzip': gzip.decompress,
+               'xz': lzma.decompress}
+
+_records_lock = Lock()
+
+
+def _compress(cmd, encoding):
+    compress = ENCODINGS[encoding]
+    return f'{cmd} | {compress} 2>/dev/null' if compress else cmd
+
+
+def tar_command(cwd, file_list, encoding):
+    """生成在设备上打包文件列表并按编码压缩的命令
+
+    :param cwd: 工作目录，文件列表中为相对此目录的路径
+    :param file_list: 设备上的文件列表路径
+    :param encoding: 编码
+    :return: 命令
+    """
+    return _compress(f'cd {cwd} && busybox tar cf - -T {file_list} '
+                     f'2>/dev/null', encoding)
+
+
+def probe_encodings(device):
+    """检查设备上可用的压缩工具
+
+    :param device: adb设备
+    :return: 可用的编码列表
+    """
+    output = device.shell('; '.join(
+        f'echo | {cmd} >/dev/null 2>&1 && echo {name}'
+        for name, cmd in ENCODINGS.items() if cmd))
+    available = set(output.split())
+    return [name for name, cmd in ENCODINGS.items()
+            if cmd is None or name in available]
+
+
+def negotiate(device, cwd, paths, encodings,
+              sample_byte = RES_ENCODING_SAMPLE_BYTE,
+              sample_files = RES_ENCODING_SAMPLE_FILES, cancel = None):
+    """按样本实测各编码的端到端速率
+
+    从文件中均匀抽取样本，每个文件只取开头一段。各编码分别在设备上
+    压缩样本、传回并在本地解压，按原始字节数除以总耗时得到速率，速率
+    同时反映设备压缩、链路传输和本地解压的开销
+
+    :param device: adb设备
+    :param cwd: 工作目录，paths为相对此目录的路径
+    :param paths: 文件路径列表
+    :param encodings: 参与比较的编码
+    :param sample_byte: 样本字节数
+    :param sample_files: 样本文件数
+    :param cancel: 取消令牌
+    :return: (速率最高的编码, {编码: {'rate': 字节/秒, 'ratio': 压缩率}})，
+    样本为空时编码为None
+    """
+    stride = max(1, len(paths) // sample_files)
+    sample = paths[::stride][:sample_files]
+    if not sample:
+        return None, {}
+    file_list = push_lines(device, sample)
+    cmd = f'cd {cwd} && while read -r f; do busybox head -c '\
+          f'{max(1, sample_byte // len(sample))} "$f"; '\
+          f'done < {file_list} 2>/dev/null'
+    rates = {}
+    try:
+        # 先读一遍样本，避免第一个编码承担冷缓存的开销
+        device.shell(f'{cmd} >/dev/null')
+        for encoding in encodings:
+            start = time.perf_counter()
+            with exec_out(device, _compress(cmd, encoding),
+                          cancel = cancel) as stream:
+                data = stream.read()
+            raw = _DECOMPRESS[encoding.split('-')[0]](data)
+            seconds = time.perf_counter() - start
+            if not raw:
+                return None, {}
+            rates[encoding] = {'rate': len(raw) / seconds,
+                               'ratio': len(data) / len(raw)}
+    finally:
+        device.shell(f'rm -f {file_list}')
+    best = max(rates, key = lambda encoding: rates[encoding]['rate'])
+    return best, rates
+
+
+class EncodingRecords:
+    """协商记录
+
+    按设备和资源目录记录协商出的编码，保存在本地文件中，有效期内的
+    记录直接复用，不再抽样
+    """
+
+    def __init__(self, file = RES_ENCODING_FILE, ttl = RES_ENCODING_TTL):
+        """
+        :param file: 记录文件
+        :param ttl: 记录的有效秒数
+        """
+        self._file = file
+        self._ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self._file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, serial, folder):
+        """
+        :param serial: 设备序列号
+        :param folder: 资源目录
+        :return: 有效期内的编码，没有时为None
+        """
+        with _records_lock:
+            record = self._load().get(serial, {}).get(folder)
+        if not record or record.get('encoding') not in ENCODINGS or\
+                time.time() - record.get('time', 0) > self._ttl:
+            return None
+        return record['encoding']
+
+    def put(self, serial, folder, encoding, rates):
+        """记录协商结果
+
+        :param serial: 设备序列号
+        :param folder: 资源目录
+        :param encoding: 编码
+        :param rates: 各编码的实测结果
+        :return: 无
+        """
+        with _records_lock:
+            records = self._load()
+            records.setdefault(serial, {})[folder] = {
+                'encoding': encoding, 'rates': rates,
+                'time': int(time.time())}
+            os.makedirs(os.path.dirname(self._file) or '.',
+                        exist_ok = True)
+            temp = f'{self._file}.tmp'
+            with open(temp, 'w') as f:
+                json.dump(records, f, indent = 2)
+            os.replace(temp, self._file)
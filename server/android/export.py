@@ -0,0 +1,338 @@
+import csv
+import html
+import json
+import logging
+import os
+import shutil
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from functools import lru_cache
+
+from config import LOG_NAME, EXPORT_BATCH_ROWS, EXPORT_HTML_PAGE_ROWS,\
+    EXPORT_CONTACT_CACHE, TASK_CANCEL_CHECK_OPS
+from .pool import JobCancelled, interrupt_handler
+
+logger = logging.getLogger(LOG_NAME)
+
+FORMATS = ('jsonl', 'csv', 'html')
+TABLES = ('message', 'rcontact', 'chatroom')
+
+# 各表导出的列，数据库中不存在的列跳过
+COLUMNS = {
+    'message': ('msgId', 'msgSvrId', 'type', 'isSend', 'createTime',
+                'talker', 'content', 'imgPath'),
+    'rcontact': ('username', 'alias', 'conRemark', 'nickname', 'type'),
+    'chatroom': ('chatroomname', 'displayname', 'roomowner',
+                 'memberlist'),
+}
+# 消息记录追加的字段
+MESSAGE_FIELDS = ('time', 'talkerName', 'sender', 'senderName')
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in
+            conn.execute(f"PRAGMA table_info({table});")]
+
+
+def iter_rows(conn, sql, args = (), batch_rows = EXPORT_BATCH_ROWS):
+    """逐批读取查询结果
+
+    :param conn: 数据库连接
+    :param sql: 查询语句
+    :param args: 查询参数
+    :param batch_rows: 每批读取的行数
+    :return: 以列名为键的字典生成器
+    """
+    cursor = conn.execute(sql, args)
+    columns = [column[0] for column in cursor.description]
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(zip(columns, row))
+    finally:
+        cursor.close()
+
+
+def iter_messages(conn, by_talker = False, batch_rows = EXPORT_BATCH_ROWS,
+                  cache_size = EXPORT_CONTACT_CACHE):
+    """逐条读取消息并关联联系人
+
+    会话名称在查询中按主键关联rcontact表，群聊中发送者的名称按需逐个
+    查询，只在有界的缓存中保留最近用到的联系人
+
+    :param conn: 数据库连接
+    :param by_talker: 按会话和时间排序，否则按msgId排序
+    :param batch_rows: 每批读取的行数
+    :param cache_size: 联系人缓存的条数
+    :return: 消息记录生成器
+    """
+    available = _table_columns(conn, 'message')
+    columns = [column for column in COLUMNS['message']
+               if column in available]
+    has_contact = bool(_table_columns(conn, 'rcontact'))
+    select = ', '.join(f'm.{column}' for column in columns)
+    if has_contact:
+        select = f"{select}, coalesce(nullif(c.conRemark, ''), "\
+                 f"c.nickname, '') AS talkerName"
+        join = "LEFT JOIN rcontact c ON c.username = m.talker"
+    else:
+        select = f"{select}, '' AS talkerName"
+        join = ""
+    order = "m.talker, m.createTime, m.msgId" if by_talker else "m.msgId"
+
+    @lru_cache(maxsize = cache_size)
+    def contact_name(username):
+        if not has_contact:
+            return ''
+        row = conn.execute("SELECT coalesce(nullif(conRemark, ''), "
+                           "nickname, '') FROM rcontact "
+                           "WHERE username = ?;", (username,)).fetchone()
+        return row[0] if row else ''
+
+    for row in iter_rows(conn, f"SELECT {select} FROM message m {join} "
+                               f"ORDER BY {order};",
+                         batch_rows = batch_rows):
+        talker = row.get('talker') or ''
+        content = row.get('content') or ''
+        if row.get('isSend'):
+            sender = ''
+        elif talker.endswith('@chatroom'):
+            # 群聊消息的内容以"发送者:\n"开头
+            sender, separator, rest = content.partition(':\n')
+            if separator and ' ' not in sender:
+                content = rest
+            else:
+                sender = ''
+        else:
+            sender = talker
+        created = row.get('createTime')
+        row.update({
+            'content': content,
+            'time': datetime.fromtimestamp(created / 1000).isoformat(
+                sep = ' ', timespec = 'seconds') if created else '',
+            'sender': sender,
+            'senderName': contact_name(sender) if sender else ''})
+        yield row
+
+
+class _Writer:
+    """导出文件写入器，按表依次写入"""
+
+    def __init__(self, root):
+        self._root = root
+        self._file = None
+
+    def begin(self, table, fields):
+        pass
+
+    def write(self, record):
+        pass
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlWriter(_Writer):
+    """每张表一个JSON Lines文件"""
+
+    def begin(self, table, fields):
+        self._file = open(f'{self._root}/{table}.jsonl', 'w',
+                          encoding = 'utf-8')
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii = False) + '\n')
+
+    def end(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class CsvWriter(_Writer):
+    """每张表一个CSV文件，带BOM以便表格软件识别编码"""
+
+    def begin(self, table, fields):
+        self._file = open(f'{self._root}/{table}.csv', 'w',
+                          encoding = 'utf-8-sig', newline = '')
+        self._writer = csv.DictWriter(self._file, fields,
+                                      extrasaction = 'ignore')
+        self._writer.writeheader()
+
+    def write(self, record):
+        self._writer.writerow(record)
+
+    def end(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class HtmlWriter(_Writer):
+    """分页的静态HTML
+
+    每页不超过page_rows行，消息按会话分页，index.html列出所有页。
+    内存中只保留页的目录
+    """
+
+    _HEAD = '<!DOCTYPE html><html><head><meta charset="utf-8">'\
+            '<title>{title}</title><style>body{{font-family:sans-serif}}'\
+            'table{{border-collapse:collapse}}td,th{{border:1px solid '\
+            '#ccc;padding:2px 6px;vertical-align:top;white-space:'\
+            'pre-wrap}}</style></head><body><p><a href="../index.html">'\
+            'index</a></p><h2>{title}</h2><table>'
+
+    def __init__(self, root, page_rows = EXPORT_HTML_PAGE_ROWS):
+        super().__init__(root)
+        self._page_rows = page_rows
+        self._pages = []  # (表, 标题, 相对路径)
+
+    def begin(self, table, fields):
+        os.makedirs(f'{self._root}/{table}', exist_ok = True)
+        self._table = table
+        self._fields = fields
+        self._page = 0
+        self._rows = 0
+        self._group = None
+
+    def _title(self, record):
+        if self._table != 'message':
+            return self._table
+        return record['talkerName'] or record['talker'] or ''
+
+    def write(self, record):
+        group = record.get('talker') if self._table == 'message' else None
+        if self._file is None or self._rows >= self._page_rows or\
+                group != self._group:
+            self._close_page()
+            self._page = self._page + 1
+            self._rows = 0
+            self._group = group
+            path = f'{self._table}/{self._page:05d}.html'
+            title = self._title(record)
+            self._pages.append((self._table, title, path))
+            self._file = open(f'{self._root}/{path}', 'w',
+                              encoding = 'utf-8')
+            self._file.write(self._HEAD.format(title = html.escape(title)))
+            self._file.write('<tr>' + ''.join(
+                f'<th>{html.escape(field)}</th>'
+                for field in self._fields) + '</tr>\n')
+        self._file.write('<tr>' + ''.join(
+            f'<td>{html.escape(self._cell(record.get(field)))}</td>'
+            for field in self._fields) + '</tr>\n')
+        self._rows = self._rows + 1
+
+    @staticmethod
+    def _cell(value):
+        # 0等假值照常输出，只有空值输出为空
+        return '' if value is None else str(value)
+
+    def _close_page(self):
+        if self._file:
+            self._file.write('</table></body></html>\n')
+            self._file.close()
+            self._file = None
+
+    def end(self):
+        self._close_page()
+
+    def close(self):
+        with open(f'{self._root}/index.html', 'w', encoding = 'utf-8') as f:
+            f.write('<!DOCTYPE html><html><head><meta charset="utf-8">'
+                    '<title>index</title></head><body>\n')
+            table = None
+            for page_table, title, path in self._pages:
+                if page_table != table:
+                    if table:
+                        f.write('</ol>\n')
+                    table = page_table
+                    f.write(f'<h2>{html.escape(table)}</h2><ol>\n')
+                f.write(f'<li><a href="{path}">{html.escape(title)}</a>'
+                        f'</li>\n')
+            if table:
+                f.write('</ol>\n')
+            f.write('</body></html>\n')
+
+
+_WRITERS = {'jsonl': JsonlWriter, 'csv': CsvWriter, 'html': HtmlWriter}
+
+
+def export_messages(src, dest, fmt, tables = TABLES,
+                    batch_rows = EXPORT_BATCH_ROWS, progress = None,
+                    cancelled = None):
+    """流式导出解密后的数据库
+
+    各表按批读取、逐条写出，内存占用与数据库大小无关。导出先写入临时
+    目录，完成后替换原有的导出
+
+    :param src: 解密后的数据库路径
+    :param dest: 导出目录
+    :param fmt: 格式，jsonl、csv或html
+    :param tables: 导出的表，不存在的表跳过
+    :param batch_rows: 每批读取的行数
+    :param progress: 进度回调，参数为(已导出行数, 总行数)
+    :param cancelled: 返回是否已取消的方法
+    :return: 导出的行数
+    """
+    temp = f'{dest}.tmp'
+    shutil.rmtree(temp, ignore_errors = True)
+    os.makedirs(temp)
+    conn = sqlite3.connect(f'file:{src}?mode=ro', uri = True)
+    # 按会话排序时由SQLite在临时文件中排序
+    conn.execute("PRAGMA temp_store = FILE;")
+    if cancelled:
+        conn.set_progress_handler(interrupt_handler(cancelled),
+                                  TASK_CANCEL_CHECK_OPS)
+    writer = _WRITERS[fmt](temp)
+    try:
+        tables = [table for table in tables
+                  if _table_columns(conn, table)]
+        total = sum(conn.execute(f"SELECT count(*) FROM {table};")
+                    .fetchone()[0] for table in tables)
+        done = 0
+        for table in tables:
+            if table == 'message':
+                fields = [column for column in COLUMNS[table]
+                          if column in _table_columns(conn, table)]
+                fields = fields + list(MESSAGE_FIELDS)
+                records = iter_messages(conn, by_talker = fmt == 'html',
+                                        batch_rows = batch_rows)
+            else:
+                fields = [column for column in COLUMNS[table]
+                          if column in _table_columns(conn, table)]
+                records = iter_rows(conn, f"SELECT {', '.join(fields)} "
+                                          f"FROM {table} ORDER BY rowid;",
+                                    batch_rows = batch_rows)
+            writer.begin(table, fields)
+            # 取消时先关闭游标，再关闭连接
+            with closing(records):
+                for record in records:
+                    writer.write(record)
+                    done = done + 1
+                    if done % batch_rows == 0:
+                        if cancelled and cancelled():
+                            raise JobCancelled()
+                        if progress:
+                            progress(done, total)
+            writer.end()
+        writer.close()
+    except Exception as e:
+        writer.end()
+        shutil.rmtree(temp, ignore_errors = True)
+        if cancelled and cancelled() and not isinstance(e, JobCancelled):
+            raise JobCancelled() from e
+        raise
+    finally:
+        conn.close()
+    shutil.rmtree(dest, ignore_errors = True)
+    os.replace(temp, dest)
+    if progress:
+        progress(total, total)
+    logger.debug(f'export {src} to {dest}: {done} rows')
+    return done
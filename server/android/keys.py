@@ -0,0 +1,108 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import LOG_NAME, DECRYPT_KEY_WORKERS, DECRYPT_FALLBACK_IMEI
+from .decrypt import CIPHERS, open_encrypted, sqlite
+
+logger = logging.getLogger(LOG_NAME)
+
+
+def derive_password(imei, uin):
+    """按微信的规则由IMEI和UIN计算数据库密码
+
+    :param imei: IMEI
+    :param uin: UIN
+    :return: 密码，即md5(imei + uin)的前7位
+    """
+    return hashlib.md5(f'{imei}{uin}'.encode('utf-8')).hexdigest()[:7]
+
+
+def _uin_variants(uin):
+    """UIN可能按有符号或无符号的32位整数保存，两种写法都要尝试"""
+    uin = str(uin).strip()
+    variants = [uin]
+    try:
+        value = int(uin)
+    except ValueError:
+        return variants
+    if value < 0:
+        variants.append(str(value + 2 ** 32))
+    elif value >= 2 ** 31:
+        variants.append(str(value - 2 ** 32))
+    return variants
+
+
+def candidate_passwords(imeis, uins, passwords = ()):
+    """生成候选密码
+
+    双卡设备有多个IMEI，取不到IMEI时微信使用固定的替代值，
+    各IMEI与UIN的每种写法组合出候选密码
+
+    :param imeis: IMEI列表
+    :param uins: UIN列表
+    :param passwords: 已知的密码，排在最前面
+    :return: 去重后的候选密码列表
+    """
+    candidates = [password for password in passwords if password]
+    for imei in [imei.strip() for imei in imeis if imei and imei.strip()]\
+            + list(DECRYPT_FALLBACK_IMEI):
+        for uin in uins:
+            if str(uin).strip():
+                candidates.extend(derive_password(imei, variant)
+                                  for variant in _uin_variants(uin))
+    return list(dict.fromkeys(candidates))
+
+
+def check_password(path, password, cipher = 'legacy'):
+    """检查密码能否按加密格式打开加密数据库
+
+    只做一次密钥派生并读取数据库的首页和表结构，密码错误时SQLCipher
+    无法解出首页，旧版格式通常只需几毫秒
+
+    :param path: 加密数据库路径
+    :param password: 密码
+    :param cipher: 加密格式
+    :return: 是否正确
+    """
+    if sqlite is None:
+        raise ImportError('pysqlcipher3 is not installed')
+    try:
+        conn = open_encrypted(path, password, cache_size = 16,
+                              cipher = cipher)
+    except sqlite.Error:
+        return False
+    try:
+        conn.execute("SELECT count(*) FROM sqlite_master;").fetchone()
+        return True
+    except sqlite.DatabaseError:
+        return False
+    finally:
+        conn.close()
+
+
+def find_password(path, candidates, workers = DECRYPT_KEY_WORKERS):
+    """并行检查候选密码
+
+    先按旧版格式检查，都不正确时再按SQLCipher 4格式检查，后者用于
+    migrate模式已迁移过的数据库，密钥派生的开销大得多
+
+    :param path: 加密数据库路径
+    :param candidates: 候选密码列表
+    :param workers: 线程数
+    :return: (排在最前的正确密码, 加密格式)，都不正确时为(None, None)
+    """
+    if not candidates:
+        return None, None
+    with ThreadPoolExecutor(max_workers = min(workers, len(candidates)),
+                            thread_name_prefix = 'key') as executor:
+        for cipher in CIPHERS:
+            results = list(executor.map(
+                lambda password: check_password(path, password, cipher),
+                candidates))
+            logger.debug(f'key trial ({cipher}): '
+                         f'{sum(results)}/{len(candidates)} valid')
+            for password, valid in zip(candidates, results):
+                if valid:
+                    return password, cipher
+    return None, None
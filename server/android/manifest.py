@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+
+from config import LOG_NAME
+from .transfer import exec_out
+
+logger = logging.getLogger(LOG_NAME)
+
+
+class Manifest:
+    """资源清单
+
+    记录资源文件相对于用户资源目录的路径、大小和修改时间，
+    用于比较设备与本地的差异，只拉取新增或变化的文件
+    """
+
+    VERSION = 1
+
+    def __init__(self, entries = None):
+        self._entries = dict(entries) if entries else {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def get(self, path, default = None):
+        return self._entries.get(path, default)
+
+    def items(self):
+        return self._entries.items()
+
+    def total_byte(self):
+        return sum(size for size, mtime in self._entries.values())
+
+    def update(self, path, size, mtime):
+        self._entries[path] = (size, mtime)
+
+    def remove(self, path):
+        self._entries.pop(path, None)
+
+    def diff(self, other):
+        """比较清单差异
+
+        :param other: 新的清单(通常为设备清单)
+        :return: other中新增或大小、修改时间有变化的路径列表
+        """
+        return [path for path, entry in other.items()
+                if self._entries.get(path) != entry]
+
+    @classmethod
+    def load(cls, file):
+        """从本地文件读取清单，文件不存在或损坏时返回空清单
+
+        :param file: 清单文件
+        :return: 清单
+        """
+        try:
+            with open(file, 'r') as f:
+                data = json.load(f)
+            assert data.get('version') == cls.VERSION
+            return cls({path: tuple(entry)
+                        for path, entry in data['files'].items()})
+        except (OSError, ValueError, KeyError, AssertionError):
+            return cls()
+
+    def save(self, file):
+        """写入本地文件，先写临时文件再替换以免中断时损坏清单
+
+        :param file: 清单文件
+        :return: 无
+        """
+        temp = f'{file}.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'files': self._entries}, f)
+        os.replace(temp, file)
+
+    @staticmethod
+    def parse_line(line):
+        """解析stat输出的一行
+
+        :param line: 格式为"大小 修改时间 路径"
+        :return: (路径, 大小, 修改时间)，无法解析时返回None
+        """
+        try:
+            size, mtime, path = line.strip('\r\n').split(' ', 2)
+            return path, int(size), int(mtime)
+        except ValueError:
+            return None
+
+
+class Inventory:
+    """设备资源清单索引
+
+    一次遍历设备上所有资源目录，以流的方式逐行读取文件的大小和修改时间，
+    按目录建立清单并汇总大小和文件数，供计数、拉取、进度和剩余时间共用
+    """
+
+    def __init__(self, folders):
+        self._folders = {folder: Manifest() for folder in folders}
+        self._folder_byte = {folder: 0 for folder in folders}
+
+    def __getitem__(self, folder):
+        return self._folders[folder]
+
+    def add(self, path, size, mtime):
+        folder = path.split('/', 1)[0]
+        if folder in self._folders:
+            self._folders[folder].update(path, size, mtime)
+            self._folder_byte[folder] = self._folder_byte[folder] + size
+
+    def folder_byte(self, folder):
+        return self._folder_byte[folder]
+
+    def total_byte(self):
+        return sum(self._folder_byte.values())
+
+    def total_files(self):
+        return sum(len(manifest) for manifest in self._folders.values())
+
+    @classmethod
+    def scan(cls, device, src_path, folders, cancel = None):
+        """遍历设备上的资源目录
+
+        :param device: adb设备
+        :param src_path: 用户资源目录
+        :param folders: 资源目录名列表
+        :param cancel: 取消令牌
+        :return: 清单索引
+        """
+        inventory = cls(folders)
+        with exec_out(device,
+                      f"cd {src_path} && busybox find "
+                      f"{' '.join(folders)} -type f -exec busybox stat "
+                      f"-c '%s %Y %n' {{}} + 2>/dev/null",
+                      cancel = cancel) as stream:
+            for line in stream:
+                entry = Manifest.parse_line(
+                    line.decode('utf-8', 'replace'))
+                if entry:
+                    inventory.add(*entry)
+        logger.debug(f'remote inventory: {inventory.total_files()} files, '
+                     f'{inventory.total_byte()} bytes')
+        return inventory
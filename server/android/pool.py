@@ -0,0 +1,166 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, CancelledError, wait
+from threading import Lock
+
+from config import LOG_NAME, DECRYPT_WORKERS, TASK_CANCEL_CHECK_INTERVAL
+
+logger = logging.getLogger(LOG_NAME)
+
+_pool = None
+_pool_lock = Lock()
+
+
+class JobCancelled(RuntimeError):
+    pass
+
+
+def interrupt_handler(cancelled, interval = TASK_CANCEL_CHECK_INTERVAL):
+    """生成中止SQLite语句的进度处理方法
+
+    供set_progress_handler使用，返回非0时SQLite中止正在执行的语句。
+    检查取消标识可能需要跨进程通信，因此每interval秒最多检查一次
+
+    :param cancelled: 返回是否已取消的方法
+    :param interval: 检查间隔秒数
+    :return: 进度处理方法
+    """
+    state = {'next': 0, 'cancelled': False}
+
+    def handler():
+        now = time.monotonic()
+        if not state['cancelled'] and now >= state['next']:
+            state['next'] = now + interval
+            state['cancelled'] = bool(cancelled())
+        return 1 if state['cancelled'] else 0
+
+    return handler
+
+
+def _run_job(func, args, kwargs, state, cancel):
+    """在工作进程中执行作业
+
+    作业的进度回调写入共享的状态字典，回调时发现取消标识已设置则抛出
+    JobCancelled中止作业；作业也可用cancelled参数在长时间执行的语句中
+    检查取消标识，被中止的作业同样抛出JobCancelled
+
+    :param func: 作业方法，需为模块级方法，接受progress和cancelled参数
+    :param args: 位置参数
+    :param kwargs: 关键字参数
+    :param state: 共享的状态字典
+    :param cancel: 共享的取消标识
+    :return: 作业方法的返回值
+    """
+    def progress(done, total):
+        state['progress'] = (done, total)
+        if cancel.is_set():
+            raise JobCancelled()
+
+    try:
+        return func(*args, progress = progress, cancelled = cancel.is_set,
+                    **kwargs)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        if cancel.is_set():
+            raise JobCancelled() from e
+        raise
+
+
+class Job:
+    """进程池中的作业
+
+    在主进程中读取作业进度、等待结果和取消作业
+    """
+
+    def __init__(self, future, state, cancel):
+        self._future = future
+        self._state = state
+        self._cancel = cancel
+
+    def progress(self):
+        """读取作业最近一次回调的进度
+
+        :return: (已完成量, 总量)
+        """
+        try:
+            return tuple(self._state.get('progress', (0, 0)))
+        except (OSError, EOFError):
+            return 0, 0
+
+    def wait(self, timeout = None):
+        """等待作业结束
+
+        :param timeout: 等待秒数
+        :return: 作业是否已结束
+        """
+        done, _ = wait([self._future], timeout)
+        return bool(done)
+
+    def result(self):
+        try:
+            return self._future.result()
+        except CancelledError:
+            raise JobCancelled()
+
+    def cancel(self):
+        """取消作业
+
+        未开始的作业直接取消，执行中的作业在下一次进度回调时中止
+
+        :return: 无
+        """
+        if not self._future.cancel():
+            self._cancel.set()
+
+
+class ProcessPool:
+    """作业进程池
+
+    把CPU密集的作业(如数据库解密)放到独立进程中执行，多个作业可以同时
+    使用多个CPU核心，也不与服务进程争用GIL。进度和取消通过Manager的
+    共享对象在进程间传递。子进程以spawn方式启动，避免在多线程的服务
+    进程中fork
+    """
+
+    def __init__(self, workers = DECRYPT_WORKERS):
+        """
+        :param workers: 进程数，为空时取CPU核心数
+        """
+        context = multiprocessing.get_context('spawn')
+        self._executor = ProcessPoolExecutor(max_workers = workers,
+                                             mp_context = context)
+        self._manager = context.Manager()
+
+    def submit(self, func, *args, **kwargs):
+        """提交作业
+
+        :param func: 作业方法，需为模块级方法，接受progress和cancelled
+        参数
+        :param args: 位置参数
+        :param kwargs: 关键字参数
+        :return: 作业
+        """
+        state = self._manager.dict()
+        cancel = self._manager.Event()
+        future = self._executor.submit(_run_job, func, args, kwargs,
+                                       state, cancel)
+        return Job(future, state, cancel)
+
+    def shutdown(self):
+        self._executor.shutdown(wait = False, cancel_futures = True)
+        self._manager.shutdown()
+
+
+def get_pool():
+    """获取共用的作业进程池，首次使用时创建
+
+    :return: 作业进程池
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPool()
+            logger.debug('process pool start')
+        return _pool
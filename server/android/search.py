@@ -0,0 +1,161 @@
+import logging
+import os
+import sqlite3
+
+from config import LOG_NAME, SEARCH_BATCH_ROWS, SEARCH_PAGE_SIZE,\
+    TASK_CANCEL_CHECK_OPS
+from .pool import JobCancelled, interrupt_handler
+
+logger = logging.getLogger(LOG_NAME)
+
+
+def _tokenizer(conn):
+    """选择全文索引的分词器
+
+    trigram分词器(SQLite 3.34+)支持中文任意子串检索，不支持时退回unicode61
+
+    :param conn: 数据库连接
+    :return: 分词器名称
+    """
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.probe USING "
+                     "fts5(x, tokenize = 'trigram');")
+        conn.execute("DROP TABLE temp.probe;")
+        return 'trigram'
+    except sqlite3.OperationalError:
+        return 'unicode61'
+
+
+def _grams(text):
+    """生成短关键字索引的词元
+
+    取内容中所有不重复的单字和双字，转为十六进制后作为词元，
+    使任意不足三个字符的子串都能以单个词元精确匹配
+
+    :param text: 消息内容
+    :return: 以空格分隔的词元
+    """
+    text = text.lower()
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return ' '.join(gram.encode('utf-8').hex() for gram in grams)
+
+
+def build_index(src, dest, batch_rows = SEARCH_BATCH_ROWS,
+                progress = None, cancelled = None):
+    """为解密后数据库的message表建立全文索引
+
+    索引保存在单独的数据库文件中：message_fts包含消息内容、会话(talker)、
+    时间(createTime)和msgId，rowid按时间递增，按rowid倒序即按时间倒序；
+    message_gram以相同的rowid保存短关键字词元，用于检索不足三个字符的关键字
+
+    :param src: 解密后的数据库路径
+    :param dest: 索引数据库路径，已存在时会被覆盖
+    :param batch_rows: 每批写入的行数
+    :param progress: 进度回调，参数为(已索引行数, 总行数)
+    :param cancelled: 返回是否已取消的方法，取消后中止正在执行的语句
+    :return: 总行数
+    """
+    temp = f'{dest}.tmp'
+    if os.path.exists(temp):
+        os.remove(temp)
+    source = sqlite3.connect(f'file:{src}?mode=ro', uri = True)
+    conn = sqlite3.connect(temp, isolation_level = None)
+    if cancelled:
+        handler = interrupt_handler(cancelled)
+        source.set_progress_handler(handler, TASK_CANCEL_CHECK_OPS)
+        conn.set_progress_handler(handler, TASK_CANCEL_CHECK_OPS)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF;")
+        conn.execute("PRAGMA synchronous = OFF;")
+        conn.execute(f"CREATE VIRTUAL TABLE message_fts USING fts5("
+                     f"content, talker UNINDEXED, createTime UNINDEXED, "
+                     f"msgId UNINDEXED, tokenize = '{_tokenizer(conn)}');")
+        conn.execute("CREATE VIRTUAL TABLE message_gram USING fts5("
+                     "grams, content = '', tokenize = 'ascii');")
+        total = source.execute("SELECT count(*) FROM message "
+                               "WHERE content IS NOT NULL;").fetchone()[0]
+        rows = source.execute(
+            "SELECT msgId, content, talker, createTime FROM message "
+            "WHERE content IS NOT NULL ORDER BY createTime, msgId;")
+        done = 0
+        while True:
+            if cancelled and cancelled():
+                raise JobCancelled()
+            batch = rows.fetchmany(batch_rows)
+            if not batch:
+                break
+            conn.execute("BEGIN;")
+            conn.executemany(
+                "INSERT INTO message_fts (rowid, content, talker, "
+                "createTime, msgId) VALUES (?, ?, ?, ?, ?);",
+                [(done + i + 1, content, talker, create_time, msg_id)
+                 for i, (msg_id, content, talker, create_time)
+                 in enumerate(batch)])
+            conn.executemany(
+                "INSERT INTO message_gram (rowid, grams) VALUES (?, ?);",
+                [(done + i + 1, _grams(str(row[1])))
+                 for i, row in enumerate(batch)])
+            conn.execute("COMMIT;")
+            done = done + len(batch)
+            if progress:
+                progress(min(done, total), total)
+        conn.execute("INSERT INTO message_fts (message_fts) "
+                     "VALUES ('optimize');")
+        conn.execute("INSERT INTO message_gram (message_gram) "
+                     "VALUES ('optimize');")
+    finally:
+        conn.close()
+        source.close()
+    os.replace(temp, dest)
+    if progress:
+        progress(total, total)
+    return total
+
+
+def search(dest, keyword, talker = None, page = 1,
+           page_size = SEARCH_PAGE_SIZE):
+    """分页检索消息
+
+    :param dest: 索引数据库路径
+    :param keyword: 关键字
+    :param talker: 只检索此会话，为空时检索全部会话
+    :param page: 页码，从1开始
+    :param page_size: 每页条数
+    :return: 包含total、page、page_size和items的字典，按时间倒序
+    """
+    page = max(1, int(page))
+    page_size = max(1, int(page_size))
+    conn = sqlite3.connect(f'file:{dest}?mode=ro', uri = True)
+    try:
+        # trigram分词器无法用MATCH检索不足三个字符的关键字，改用短关键字索引
+        if len(keyword) < 3:
+            source = ("message_gram AS g "
+                      "JOIN message_fts AS f ON f.rowid = g.rowid")
+            where, order = "g.grams MATCH ?", "g.rowid"
+            args = ['"' + keyword.lower().encode('utf-8').hex() + '"']
+        else:
+            source = "message_fts AS f"
+            where, order = "f.content MATCH ?", "f.rowid"
+            args = ['"' + keyword.replace('"', '""') + '"']
+        if talker:
+            where = f"{where} AND f.talker = ?"
+            args.append(talker)
+        total = conn.execute(
+            f"SELECT count(*) FROM {source} WHERE {where};",
+            args).fetchone()[0]
+        items = [{'msgId': row[0],
+                  'talker': row[1],
+                  'createTime': row[2],
+                  'content': row[3]}
+                 for row in conn.execute(
+                     f"SELECT f.msgId, f.talker, f.createTime, f.content "
+                     f"FROM {source} WHERE {where} "
+                     f"ORDER BY {order} DESC LIMIT ? OFFSET ?;",
+                     args + [page_size, (page - 1) * page_size])]
+        return {'total': total,
+                'page': page,
+                'page_size': page_size,
+                'items': items}
+    finally:
+        conn.close()
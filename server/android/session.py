@@ -0,0 +1,165 @@
+import logging
+import time
+from threading import Thread, Lock, Event
+
+from adb.device import Device
+
+from config import LOG_NAME, DEVICE_SESSION_TTL, DEVICE_LIST_TTL,\
+    DEVICE_TRACK_RETRY
+from ..metrics import adb_request_seconds
+
+logger = logging.getLogger(LOG_NAME)
+
+
+class MeteredDevice(Device):
+    """记录adb请求耗时的设备
+
+    shell为完整的往返，connect为建立到设备的连接(exec流和sync连接
+    都由此建立)
+    """
+
+    def shell(self, cmd, *args, **kwargs):
+        with adb_request_seconds.time(request = 'shell'):
+            return super().shell(cmd, *args, **kwargs)
+
+    def create_connection(self, *args, **kwargs):
+        with adb_request_seconds.time(request = 'connect'):
+            return super().create_connection(*args, **kwargs)
+
+
+class DeviceSession:
+    """设备会话
+
+    缓存一台设备的查询结果(Root状态、属性、IMEI、UIN等)，每项按各自的
+    有效期过期，设备断开或状态变化时整体作废
+    """
+
+    def __init__(self, client, serial, state = None):
+        self.device = MeteredDevice(client, serial)
+        self.serial = serial
+        self.state = state
+        self._values = {}  # 键 -> (过期时间, 值)
+        self._lock = Lock()
+
+    def get(self, key, loader, ttl = DEVICE_SESSION_TTL):
+        """读取缓存值，没有或已过期时调用loader重新查询
+
+        loader抛出异常时不缓存，异常原样抛出
+
+        :param key: 缓存键
+        :param loader: 查询方法，参数为adb设备
+        :param ttl: 有效期秒数
+        :return: 缓存值
+        """
+        with self._lock:
+            expire, value = self._values.get(key, (0, None))
+            if expire > time.monotonic():
+                return value
+        value = loader(self.device)
+        with self._lock:
+            self._values[key] = (time.monotonic() + ttl, value)
+        return value
+
+    def invalidate(self, key = None):
+        with self._lock:
+            if key:
+                self._values.pop(key, None)
+            else:
+                self._values.clear()
+
+
+class SessionCache(Thread):
+    """设备会话缓存
+
+    通过adb的host:track-devices长连接接收设备列表的变化，据此维护在线设备
+    和各设备的会话，监听正常时查询设备列表不再访问adb服务。监听断开时
+    (如adb服务未启动)退回到按有效期查询，并定期尝试重新监听
+    """
+
+    def __init__(self, client):
+        super().__init__(name = 'Device tracker', daemon = True)
+        self._client = client
+        self._sessions = {}  # 序列号 -> 会话，按设备列表的顺序
+        self._tracking = Event()  # 正在监听标识
+        self._expire = 0  # 未监听时设备列表的过期时间
+        self._lock = Lock()
+        self._start_lock = Lock()
+
+    def run(self):
+        while True:
+            try:
+                self._track()
+            except (OSError, RuntimeError, ValueError) as e:
+                logger.debug(f'device tracker error: {e!r}')
+            self._tracking.clear()
+            time.sleep(DEVICE_TRACK_RETRY)
+
+    def sessions(self):
+        """获取在线设备的会话
+
+        :return: 会话列表，按adb报告的顺序
+        """
+        with self._start_lock:
+            if not self._started.is_set():
+                self.start()
+        if not self._tracking.is_set() and\
+                self._expire <= time.monotonic():
+            self._update([(device.serial, None)
+                          for device in self._client.devices()])
+            self._expire = time.monotonic() + DEVICE_LIST_TTL
+        with self._lock:
+            return list(self._sessions.values())
+
+    def session(self, serial = None):
+        """获取设备的会话
+
+        :param serial: 序列号，为空时取第一台设备
+        :return: 会话，设备不在线时为None
+        """
+        for session in self.sessions():
+            if serial is None or session.serial == serial:
+                return session
+        return None
+
+    def _track(self):
+        conn = self._client.create_connection()
+        try:
+            conn.send('host:track-devices')
+            logger.debug('device tracker start')
+            while True:
+                length = int(self._read(conn, 4), 16)
+                lines = self._read(conn, length).decode('utf-8')
+                self._update([tuple(line.split('\t', 1))
+                              for line in lines.splitlines() if line])
+                # 收到第一份设备列表后才改用监听结果
+                self._tracking.set()
+        finally:
+            conn.close()
+
+    def _read(self, conn, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = conn.socket.recv(length - len(data))
+            if not chunk:
+                raise RuntimeError('device tracker closed')
+            data.extend(chunk)
+        return bytes(data)
+
+    def _update(self, devices):
+        """按最新的设备列表更新会话
+
+        新出现的设备建立会话，消失或状态变化的设备作废原会话
+
+        :param devices: (序列号, 状态)列表
+        :return: 无
+        """
+        with self._lock:
+            sessions = {}
+            for serial, state in devices:
+                session = self._sessions.get(serial, None)
+                if session is None or\
+                        (state is not None and session.state != state):
+                    logger.debug(f'device session new: {serial} {state}')
+                    session = DeviceSession(self._client, serial, state)
+                sessions[serial] = session
+            self._sessions = sessions
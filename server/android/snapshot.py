@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import time
+
+from config import LOG_NAME, DB_SNAPSHOT_BLOCK_BYTE
+from .store import BlobStore
+
+logger = logging.getLogger(LOG_NAME)
+
+
+class Snapshots:
+    """数据库快照
+
+    快照把数据库按固定大小分块，各块按md5保存在项目的块存储中，快照本身
+    只记录块的md5列表。相邻两次备份之间没有变化的块只保存一份，
+    任一快照都可以按块列表重新拼出完整的数据库
+    """
+
+    VERSION = 1
+
+    def __init__(self, root, block_byte = DB_SNAPSHOT_BLOCK_BYTE):
+        """
+        :param root: 快照目录
+        :param block_byte: 分块大小
+        """
+        self._root = root
+        self._block_byte = block_byte
+        self._blocks = BlobStore(f'{root}/blocks')
+
+    @property
+    def block_byte(self):
+        return self._block_byte
+
+    def names(self):
+        """获取所有快照名称
+
+        :return: 快照名称列表，按时间先后排序
+        """
+        if not os.path.isdir(self._root):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self._root)
+                      if name.endswith('.json'))
+
+    def load(self, name):
+        with open(f'{self._root}/{name}.json', 'r') as f:
+            snapshot = json.load(f)
+        assert snapshot.get('version') == self.VERSION
+        return snapshot
+
+    def has_block(self, digest):
+        return self._blocks.has(digest)
+
+    def put_block(self, data):
+        return self._blocks.put(data)
+
+    def save(self, blocks, src_byte, src_mtime):
+        """保存快照
+
+        :param blocks: 各块的md5列表，所有块都应已在块存储中
+        :param src_byte: 数据库大小
+        :param src_mtime: 数据库在设备上的修改时间
+        :return: 快照名称，同一秒内的快照按序号区分
+        """
+        os.makedirs(self._root, exist_ok = True)
+        base = time.strftime('%Y%m%d%H%M%S')
+        name, count = base, 0
+        while os.path.exists(f'{self._root}/{name}.json'):
+            count = count + 1
+            name = f'{base}-{count:02d}'
+        temp = f'{self._root}/{name}.json.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'src_byte': src_byte,
+                       'src_mtime': src_mtime,
+                       'block_byte': self._block_byte,
+                       'blocks': blocks}, f)
+        os.replace(temp, f'{self._root}/{name}.json')
+        logger.debug(f'snapshot saved: {self._root}/{name}')
+        return name
+
+    def assemble(self, blocks, src_byte, dest, md5 = None,
+                 progress = None):
+        """按块的md5列表拼出完整的数据库
+
+        :param blocks: 各块的md5列表，所有块都应已在块存储中
+        :param src_byte: 数据库大小
+        :param dest: 目标文件，直接写入
+        :param md5: hashlib对象，写入时同时计算整个文件的摘要
+        :param progress: 进度回调，参数为本块的字节数
+        :return: 数据库大小
+        """
+        with open(dest, 'wb') as f:
+            for digest in blocks:
+                data = self._blocks.read(digest)
+                if md5:
+                    md5.update(data)
+                f.write(data)
+                if progress:
+                    progress(len(data))
+            size = f.tell()
+        if size != src_byte:
+            raise OSError(f'assembled {size} bytes, expected {src_byte}')
+        return size
+
+    def restore(self, name, dest, md5 = None):
+        """按快照拼出完整的数据库
+
+        :param name: 快照名称
+        :param dest: 目标文件，先写临时文件再替换
+        :param md5: hashlib对象，写入时同时计算整个文件的摘要
+        :return: 数据库大小
+        """
+        snapshot = self.load(name)
+        temp = f'{dest}.tmp'
+        size = self.assemble(snapshot['blocks'], snapshot['src_byte'],
+                             temp, md5 = md5)
+        os.replace(temp, dest)
+        return size
+
+    def prune(self, keep):
+        """只保留最近的快照，并删除不再被引用的块
+
+        :param keep: 保留的快照数
+        :return: 删除的快照数
+        """
+        names = self.names()
+        removed = names[:-keep] if keep > 0 else []
+        for name in removed:
+            os.remove(f'{self._root}/{name}.json')
+        used = set()
+        for name in self.names():
+            used.update(self.load(name)['blocks'])
+        for folder, _, files in os.walk(f'{self._root}/blocks'):
+            for file in files:
+                digest = os.path.basename(folder) + file
+                if digest not in used:
+                    os.remove(f'{folder}/{file}')
+        return len(removed)
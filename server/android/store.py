@@ -0,0 +1,152 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+from config import LOG_NAME, RES_STORE_DIR
+
+logger = logging.getLogger(LOG_NAME)
+
+try:
+    import fcntl
+    _FICLONE = 0x40049409  # linux/fs.h FICLONE
+except ImportError:
+    fcntl = None
+
+
+def file_md5(path, buffer_size = 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _clone(src, dest):
+    """以硬链接建立文件，跨文件系统时尝试reflink，都不支持时复制
+
+    :param src: 源文件
+    :param dest: 目标文件，不能已存在
+    :return: 无
+    """
+    try:
+        os.link(src, dest)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    if fcntl:
+        try:
+            with open(src, 'rb') as s, open(dest, 'wb') as d:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            return
+        except OSError:
+            os.remove(dest)
+    shutil.copyfile(src, dest)
+
+
+class BlobStore:
+    """按内容寻址的资源存储
+
+    文件按md5保存为store/ab/cdef...，各项目的资源目录以硬链接引用，
+    同一内容在磁盘上只保存一份。md5与设备上busybox md5sum的结果一致，
+    拉取前可据此跳过已保存的文件
+    """
+
+    def __init__(self, root = RES_STORE_DIR):
+        self._root = root
+
+    def path(self, digest):
+        return f'{self._root}/{digest[:2]}/{digest[2:]}'
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def is_empty(self):
+        """存储中是否还没有内容
+
+        :return: 是否为空
+        """
+        for _, _, files in os.walk(self._root):
+            if files:
+                return False
+        return True
+
+    def add(self, file, digest = None):
+        """把本地文件加入存储
+
+        存储中已有相同内容时，本地文件改为指向已有内容的硬链接
+
+        :param file: 本地文件
+        :param digest: 文件的md5，写入时已算出的不再重读文件
+        :return: md5
+        """
+        digest = digest or file_md5(file)
+        blob = self.path(digest)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, file):
+                self._replace(blob, file)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok = True)
+            try:
+                os.link(file, blob)
+            except FileExistsError:
+                self._replace(blob, file)
+            except OSError as e:
+                # 存储与项目不在同一文件系统时不加入存储
+                logger.debug(f'store add {file} skipped: {e!r}')
+        return digest
+
+    def put(self, data):
+        """把一段数据加入存储
+
+        :param data: 数据
+        :return: md5
+        """
+        digest = hashlib.md5(data).hexdigest()
+        blob = self.path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok = True)
+            temp = f'{blob}.{uuid.uuid4().hex}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, blob)
+        return digest
+
+    def read(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+    def link(self, digest, dest):
+        """从存储中取出文件
+
+        :param digest: md5
+        :param dest: 本地文件，已存在时被替换
+        :return: 无
+        """
+        self._replace(self.path(digest), dest)
+
+    def prune(self):
+        """删除不再被任何项目引用的内容
+
+        :return: 删除的文件数
+        """
+        count = 0
+        for folder, _, files in os.walk(self._root):
+            for name in files:
+                blob = f'{folder}/{name}'
+                try:
+                    if os.stat(blob).st_nlink <= 1:
+                        os.remove(blob)
+                        count = count + 1
+                except OSError:
+                    pass
+        logger.debug(f'store prune {count} blobs')
+        return count
+
+    def _replace(self, blob, dest):
+        temp = f'{dest}.{uuid.uuid4().hex}.tmp'
+        _clone(blob, temp)
+        os.replace(temp, dest)
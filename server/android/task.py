@@ -1,22 +1,68 @@
+import asyncio
 import base64
+import hashlib
 import io
+import json
 import logging
 import os
-import subprocess
 import tarfile
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed,\
+    TimeoutError as FutureTimeoutError
+from contextlib import closing, contextmanager
+from threading import Lock
 
 from adb.sync import Sync as AdbSync
 from flask_babel import gettext as _
-from pysqlcipher3 import dbapi2 as sqlite
 
 from config import LOG_NAME, MM_DB_DIR, MM_RES_DIR, MM_DB_ENCODE_NAME,\
-    MM_DB_DECODE_NAME
-from ..task import TaskRunner, HeartbeatRunner, OnceRunner
+    MM_DB_DECODE_NAME, RES_PULL_MODE, RES_PULL_INCREMENTAL,\
+    RES_PULL_WORKERS, RES_PULL_SHARD_BYTE, RES_PULL_SHARD_FILES,\
+    RES_STORE, RES_STORE_MIN_BYTE, RES_OUTPUT, RES_PULL_ENCODING,\
+    RES_ENCODING_MIN_BYTE,\
+    DB_PULL_MODE, DB_PULL_CHUNK_BYTE, DB_PULL_RETRIES,\
+    DB_SNAPSHOT_BLOCK_BYTE, DB_SNAPSHOT_KEEP, DECRYPT_MODE,\
+    DECRYPT_PAGE_SIZE, DECRYPT_CACHE_SIZE, DECRYPT_CIPHER_PAGE_SIZE,\
+    DECRYPT_BUILD_INDEX, DECRYPT_EXECUTOR, DECRYPT_POLL_INTERVAL,\
+    SEARCH_DB_NAME, TASK_EXECUTION_MODE, TASK_CANCEL_CHECK_OPS,\
+    EXPORT_FORMAT
+from .aioadb import AsyncAdbClient, AsyncAdbError
+from .archive import PackArchive
+from .decrypt import export_plaintext, sqlite
+from .export import FORMATS, TABLES, export_messages
+from .keys import candidate_passwords, find_password
+from .encoding import ENCODINGS, DEFAULT_ENCODING, EncodingRecords,\
+    negotiate, probe_encodings, tar_command
+from .search import build_index
+from .manifest import Manifest, Inventory
+from .pool import JobCancelled, get_pool, interrupt_handler
+from .snapshot import Snapshots
+from .store import BlobStore
+from .transfer import block_md5_cmd, exec_out, interrupt, push_lines,\
+    read_chunk, remote_md5, remote_block_md5, remote_file_md5
+from .. import metrics
+from ..task import TaskRunner, HeartbeatRunner, OnceRunner,\
+    AsyncTaskRunner, AsyncHeartbeatRunner, AsyncOnceRunner
 
 logger = logging.getLogger(LOG_NAME)
 
 
+def _device_slot_keys(serial, bus):
+    """设备传输任务占用的并发名额
+
+    同时受全局、单台设备和所在USB总线的并发上限约束
+
+    :param serial: 序列号
+    :param bus: USB总线编号，非USB连接时为None
+    :return: 名额键列表
+    """
+    keys = [('fleet', ''), ('device', serial)]
+    if bus:
+        keys.append(('bus', bus))
+    return keys
+
+
 class DBPullRunnerInitError(RuntimeError):
     pass
 
@@ -29,8 +75,15 @@ class ResPullRunnerInitError(RuntimeError):
     pass
 
 
-class DbPullRunner(TaskRunner):
-    """数据库拉取运行器
+class ExportRunnerInitError(RuntimeError):
+    pass
+
+
+class _DbPullMixin:
+    """DbPullRunner和AsyncDbPullRunner共用的部分
+
+    参数解析、断点记录、进度和存活检查与运行方式无关，两个运行器只各自
+    实现与设备的交互
     """
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -38,14 +91,20 @@ class DbPullRunner(TaskRunner):
         try:
             params = kwargs.get('params', None)
             assert params
-            self._device = params.get('device', None)
+            client = params.get('device', None)
+            assert client
+            self._device = client.device(params.get('serial', None))
             assert self._device
-            self._device = self._device.current_device
-            self._connection = self._device.sync()
+            self._serial = self._device.serial
+            self._bus = client.device_bus(self._serial)
+            self._catalog = client.catalog
 
             self._user = params.get('user', None)
             assert self._user
 
+            self._chunk_byte = int(params.get('chunk', DB_PULL_CHUNK_BYTE))
+            assert self._chunk_byte > 0
+
             self._task_alive_timeout = params.get('timeout', 10)
             self._task_alive_timestamp = time.time()
         except AssertionError:
@@ -57,52 +116,132 @@ class DbPullRunner(TaskRunner):
                          f'{MM_DB_ENCODE_NAME}.db'
         self._dest_path = f'data/{self.name}/'\
                           f'{self._dest_name}'
-        self._src_byte = self._remote_byte(self._src_path)
-        self._dest_byte = -1
+        self._part_path = f'{self._dest_path}.part'
+        self._part_state_path = f'{self._dest_path}.part.json'
+        self._src_byte, self._src_mtime = None, None
+        self._dest_byte = -1  # 上次存活检查时已拉取的字节数
+        self._pulled_byte = 0  # 已拉取的字节数，为None时按目标文件大小
+        self._unchanged = False  # 设备上的数据库与上次拉取的相同
+        self._finished = False  # 拉取完成并已校验
 
         self._pull_db_error = False
 
-    def _on_before_runloop(self):
-        if not os.path.exists(f'data/{self.name}'):
-            os.makedirs(f'data/{self.name}')
-        self._add_checker()
-
-    def _on_runloop(self):
+    def _touch(self):
+        """刷新存活时间
+
+        设备计算md5或本地读写期间已拉取的字节数不变，需要主动刷新，
+        避免被守护线程当作失去响应
+
+        :return: 无
+        """
+        self._task_alive_timestamp = time.time()
+
+    def _checksum_record(self):
+        """项目目录中上次拉取的校验和
+
+        :return: 十六进制md5，记录的大小与设备上和本地的数据库不符时为None
+        """
+        record = self._catalog.checksum(self.name, self._dest_path)
+        if record and record[0] == self._src_byte ==\
+                self._local_byte(self._dest_path):
+            return record[1]
+        return None
+
+    def _set_unchanged(self):
+        self._unchanged = True
+        self._finished = True
+        logger.debug(f"[{self.name}] DbPullRunner db unchanged")
+        # 上次中断留下的临时文件已无用
+        for path in (self._part_path, self._part_state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def _verify(digest, expected):
+        if digest != expected:
+            raise OSError(f'checksum mismatch: {digest} != {expected}')
+
+    def _check_chunk(self, data, offset, expected):
+        """核对一块的长度和md5
+
+        :param data: 分块数据
+        :param offset: 分块的偏移
+        :param expected: 设备上计算的十六进制md5
+        :return: 无
+        """
+        assert len(data) == min(self._chunk_byte, self._src_byte - offset)
+        assert hashlib.md5(data).hexdigest() == expected
+
+    def _hash_prefix(self, f, offset):
+        """继续上次的拉取时读一遍已完成的部分，得到md5的初始状态
+
+        :param f: 临时文件
+        :param offset: 已完成的偏移
+        :return: hashlib对象
+        """
+        md5 = hashlib.md5()
+        remain = offset
+        while remain > 0:
+            block = f.read(min(remain, 1024 * 1024))
+            if not block:
+                raise OSError('partial database truncated')
+            md5.update(block)
+            remain = remain - len(block)
+            self._touch()
+        return md5
+
+    def _finish_part(self, stat):
+        """确认设备上的数据库在拉取期间没有变化后用临时文件替换数据库
+
+        每块都已与设备上的md5核对，数据库的大小和修改时间与开始拉取时
+        相同，拉到的就是完整的一份
+
+        :param stat: 拉取结束时设备上数据库的(大小, 修改时间)
+        :return: 无
+        """
+        if tuple(stat) != (self._src_byte, self._src_mtime):
+            # 拉取期间数据库有变化，下次从头拉取
+            os.remove(self._part_path)
+            os.remove(self._part_state_path)
+            raise OSError(f'database changed during pull: {stat}')
+        os.replace(self._part_path, self._dest_path)
+        os.remove(self._part_state_path)
+
+    def _load_part_state(self):
+        """读取上次中断时的拉取状态
+
+        :return: 可以继续的偏移，设备上的数据库已变化或没有记录时为0
+        """
         try:
-            logger.debug(
-                f"[{self.name}] DbPullRunner connection closed "
-                f"status: {self._connection.socket._closed}")
-            if not self._connection.socket._closed:
-                sync = AdbSync(self._connection)
-                with self._connection:
-                    logger.debug(
-                        f"[{self.name}] DbPullRunner pull db start")
-                    sync.pull(self._src_path, self._dest_path)
-                    logger.debug(
-                        f"[{self.name}] DbPullRunner pull db end")
-        except OSError as e:
-            logger.debug(
-                f"[{self.name}] DbPullRunner pull db error: {e}")
-            if not self._stop_by_user:
-                self._pull_db_error = True
-        finally:
-            logger.debug(
-                f"[{self.name}] DbPullRunner pull db finish")
-            self.stop()
+            with open(self._part_state_path, 'r') as f:
+                state = json.load(f)
+            assert state['src_byte'] == self._src_byte
+            assert state['src_mtime'] == self._src_mtime
+            offset = min(state['offset'],
+                         self._local_byte(self._part_path))
+            return offset - offset % self._chunk_byte
+        except (OSError, ValueError, KeyError, AssertionError):
+            return 0
 
-    def _on_before_stop(self):
-        self._connection.close()
+    def _save_part_state(self, offset):
+        with open(self._part_state_path, 'w') as f:
+            json.dump({'src_byte': self._src_byte,
+                       'src_mtime': self._src_mtime,
+                       'offset': offset}, f)
 
     def is_task_alive(self):
         alive = True
         try:
-            size = self._local_byte(self._dest_path)
+            size = self.dest_byte
             if size != self._dest_byte:
                 self._dest_byte = size
-                self._task_alive_timestamp = time.time()
+                self._touch()
             elif time.time() - self._task_alive_timestamp >\
                     self._task_alive_timeout:
                 alive = False
+                if not self._finished:
+                    # 被守护线程停止的拉取没有完成，按失败报告
+                    self._pull_db_error = True
         except Exception:
             alive = False
             logger.debug(
@@ -110,9 +249,15 @@ class DbPullRunner(TaskRunner):
         finally:
             return alive
 
+    def slot_keys(self):
+        return _device_slot_keys(self._serial, self._bus)
+
     def is_kill_when_stop(self):
         return True
 
+    def alive_interval(self):
+        return max(1, self._task_alive_timeout / 2)
+
     def is_pull_db_error(self):
         return self._pull_db_error
 
@@ -126,8 +271,18 @@ class DbPullRunner(TaskRunner):
                     "path": self.dest_path,
                     'src_byte': -1,
                     'dest_byte': -1}
-        elif self.src_byte > self.dest_byte:
-            p = float(str(self.dest_byte / self.src_byte)[:6])
+        elif self._finished:
+            logger.debug(f"[{self.name}] DbPullRunner progress 100%")
+            return {"projectName": self.name,
+                    "progress": 1,
+                    "filename": self.dest_name,
+                    "path": self.dest_path,
+                    'src_byte': self.src_byte,
+                    'dest_byte': self.src_byte}
+        elif self.src_byte:
+            # 校验通过前不报告100%
+            p = min(float(str(self.dest_byte / self.src_byte)[:6]),
+                    0.9999)
             logger.debug(f"[{self.name}] DbPullRunner progress p: {p}")
             return {"projectName": self.name,
                     "progress": p,
@@ -135,19 +290,22 @@ class DbPullRunner(TaskRunner):
                     "path": self.dest_path,
                     'src_byte': self.src_byte,
                     'dest_byte': self.dest_byte}
-        elif self.src_byte == self.dest_byte:
-            logger.debug(f"[{self.name}] DbPullRunner progress 100%")
+        else:
+            # 还未取得设备上数据库的大小
             return {"projectName": self.name,
-                    "progress": 1,
+                    "progress": 0,
                     "filename": self.dest_name,
                     "path": self.dest_path,
-                    'src_byte': self.src_byte,
-                    'dest_byte': self.dest_byte}
+                    'src_byte': 0,
+                    'dest_byte': 0}
 
     @property
     def dest_byte(self):
-        self._dest_byte = self._local_byte(self._dest_path)
-        return self._dest_byte
+        """已拉取的字节数
+        """
+        if self._pulled_byte is None:
+            return self._local_byte(self._dest_path)
+        return self._pulled_byte
 
     @property
     def dest_path(self):
@@ -178,10 +336,6 @@ class DbPullRunner(TaskRunner):
         except OSError:
             return 0
 
-    def _remote_byte(self, path):
-        return int(
-            self._device.shell(f'stat -c%s {path}').replace('\r\n', ''))
-
     def _get_stop_success_message(self):
         return _('Pull has been stopped')
 
@@ -189,13 +343,483 @@ class DbPullRunner(TaskRunner):
         return _('Stop pull was failed')
 
     def _add_checker(self):
-        from server import _daemon
-        _daemon.add_task(HeartbeatRunner,
-                         f'Db size checker - {self.name}',
-                         callback = self._callback,
-                         params = {'command': "check_db_size",
-                                   'interval': 1,
-                                   'progress': self.progress})
+        from server import _ticker
+        _ticker.register(f'Db size checker - {self.name}',
+                         'check_db_size',
+                         params = {'progress': self.progress},
+                         owner = self)
+
+
+class DbPullRunner(_DbPullMixin, TaskRunner):
+    """数据库拉取运行器
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        try:
+            params = kwargs['params']
+            self._mode = params.get('mode', DB_PULL_MODE)
+            assert self._mode in ('chunked', 'snapshot', 'sync')
+            self._connection = None
+            self._block_byte = int(params.get('block',
+                                              DB_SNAPSHOT_BLOCK_BYTE))
+            assert self._block_byte > 0 and\
+                self._block_byte % DECRYPT_CIPHER_PAGE_SIZE == 0
+        except AssertionError:
+            raise DBPullRunnerInitError()
+
+        self._src_byte, self._src_mtime = self._remote_stat(
+            self._src_path)
+        self._executor = None
+        self._remote = None  # 设备上整个文件md5的Future
+
+    def _on_before_runloop(self):
+        if not os.path.exists(f'data/{self.name}'):
+            os.makedirs(f'data/{self.name}')
+        self._add_checker()
+
+    def _on_runloop(self):
+        try:
+            with self._stage(f'pull_{self._mode}'):
+                self._pull()
+        except OSError as e:
+            logger.debug(
+                f"[{self.name}] DbPullRunner pull db error: {e}")
+            if not self._stop_by_user:
+                self._pull_db_error = True
+        finally:
+            logger.debug(
+                f"[{self.name}] DbPullRunner pull db finish")
+            self.stop()
+
+    def _pull(self):
+        """拉取并校验数据库
+
+        本地的md5在数据到达时同步计算，不再重读文件。分块模式按块核对
+        设备上的md5，其他模式与设备上整个文件的md5核对，一致才算拉取
+        成功，并记入项目目录；下次拉取时大小相符、设备上的md5也与记录
+        相同则跳过
+
+        :return: 无
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers = 1, thread_name_prefix = f'{self.name}-md5')
+        try:
+            if self._mode != 'chunked':
+                # 与传输同时在设备上计算整个文件的md5
+                self._start_remote_md5()
+            if self._is_unchanged():
+                return
+            if self._mode == 'chunked':
+                digest = self._pull_chunked()
+            elif self._mode == 'snapshot':
+                digest = self._pull_snapshot()
+            else:
+                digest = self._pull_sync()
+            if digest:
+                self._catalog.set_checksum(self.name, self._dest_path,
+                                           self._src_byte, digest)
+                self._finished = True
+        finally:
+            self._executor.shutdown(wait = False)
+
+    def _start_remote_md5(self):
+        if self._remote is None:
+            self._remote = self._executor.submit(
+                remote_file_md5, self._device, self._src_path,
+                cancel = self._cancel)
+        return self._remote
+
+    def _remote_md5(self):
+        """等待设备上整个文件的md5，未开始计算时先开始
+
+        :return: 十六进制md5
+        """
+        return self._wait_device(self._start_remote_md5())
+
+    def _wait_device(self, future):
+        """等待设备上的计算完成
+
+        等待期间刷新存活时间，任务停止时不再等待
+
+        :param future: 设备上计算的Future
+        :return: 计算结果
+        """
+        while True:
+            if self._stopped.is_set():
+                raise InterruptedError('pull cancelled')
+            try:
+                return future.result(timeout = 0.5)
+            except FutureTimeoutError:
+                self._touch()
+
+    def _is_unchanged(self):
+        """按项目目录中的校验和判断设备上的数据库是否与本地的相同
+
+        大小不符时不需要设备上的md5，不在设备上读一遍整个文件
+
+        :return: 是否相同
+        """
+        digest = self._checksum_record()
+        if digest and digest == self._remote_md5():
+            self._set_unchanged()
+        return self._unchanged
+
+    def _pull_sync(self):
+        # 连接在运行线程中打开和关闭，取消时只中断不关闭
+        self._connection = self._device.sync()
+        sync = AdbSync(self._connection)
+        with self._connection, self._cancel.on_cancel(
+                lambda: interrupt(self._connection)):
+            logger.debug(
+                f"[{self.name}] DbPullRunner pull db start")
+            # sync协议由adb库直接写文件，按文件大小计算进度
+            self._pulled_byte = None
+            try:
+                sync.pull(self._src_path, self._dest_path)
+            except Exception:
+                if self._cancel.is_set():
+                    raise InterruptedError('pull cancelled')
+                raise
+            finally:
+                self._pulled_byte = self._local_byte(self._dest_path)
+            metrics.observe_transfer(self, 'database', self._pulled_byte)
+            logger.debug(
+                f"[{self.name}] DbPullRunner pull db end")
+        # 只能在拉取后读取一遍计算md5
+        md5 = hashlib.md5()
+        with open(self._dest_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+                self._touch()
+        self._verify(md5.hexdigest(), self._remote_md5())
+        return md5.hexdigest()
+
+    def _pull_chunked(self):
+        """分块拉取数据库
+
+        用dd按块读取设备上的数据库，设备在另一个连接上逐块计算md5并逐行
+        返回，每块在本地计算md5与之核对后才写入临时文件并记录已完成的
+        偏移，失败的块会重试。两个连接几乎同时读取同一块，设备上的数据
+        多来自页缓存。任务中断后再次拉取时，只要设备上的数据库没有变化，
+        就从最后一个完成的偏移继续。设备上的数据库在拉取期间没有变化才
+        替换原有的数据库
+
+        :return: 十六进制md5，未拉取完时为None
+        """
+        offset = self._load_part_state()
+        self._pulled_byte = offset
+        logger.debug(
+            f"[{self.name}] DbPullRunner pull db from offset {offset}")
+        count = -(-self._src_byte // self._chunk_byte)
+        listing = remote_block_md5(self._device, self._src_path,
+                                   self._chunk_byte, count,
+                                   start = offset // self._chunk_byte,
+                                   timeout = self._task_alive_timeout,
+                                   cancel = self._cancel)
+        retries, expected = 0, None
+        with open(self._part_path, 'r+b' if offset else 'wb') as f,\
+                closing(listing):
+            md5 = self._hash_prefix(f, offset)
+            f.truncate(offset)
+            f.seek(offset)
+            while offset < self._src_byte and not self._stopped.is_set():
+                index = offset // self._chunk_byte
+                if expected is None:
+                    # 设备上的md5流中断后不能再对齐，不重试
+                    expected = next(listing, None)
+                    if expected is None:
+                        raise OSError(f'hash chunk {index} failed')
+                try:
+                    data = read_chunk(self._device, self._src_path, index,
+                                      self._chunk_byte,
+                                      timeout = self._task_alive_timeout,
+                                      cancel = self._cancel)
+                    self._check_chunk(data, offset, expected)
+                except (OSError, AssertionError) as e:
+                    retries = retries + 1
+                    logger.debug(
+                        f"[{self.name}] DbPullRunner chunk {index} "
+                        f"failed ({retries}): {e!r}")
+                    if retries > DB_PULL_RETRIES:
+                        raise OSError(f'pull chunk {index} failed')
+                    continue
+                retries, expected = 0, None
+                md5.update(data)
+                f.write(data)
+                f.flush()
+                offset = offset + len(data)
+                self._pulled_byte = offset
+                self._save_part_state(offset)
+                metrics.observe_transfer(self, 'database', len(data))
+        if offset != self._src_byte:
+            return None
+        self._finish_part(self._remote_stat(self._src_path))
+        logger.debug(f"[{self.name}] DbPullRunner pull db end")
+        return md5.hexdigest()
+
+    def _pull_snapshot(self):
+        """按块增量拉取数据库并保存快照
+
+        先在设备上逐块计算md5，块存储中已有的块不再传输，缺少的块按连续
+        区间用dd读取并逐块核对md5后存入块存储。所有块就绪后拼出临时
+        文件，与设备上整个文件的md5核对后才保存快照并替换数据库
+
+        :return: 十六进制md5，未拉取完时为None
+        """
+        self._pulled_byte = 0
+        snapshots = Snapshots(f'data/{self.name}/snapshots',
+                              self._block_byte)
+        count = -(-self._src_byte // self._block_byte)
+        blocks, missing = [], []
+        for index, digest in enumerate(remote_block_md5(
+                self._device, self._src_path, self._block_byte, count,
+                cancel = self._cancel)):
+            if self._stopped.is_set():
+                return
+            blocks.append(digest)
+            if snapshots.has_block(digest):
+                self._pulled_byte = self._pulled_byte +\
+                    self._block_size(index)
+            else:
+                missing.append(index)
+            # 计算md5期间没有数据写入，按行刷新存活时间
+            self._touch()
+        if len(blocks) != count:
+            raise OSError(f'hash {len(blocks)}/{count} blocks')
+        logger.debug(f"[{self.name}] DbPullRunner snapshot missing "
+                     f"{len(missing)}/{count} blocks")
+        for start, length in self._block_ranges(missing):
+            with exec_out(self._device,
+                          f'busybox dd if={self._src_path} '
+                          f'bs={self._block_byte} skip={start} '
+                          f'count={length} 2>/dev/null',
+                          timeout = self._task_alive_timeout,
+                          cancel = self._cancel) as stream:
+                for index in range(start, start + length):
+                    if self._stopped.is_set():
+                        return
+                    data = stream.read(self._block_size(index))
+                    if snapshots.put_block(data) != blocks[index]:
+                        raise OSError(f'block {index} changed')
+                    self._pulled_byte = self._pulled_byte + len(data)
+                    metrics.observe_transfer(self, 'database', len(data))
+        temp = f'{self._dest_path}.tmp'
+        md5 = hashlib.md5()
+        try:
+            snapshots.assemble(blocks, self._src_byte, temp, md5 = md5,
+                               progress = lambda size: self._touch())
+            self._verify(md5.hexdigest(), self._remote_md5())
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        name = snapshots.save(blocks, self._src_byte, self._src_mtime)
+        os.replace(temp, self._dest_path)
+        snapshots.prune(DB_SNAPSHOT_KEEP)
+        logger.debug(f"[{self.name}] DbPullRunner snapshot {name} end")
+        return md5.hexdigest()
+
+    def _block_size(self, index):
+        return min(self._block_byte,
+                   self._src_byte - index * self._block_byte)
+
+    @staticmethod
+    def _block_ranges(indexes):
+        """把块序号合并为连续区间
+
+        :param indexes: 升序的块序号列表
+        :return: (起始序号, 块数)生成器
+        """
+        start, length = None, 0
+        for index in indexes:
+            if start is not None and index == start + length:
+                length = length + 1
+                continue
+            if start is not None:
+                yield start, length
+            start, length = index, 1
+        if start is not None:
+            yield start, length
+
+    def _remote_byte(self, path):
+        return int(
+            self._device.shell(f'stat -c%s {path}').replace('\r\n', ''))
+
+    def _remote_stat(self, path):
+        size, mtime = self._device.shell(f'stat -c"%s %Y" {path}').split()
+        return int(size), int(mtime)
+
+
+class AsyncDbPullRunner(_DbPullMixin, AsyncTaskRunner):
+    """异步数据库拉取运行器
+
+    与DbPullRunner的分块模式相同，分块读取和设备端md5通过异步adb客户端
+    完成，等待设备时不占用线程
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        client = kwargs['params']['device']
+        self._client = AsyncAdbClient(client.host, client.port)
+        self._remote = None  # 设备上整个文件md5的Task
+
+    async def _on_before_runloop(self):
+        if not os.path.exists(f'data/{self.name}'):
+            os.makedirs(f'data/{self.name}')
+        self._add_checker()
+        try:
+            self._src_byte, self._src_mtime = await self._remote_stat()
+        except (OSError, ValueError, AsyncAdbError,
+                asyncio.TimeoutError) as e:
+            logger.debug(
+                f"[{self.name}] AsyncDbPullRunner stat db error: {e!r}")
+            self._pull_db_error = True
+            await self.astop()
+
+    async def _on_runloop(self):
+        try:
+            with self._stage('pull_chunked'):
+                await self._pull()
+        except (OSError, AsyncAdbError, asyncio.TimeoutError) as e:
+            logger.debug(
+                f"[{self.name}] AsyncDbPullRunner pull db error: {e!r}")
+            if not self._stop_by_user:
+                self._pull_db_error = True
+        finally:
+            logger.debug(
+                f"[{self.name}] AsyncDbPullRunner pull db finish")
+            await self.astop()
+
+    async def _pull(self):
+        try:
+            if await self._is_unchanged():
+                return
+            digest = await self._pull_chunked()
+            if digest:
+                self._catalog.set_checksum(self.name, self._dest_path,
+                                           self._src_byte, digest)
+                self._finished = True
+        finally:
+            if self._remote:
+                self._remote.cancel()
+
+    async def _is_unchanged(self):
+        digest = self._checksum_record()
+        if digest:
+            self._remote = asyncio.ensure_future(self._remote_file_md5())
+            if digest == await self._wait_device(self._remote):
+                self._set_unchanged()
+        return self._unchanged
+
+    async def _wait_device(self, future):
+        """等待设备上的计算完成
+
+        等待期间刷新存活时间，任务停止时不再等待
+
+        :param future: 设备上计算的Future
+        :return: 计算结果
+        """
+        while True:
+            done, pending = await asyncio.wait({future}, timeout = 0.5)
+            if done:
+                return future.result()
+            if self._stopped.is_set():
+                raise InterruptedError('pull cancelled')
+            self._touch()
+
+    async def _remote_stat(self):
+        output = await asyncio.wait_for(
+            self._client.shell(self._serial,
+                               f'stat -c"%s %Y" {self._src_path}'),
+            self._task_alive_timeout)
+        size, mtime = output.split()
+        return int(size), int(mtime)
+
+    async def _remote_file_md5(self):
+        output = await self._client.shell(
+            self._serial, f'busybox md5sum {self._src_path} 2>/dev/null')
+        return output.split()[0] if output.strip() else ''
+
+    async def _pull_chunked(self):
+        offset = self._load_part_state()
+        self._pulled_byte = offset
+        logger.debug(f"[{self.name}] AsyncDbPullRunner pull db from "
+                     f"offset {offset}")
+        count = -(-self._src_byte // self._chunk_byte)
+        listing = await asyncio.wait_for(
+            self._client.exec_out(
+                self._serial,
+                block_md5_cmd(self._src_path, self._chunk_byte, count,
+                              start = offset // self._chunk_byte)),
+            self._task_alive_timeout)
+        retries, expected = 0, None
+        async with listing:
+            with open(self._part_path, 'r+b' if offset else 'wb') as f,\
+                    self._cancel.on_cancel(listing.abort):
+                # 已完成部分可能很大，在线程中读取，不阻塞事件循环
+                md5 = await asyncio.get_running_loop().run_in_executor(
+                    None, self._hash_prefix, f, offset)
+                f.truncate(offset)
+                f.seek(offset)
+                while offset < self._src_byte and\
+                        not self._stopped.is_set():
+                    index = offset // self._chunk_byte
+                    if expected is None:
+                        expected = await self._next_md5(listing, index)
+                    try:
+                        data = await asyncio.wait_for(
+                            self._read_chunk(index),
+                            self._task_alive_timeout)
+                        self._check_chunk(data, offset, expected)
+                    except (OSError, AsyncAdbError, asyncio.TimeoutError,
+                            AssertionError) as e:
+                        retries = retries + 1
+                        logger.debug(
+                            f"[{self.name}] AsyncDbPullRunner chunk "
+                            f"{index} failed ({retries}): {e!r}")
+                        if retries > DB_PULL_RETRIES:
+                            raise OSError(f'pull chunk {index} failed')
+                        continue
+                    retries, expected = 0, None
+                    md5.update(data)
+                    f.write(data)
+                    f.flush()
+                    offset = offset + len(data)
+                    self._pulled_byte = offset
+                    self._save_part_state(offset)
+                    metrics.observe_transfer(self, 'database', len(data))
+        if offset != self._src_byte:
+            return None
+        self._finish_part(await self._remote_stat())
+        logger.debug(f"[{self.name}] AsyncDbPullRunner pull db end")
+        return md5.hexdigest()
+
+    async def _next_md5(self, listing, index):
+        """读取设备上下一块的md5
+
+        md5流中断后不能再对齐，不重试
+
+        :param listing: 逐块计算md5的连接
+        :param index: 分块序号
+        :return: 十六进制md5
+        """
+        line = await asyncio.wait_for(listing.read_line(),
+                                      self._task_alive_timeout)
+        if not line.strip():
+            raise OSError(f'hash chunk {index} failed')
+        return line.split()[0].decode('ascii')
+
+    def _chunk_cmd(self, index):
+        return f'busybox dd if={self._src_path} bs={self._chunk_byte} '\
+               f'skip={index} count=1 2>/dev/null'
+
+    async def _read_chunk(self, index):
+        conn = await self._client.exec_out(self._serial,
+                                           self._chunk_cmd(index))
+        async with conn:
+            with self._cancel.on_cancel(conn.abort):
+                return await conn.read_all()
 
 
 class DbDecryptRunner(TaskRunner):
@@ -208,11 +832,29 @@ class DbDecryptRunner(TaskRunner):
             params = kwargs.get('params', None)
             assert params
             self._password = params.get('password', None)
-            assert self._password
+            # 未给出密码时按设备的IMEI和UIN计算候选密码
+            self._client = params.get('device', None)
+            self._serial = params.get('serial', None)
+            self._imeis = params.get('imei', [])
+            if isinstance(self._imeis, str):
+                self._imeis = [self._imeis]
+            self._uins = [params['uin']] if params.get('uin') else []
+            assert self._password or self._client or\
+                (self._imeis and self._uins)
+
+            self._mode = params.get('mode', DECRYPT_MODE)
+            assert self._mode in ('single', 'migrate')
+            self._page_size = int(params.get('page_size',
+                                             DECRYPT_PAGE_SIZE))
+            self._cache_size = int(params.get('cache_size',
+                                              DECRYPT_CACHE_SIZE))
+            self._build_index = params.get('index', DECRYPT_BUILD_INDEX)
+            self._executor = params.get('executor', DECRYPT_EXECUTOR)
+            assert self._executor in ('process', 'thread')
 
             self._task_alive_timeout = params.get('timeout', 10)
             self._task_alive_timestamp = time.time()
-        except AssertionError:
+        except (AssertionError, ValueError):
             raise DbDecryptRunnerInitError()
 
         self._src_db_filename = f'{MM_DB_ENCODE_NAME}.db'
@@ -227,25 +869,99 @@ class DbDecryptRunner(TaskRunner):
             f'{self._dest_db_path}']
         self._temp_file_byte = -1
 
-        self._step_names = [_('Migrating'),
-                            _('Decrypting')]
-        self._step_processs = [getattr(self, '_on_step_migrate'),
-                               getattr(self, '_on_step_decrypt')]
+        self._index_db_path = f'data/{self.name}/{SEARCH_DB_NAME}.db'
+
+        if self._mode == 'single':
+            self._temp_file = [f'{self._dest_db_path}']
+            self._step_names = [_('Decrypting')]
+            self._step_processs = [getattr(self, '_on_step_export')]
+            if self._build_index:
+                self._temp_file.append(self._index_db_path)
+                self._step_names.append(_('Indexing'))
+                self._step_processs.append(
+                    getattr(self, '_on_step_index'))
+        else:
+            self._step_names = [_('Migrating'),
+                                _('Decrypting')]
+            self._step_processs = [getattr(self, '_on_step_migrate'),
+                                   getattr(self, '_on_step_decrypt')]
         self._step = 0
+        self._pages = (0, 0)  # (已处理页数, 总页数)
+        self._step_progress = (0, 0)  # 当前步骤的(已完成量, 总量)
+        self._decrypt_error = False
+        self._password_error = False
+        self._cipher = 'legacy'  # 源库的加密格式
+        self._job = None  # 进程池中执行的作业
 
     def _on_before_runloop(self):
         self._add_checker()
+        with self._stage('key'):
+            password, cipher = self._find_password()
+        if password:
+            self._password = password
+            self._cipher = cipher
+        else:
+            self._password_error = True
+            self._decrypt_error = True
+            self.stop()
+
+    def _find_password(self):
+        """在解密前确定密码
+
+        给出的密码和由所有IMEI、UIN组合出的候选密码并行试开数据库，
+        每个候选只需一次密钥派生和读取首页，密码错误时不必等到迁移或
+        导出失败。给出的候选都不正确时再从设备读取IMEI和UIN。之前以
+        migrate模式解密过的数据库已迁移为SQLCipher 4格式，同时得到格式。
+        更正后的密码只记入项目目录，不写入日志和进度
+
+        :return: (正确的密码, 加密格式)，都不正确时为(None, None)
+        """
+        candidates = candidate_passwords(self._imeis, self._uins,
+                                         [self._password])
+        password, cipher = find_password(self._src_db_path, candidates)
+        if not password and self._client:
+            imeis, uins = self._client.key_sources(self._serial)
+            candidates = [candidate for candidate
+                          in candidate_passwords(imeis, uins)
+                          if candidate not in candidates]
+            password, cipher = find_password(self._src_db_path, candidates)
+        logger.debug(f"[{self.name}] DbDecryptRunner key trial "
+                     f"{f'found ({cipher})' if password else 'not found'}")
+        if password and password != self._password:
+            logger.debug(f"[{self.name}] DbDecryptRunner password corrected")
+            if self._client:
+                self._client.catalog.set_password(self.name, password)
+        return password, cipher
+
+    def _on_before_stop(self):
+        job = self._job
+        if job:
+            job.cancel()
 
     def _on_runloop(self):
         if self._step < len(self._step_processs):
             logger.debug(
                 f"[{self.name}] DbDecryptRunner run step: {self._step}")
-            self._step_processs[self._step]()
+            process = self._step_processs[self._step]
+            with self._stage(process.__name__[len('_on_step_'):]):
+                process()
             self._step = self._step + 1
+        else:
+            self.stop()
+
+    def _connect_src(self):
+        # 任务停止时中止正在执行的迁移或导出语句
+        conn = sqlite.connect(self._src_db_path)
+        conn.set_progress_handler(interrupt_handler(self._cancel.is_set),
+                                  TASK_CANCEL_CHECK_OPS)
+        return conn
 
     def _on_step_migrate(self):
+        if self._cipher != 'legacy':
+            logger.debug(f"[{self.name}] DbDecryptRunner already migrated")
+            return
         logger.debug(f"[{self.name}] DbDecryptRunner migrate start")
-        conn = sqlite.connect(self._src_db_path)
+        conn = self._connect_src()
         cursor = conn.cursor()
         try:
             cursor.execute("PRAGMA key = '" + self._password + "';")
@@ -258,7 +974,7 @@ class DbDecryptRunner(TaskRunner):
 
     def _on_step_decrypt(self):
         logger.debug(f"[{self.name}] DbDecryptRunner decrypt start")
-        conn = sqlite.connect(self._src_db_path)
+        conn = self._connect_src()
         cursor = conn.cursor()
         try:
             cursor.execute("PRAGMA key = '" + self._password + "';")
@@ -272,15 +988,92 @@ class DbDecryptRunner(TaskRunner):
             cursor.execute("SELECT sqlcipher_export('db');")
             cursor.execute("DETACH DATABASE db;")
         except Exception as e:
-            logger.debug(f"[{self.name}] DbDecryptRunner decrypt error")
+            logger.debug(
+                f"[{self.name}] DbDecryptRunner decrypt error: {e!r}")
+            self._decrypt_error = True
+            self.stop()
         finally:
             cursor.close()
         logger.debug(f"[{self.name}] DbDecryptRunner decrypt end")
 
+    def _on_step_export(self):
+        logger.debug(f"[{self.name}] DbDecryptRunner export start")
+        try:
+            self._call(export_plaintext, self._src_db_path,
+                       self._dest_db_path, self._password,
+                       page_size = self._page_size,
+                       cache_size = self._cache_size,
+                       progress = self._on_pages, cipher = self._cipher)
+        except JobCancelled:
+            logger.debug(f"[{self.name}] DbDecryptRunner export cancelled")
+        except Exception as e:
+            logger.debug(
+                f"[{self.name}] DbDecryptRunner export error: {e!r}")
+            self._decrypt_error = True
+            self.stop()
+        logger.debug(f"[{self.name}] DbDecryptRunner export end")
+
+    def _on_step_index(self):
+        logger.debug(f"[{self.name}] DbDecryptRunner index start")
+        self._step_progress = (0, 0)
+        try:
+            self._call(build_index, self._dest_db_path,
+                       self._index_db_path, progress = self._on_rows)
+        except JobCancelled:
+            logger.debug(f"[{self.name}] DbDecryptRunner index cancelled")
+        except Exception as e:
+            # 索引失败不影响已解密的数据库
+            logger.debug(
+                f"[{self.name}] DbDecryptRunner index error: {e!r}")
+        logger.debug(f"[{self.name}] DbDecryptRunner index end")
+
+    def _call(self, func, *args, progress = None, **kwargs):
+        """执行解密或索引作业
+
+        进程池模式下作业在工作进程中执行，本线程只定期读取作业进度，
+        任务停止时取消作业；线程模式下作业按本任务的取消令牌中止
+
+        :param func: 作业方法，需为模块级方法
+        :param args: 位置参数
+        :param progress: 进度回调，参数为(已完成量, 总量)
+        :param kwargs: 关键字参数
+        :return: 作业方法的返回值
+        """
+        if self._executor == 'thread':
+            try:
+                return func(*args, progress = progress,
+                            cancelled = self._cancel.is_set, **kwargs)
+            except Exception as e:
+                if self._cancel.is_set():
+                    raise JobCancelled() from e
+                raise
+        self._job = get_pool().submit(func, *args, **kwargs)
+        try:
+            if self._stopped.is_set():
+                self._job.cancel()
+            while not self._job.wait(DECRYPT_POLL_INTERVAL):
+                progress(*self._job.progress())
+            progress(*self._job.progress())
+            return self._job.result()
+        finally:
+            self._job = None
+
+    def _on_pages(self, done, total):
+        self._pages = (done, total)
+        self._step_progress = (done, total)
+
+    def _on_rows(self, done, total):
+        self._step_progress = (done, total)
+
+    def _alive_mark(self):
+        if self._mode == 'single':
+            return self._step, self._step_progress[0]
+        return self._local_byte(self._temp_file[self._step])
+
     def is_task_alive(self):
         alive = True
         try:
-            size = self._local_byte(self._temp_file[self._step])
+            size = self._alive_mark()
             if size != self._temp_file_byte:
                 self._temp_file_byte = size
                 self._task_alive_timestamp = time.time()
@@ -297,9 +1090,33 @@ class DbDecryptRunner(TaskRunner):
     def is_kill_when_stop(self):
         return True
 
+    def alive_interval(self):
+        return max(1, self._task_alive_timeout / 2)
+
     def progress(self):
         logger.debug(f"[{self.name}] DbDecryptRunner progress start")
-        if self._step < len(self._step_processs):
+        if self._decrypt_error:
+            return {"projectName": self.name,
+                    "progress": -1,
+                    "filename": self._dest_db_filename,
+                    "step_name": _('No valid password found')
+                    if self._password_error else _('Decryption failed'),
+                    "path": self._dest_db_path,
+                    "byte": 0}
+        elif self._mode == 'single' and\
+                self._step < len(self._step_processs):
+            done, total = self._step_progress
+            p = (self._step + (done / total if total else 0)) /\
+                len(self._step_processs)
+            return {"projectName": self.name,
+                    "progress": min(float(str(p)[:6]), 0.9999),
+                    "filename": self._dest_db_filename,
+                    "step_name": self._step_names[self._step],
+                    "path": self._dest_db_path,
+                    "byte": self._pages[0] * DECRYPT_CIPHER_PAGE_SIZE,
+                    "pages": self._pages[0],
+                    "page_count": self._pages[1]}
+        elif self._step < len(self._step_processs):
             size = self._local_byte(self._temp_file[self._step])
             logger.debug(
                 f"[{self.name}] DbDecryptRunner progress size: {size}")
@@ -333,13 +1150,11 @@ class DbDecryptRunner(TaskRunner):
             return 0
 
     def _add_checker(self):
-        from server import _daemon
-        _daemon.add_task(HeartbeatRunner,
-                         f'Decrypt checker - {self.name}',
-                         callback = self._callback,
-                         params = {'command': "check_decrypt_progress",
-                                   'interval': 1,
-                                   'progress': self.progress})
+        from server import _ticker
+        _ticker.register(f'Decrypt checker - {self.name}',
+                         'check_decrypt_progress',
+                         params = {'progress': self.progress},
+                         owner = self)
 
 
 class ResPullRunner(TaskRunner):
@@ -351,14 +1166,33 @@ class ResPullRunner(TaskRunner):
         try:
             params = kwargs.get('params', None)
             assert params
-            self._device = params.get('device', None)
+            client = params.get('device', None)
+            assert client
+            self._device = client.device(params.get('serial', None))
             assert self._device
-            self._device = self._device.current_device
-            self._connection = self._device.sync()
+            self._serial = self._device.serial
+            self._bus = client.device_bus(self._serial)
 
             self._user = params.get('user', None)
             assert self._user
 
+            self._mode = params.get('mode', RES_PULL_MODE)
+            assert self._mode in ('stream', 'base64')
+            self._incremental = params.get('incremental',
+                                           RES_PULL_INCREMENTAL)
+            self._workers = int(params.get('workers', RES_PULL_WORKERS))
+            assert self._workers > 0
+            self._output = params.get('output', RES_OUTPUT)
+            assert self._output in ('files', 'archive')
+            self._encoding = params.get('encoding', RES_PULL_ENCODING)
+            assert self._encoding == 'auto' or\
+                self._encoding in ENCODINGS
+            # 归档只支持流模式，归档中的成员不使用存储
+            assert self._output == 'files' or self._mode == 'stream'
+            self._store = BlobStore() if params.get('store', RES_STORE)\
+                and self._output == 'files' else None
+            self._store_empty = True
+
             self._task_alive_timeout = params.get('timeout', 10)
             self._task_alive_byte = -1
             self._task_alive_timestamp = time.time()
@@ -366,33 +1200,55 @@ class ResPullRunner(TaskRunner):
             raise ResPullRunnerInitError()
 
         self._src_path = f'{MM_RES_DIR}/{self._user}/'
-        self._dest_path = f'data/{self.name}/Resource'
+        self._dest_path = f'data/{self.name}/Resource'\
+            if self._output == 'files' else f'data/{self.name}/Resource.pack'
+        self._archive = None
+        self._manifest_path = f'data/{self.name}/manifest.json'
+        self._manifest = Manifest()
+        self._manifest_lock = Lock()
         self._src_byte = -1
-        self._dest_byte = -1
+        self._dest_base_byte = 0  # 拉取前本地已有的字节数
+        self._pulled_byte = 0  # 本次已拉取的字节数
+        self._pulled_files = 0  # 本次已拉取的文件数
+        self._linked_files = 0  # 本次从存储中链接的文件数
+        self._counter_lock = Lock()
 
         self._folder = ['avatar', 'emoji', 'sfs', 'voice2', 'image2',
                         'video']
         self._folder_byte = []
-
-        self._step_names = [_('Counting')]
-        self._step_processs = [(getattr(self, '_run_step_count'), None)]
-        for folder in self._folder:
-            self._step_names.append(_('Pulling {}').format(folder))
-            self._step_processs.append(
-                (getattr(self, '_run_step_pull'), folder))
+        self._inventory = Inventory(self._folder)
+        self._pull_timestamp = None
+        self._folder_pulling = Counter()  # 各目录在拉取的分片数
+        self._folder_encoding = {}  # 各目录使用的编码
+        self._encodings = None  # 设备上可用的编码
+        self._folder_lock = Lock()
+
+        self._step_names = [_('Counting'), _('Pulling')]
+        self._step_processs = [(getattr(self, '_run_step_count'), None),
+                               (getattr(self, '_run_step_pull'), None)]
         self._step = 0
         self._index = 0
 
         self._pull_error = False
 
     def _on_before_runloop(self):
-        for folder in self._folder:
-            if not os.path.exists(self._dest_path + '/' + folder):
-                os.makedirs(self._dest_path + '/' + folder)
+        if self._output == 'archive':
+            self._archive = PackArchive(self._dest_path)
+        else:
+            for folder in self._folder:
+                if not os.path.exists(self._dest_path + '/' + folder):
+                    os.makedirs(self._dest_path + '/' + folder)
+        if self._incremental:
+            self._manifest = Manifest.load(self._manifest_path)
+            # 只有流方式按清单跳过未变化的文件，base64方式重新拉取全部
+            # 文件，已有字节数从零算起
+            if self._mode == 'stream':
+                self._dest_base_byte = self._manifest.total_byte()
         self._add_checker()
 
-    def _on_before_stop(self):
-        self._connection.close()
+    def _on_after_runloop(self):
+        if self._archive:
+            self._archive.close()
 
     def _on_runloop(self):
         try:
@@ -400,8 +1256,9 @@ class ResPullRunner(TaskRunner):
                 logger.debug(
                     f"[{self.name}] ResPullRunner run step: "
                     f"{self._step}")
-                self._step_processs[self._step][0](
-                    self._step_processs[self._step][1])
+                process, arg = self._step_processs[self._step]
+                with self._stage(process.__name__[len('_run_step_'):]):
+                    process(arg)
             else:
                 self.stop()
         except OSError as e:
@@ -411,10 +1268,12 @@ class ResPullRunner(TaskRunner):
             self._step = self._step + 1
 
     def _run_step_count(self, nothing):
-        for folder in self._folder:
-            self._folder_byte.append(
-                self._remote_byte(self._src_path + folder))
-        self._src_byte = sum(self._folder_byte)
+        self._inventory = Inventory.scan(self._device, self._src_path,
+                                         self._folder,
+                                         cancel = self._cancel)
+        self._folder_byte = [self._inventory.folder_byte(folder) // 1024
+                             for folder in self._folder]
+        self._src_byte = self._inventory.total_byte() // 1024
 
     # def _run_step_pull(self, folder):
     #     stream_base64 = self._device.shell(
@@ -428,10 +1287,279 @@ class ResPullRunner(TaskRunner):
     #         tar.extract(file_name, self._dest_path)
     #     tar.close()
 
-    def _run_step_pull(self, folder):
+    def _run_step_pull(self, nothing):
+        self._pull_timestamp = time.time()
+        if self._mode == 'stream':
+            self._pull_stream()
+        else:
+            for folder in self._folder:
+                with self._pulling(folder):
+                    self._pull_base64(folder)
+
+    def _pull_stream(self):
+        """以流方式并发拉取资源
+
+        各资源目录按计数时得到的设备清单，与本地清单比较出新增或变化的文件
+        (非增量模式下为全部文件)，再按大小和文件数切分为分片。每个分片在
+        设备上打包为tar流，经独立的exec连接原样传回并边接收边解出。
+        分片由一个有界线程池执行，同时占用的adb连接数不超过线程数。
+        各目录的tar流按协商出的编码压缩。
+        启用存储时，分片中较大的文件先在设备上计算md5，存储中已有的
+        内容直接链接，不再拉取
+
+        :return: 无
+        """
+        base = self._manifest if self._incremental else Manifest()
+        # 开始时存储为空则没有可链接的内容，不在设备上计算md5
+        self._store_empty = not self._store or self._store.is_empty()
+        executor = ThreadPoolExecutor(
+            max_workers = self._workers,
+            thread_name_prefix = f'{self.name}-pull')
+        try:
+            shards = []
+            for folder in self._folder:
+                remote = self._inventory[folder]
+                paths = base.diff(remote)
+                logger.debug(
+                    f"[{self.name}] ResPullRunner {folder} changed: "
+                    f"{len(paths)}/{len(remote)}")
+                if not self._archive:
+                    self._make_dirs(paths)
+                # 将被覆盖的旧文件不再计入已有字节数
+                stale_byte = sum(base.get(path)[0] for path in paths
+                                 if path in base)
+                with self._counter_lock:
+                    self._dest_base_byte = self._dest_base_byte -\
+                                           stale_byte
+                if not paths:
+                    continue
+                encoding = self._choose_encoding(folder, paths, remote)
+                for shard in self._split_shards(paths, remote):
+                    shards.append(executor.submit(self._pull_shard,
+                                                  folder, shard, remote,
+                                                  encoding))
+            for future in as_completed(shards):
+                future.result()
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+            if self._archive:
+                self._archive.flush()
+            with self._manifest_lock:
+                self._manifest.save(self._manifest_path)
+
+    def _choose_encoding(self, folder, paths, remote):
+        """选择目录的tar流编码
+
+        自动模式下优先使用本设备此目录有效期内的协商记录；没有记录且
+        变化的数据足够多时按样本实测各编码的端到端速率，取最快的并记录，
+        否则使用默认编码
+
+        :param folder: 资源目录
+        :param paths: 需拉取的文件路径列表
+        :param remote: 设备清单
+        :return: 编码
+        """
+        if self._encoding != 'auto':
+            return self._encoding
+        records = EncodingRecords()
+        encoding = records.get(self._serial, folder)
+        if encoding is None and sum(remote.get(path)[0] for path in paths)\
+                >= RES_ENCODING_MIN_BYTE:
+            try:
+                if self._encodings is None:
+                    self._encodings = probe_encodings(self._device)
+                encoding, rates = negotiate(self._device, self._src_path,
+                                            paths, self._encodings,
+                                            cancel = self._cancel)
+                logger.debug(f"[{self.name}] ResPullRunner {folder} "
+                             f"encoding rates: {rates}")
+                if encoding:
+                    records.put(self._serial, folder, encoding, rates)
+            except (OSError, RuntimeError) as e:
+                logger.debug(f"[{self.name}] ResPullRunner {folder} "
+                             f"negotiate failed: {e!r}")
+                encoding = None
+        encoding = encoding or DEFAULT_ENCODING
+        self._folder_encoding[folder] = encoding
+        logger.debug(f"[{self.name}] ResPullRunner {folder} encoding: "
+                     f"{encoding}")
+        return encoding
+
+    def _split_shards(self, paths, remote):
+        """按累计大小和文件数把文件列表切分为分片
+
+        :param paths: 文件路径列表
+        :param remote: 设备清单
+        :return: 分片生成器
+        """
+        shard, shard_byte = [], 0
+        for path in paths:
+            shard.append(path)
+            shard_byte = shard_byte + remote.get(path)[0]
+            if shard_byte >= RES_PULL_SHARD_BYTE or\
+                    len(shard) >= RES_PULL_SHARD_FILES:
+                yield shard
+                shard, shard_byte = [], 0
+        if shard:
+            yield shard
+
+    def _make_dirs(self, paths):
+        """预先建好解出文件所需的目录，避免多个分片并发解出时重复创建
+
+        :param paths: 文件路径列表
+        :return: 无
+        """
+        for folder in {os.path.dirname(path) for path in paths}:
+            os.makedirs(f'{self._dest_path}/{folder}', exist_ok = True)
+
+    def _pull_shard(self, folder, paths, remote, encoding):
+        if self._stopped.is_set():
+            return
+        with self._pulling(folder):
+            if self._store:
+                paths = self._link_stored(paths, remote)
+                if not paths:
+                    return
+            file_list = push_lines(self._device, paths)
+            try:
+                self._extract_stream(tar_command(self._src_path, file_list,
+                                                 encoding), remote)
+            finally:
+                self._device.shell(f'rm -f {file_list}')
+
+    def _link_stored(self, paths, remote):
+        """链接存储中已有内容的文件
+
+        :param paths: 文件路径列表
+        :param remote: 设备清单
+        :return: 仍需拉取的文件路径列表
+        """
+        candidates = [path for path in paths
+                      if remote.get(path)[0] >= RES_STORE_MIN_BYTE]
+        if not candidates or self._store_empty:
+            return paths
+        linked = set()
+        for path, digest in remote_md5(self._device, self._src_path,
+                                       candidates,
+                                       cancel = self._cancel).items():
+            if path not in remote or not self._store.has(digest):
+                continue
+            try:
+                self._store.link(digest, f'{self._dest_path}/{path}')
+            except OSError as e:
+                logger.debug(f"[{self.name}] ResPullRunner link {path} "
+                             f"failed: {e!r}")
+                continue
+            linked.add(path)
+            size, mtime = remote.get(path)
+            with self._manifest_lock:
+                self._manifest.update(path, size, mtime)
+            self._add_pulled(size, linked = True)
+        return [path for path in paths if path not in linked]
+
+    @contextmanager
+    def _pulling(self, folder):
+        with self._folder_lock:
+            self._folder_pulling[folder] += 1
+        try:
+            yield
+        finally:
+            with self._folder_lock:
+                self._folder_pulling[folder] -= 1
+
+    def _pulling_folders(self):
+        with self._folder_lock:
+            return [folder for folder in self._folder
+                    if self._folder_pulling[folder] > 0]
+
+    def _extract_stream(self, cmd, remote = None):
+        """执行打包命令并逐个解出tar流中的成员
+
+        :param cmd: 在设备上输出tar流的命令
+        :param remote: 设备清单，解出的文件会按其记入本地清单
+        :return: 无
+        """
+        stream = exec_out(self._device, cmd, cancel = self._cancel)
+        try:
+            with tarfile.open(fileobj = stream, mode = 'r|*') as tar:
+                for member in tar:
+                    self._write_member(tar, member)
+                    if member.isfile():
+                        self._add_pulled(member.size)
+                    entry = remote.get(member.name) if remote else None
+                    if entry and member.isfile():
+                        with self._manifest_lock:
+                            self._manifest.update(member.name, *entry)
+        except (tarfile.ReadError, tarfile.StreamError):
+            pass
+        finally:
+            stream.close()
+
+    def _write_member(self, tar, member):
+        """保存tar流中的一个成员
+
+        归档模式下文件追加到包文件，目录等其他成员忽略；文件模式下解出到
+        资源目录并加入存储
+
+        :param tar: tar流
+        :param member: 成员
+        :return: 无
+        """
+        if self._archive:
+            if member.isfile():
+                self._archive.add(member.name, tar.extractfile(member),
+                                  member.size, int(member.mtime))
+            return
+        if member.isfile():
+            # 先删除旧文件，以免原地覆盖与存储共用的内容，未启用存储时
+            # 旧文件也可能是之前链接到存储的
+            target = f'{self._dest_path}/{member.name}'
+            if os.path.lexists(target):
+                os.remove(target)
+            if self._store and member.size >= RES_STORE_MIN_BYTE:
+                self._store_member(tar, member, target)
+                return
+        tar.extract(member, self._dest_path)
+
+    def _store_member(self, tar, member, target):
+        """解出文件并加入存储
+
+        写入时同时计算md5，加入存储时不再重读文件
+
+        :param tar: tar流
+        :param member: 成员
+        :param target: 本地文件
+        :return: 无
+        """
+        md5 = hashlib.md5()
+        source = tar.extractfile(member)
+        with open(target, 'wb') as f:
+            for block in iter(lambda: source.read(1024 * 1024), b''):
+                md5.update(block)
+                f.write(block)
+        os.chmod(target, member.mode & 0o7777)
+        os.utime(target, (member.mtime, member.mtime))
+        try:
+            self._store.add(target, md5.hexdigest())
+        except OSError as e:
+            logger.debug(f"[{self.name}] ResPullRunner store "
+                         f"{member.name} failed: {e!r}")
+
+    def _add_pulled(self, byte, linked = False):
+        with self._counter_lock:
+            self._pulled_byte = self._pulled_byte + byte
+            self._pulled_files = self._pulled_files + 1
+            if linked:
+                self._linked_files = self._linked_files + 1
+        metrics.observe_transfer(self, 'linked' if linked else 'resource',
+                                 byte, 1)
+
+    def _pull_base64(self, folder):
         subpaths = self._device.shell(
             f"ls {self._src_path}{folder}").split('\r\n')
         for path in subpaths:
+            if self._stopped.is_set():
+                return
             stream_base64 = self._device.shell(
                 f"cd {self._src_path}{folder} && busybox tar czf - "
                 f"{path} 2>/dev/null | busybox base64")
@@ -440,9 +1568,10 @@ class ResPullRunner(TaskRunner):
             try:
                 tar = tarfile.open(fileobj = stream_file,
                                    mode = 'r' or 'r:*')
-                file_names = tar.getnames()
-                for file in file_names:
-                    tar.extract(file, f'{self._dest_path}/{folder}')
+                for member in tar.getmembers():
+                    tar.extract(member, f'{self._dest_path}/{folder}')
+                    if member.isfile():
+                        self._add_pulled(member.size)
                 tar.close()
             except tarfile.ReadError:
                 pass
@@ -450,7 +1579,7 @@ class ResPullRunner(TaskRunner):
     def is_task_alive(self):
         alive = True
         try:
-            size = self._dest_byte
+            size = self._pulled_byte
             if size != self._task_alive_byte:
                 logger.debug(
                     f"[{self.name}] ResPullRunner update timestamp "
@@ -473,13 +1602,30 @@ class ResPullRunner(TaskRunner):
         finally:
             return alive
 
+    def slot_keys(self):
+        return _device_slot_keys(self._serial, self._bus)
+
     def is_kill_when_stop(self):
         return True
 
+    def alive_interval(self):
+        return max(1, self._task_alive_timeout / 2)
+
     def progress(self):
-        self._dest_byte = self._local_byte(self._dest_path)
+        dest_byte = self.dest_byte
         if self._stopped.is_set():
-            if self._step < len(self._step_processs):  # timeout
+            if self.is_pull_error():
+                logger.debug(f"[{self.name}] ResPullRunner error")
+                return {"projectName": self.name,
+                        "progress": -1,
+                        "folder": '',
+                        "step": -1,
+                        "step_name": _('Resource pull failed'),
+                        "path": '',
+                        "byte": 0,
+                        "current": 0,
+                        "files": self._pulled_files}
+            elif self._step < len(self._step_processs):  # timeout
                 logger.debug(f"[{self.name}] ResPullRunner timeout")
                 return {"projectName": self.name,
                         "progress": 0,
@@ -488,7 +1634,8 @@ class ResPullRunner(TaskRunner):
                         "step_name": _('Resouce pull timeout'),
                         "path": '',
                         "byte": 0,
-                        "current": 0}
+                        "current": 0,
+                        "files": self._pulled_files}
             else:  # finish
                 logger.debug(
                     f"[{self.name}] ResPullRunner progress 100%")
@@ -498,20 +1645,29 @@ class ResPullRunner(TaskRunner):
                         "step": -1,
                         "step_name": _('Resouce pull completed'),
                         "path": self._dest_path,
-                        "byte": self._dest_byte,
-                        "current": self._dest_byte}
+                        "byte": dest_byte,
+                        "current": dest_byte,
+                        "files": self._pulled_files,
+                        "linked_files": self._linked_files}
         else:
             if 0 < self._step < len(self._step_processs):  # pulling
-                p = float(str(self._dest_byte / self._src_byte)[:6])
+                p = float(str(dest_byte / self._src_byte)[:6])\
+                    if self._src_byte > 0 else 0
+                folders = ', '.join(self._pulling_folders())
                 return {"projectName": self.name,
                         "progress": p,
-                        "folder": self._folder[self._step - 1],
+                        "folder": folders,
                         "step": self._step,
-                        "step_name": self._step_names[self._step],
-                        "path": self._dest_path + self._folder[
-                            self._step - 1],
+                        "step_name": _('Pulling {}').format(folders)
+                        if folders else self._step_names[self._step],
+                        "path": self._dest_path,
                         'byte': self._src_byte,
-                        "current": self._dest_byte}
+                        "current": dest_byte,
+                        "files": self._pulled_files,
+                        "linked_files": self._linked_files,
+                        "total_files": self._inventory.total_files(),
+                        "encoding": dict(self._folder_encoding),
+                        "eta": self.eta()}
             elif self._step == 0:  # init
                 return {"projectName": self.name,
                         "progress": 0,
@@ -520,18 +1676,38 @@ class ResPullRunner(TaskRunner):
                         "step_name": self._step_names[self._step],
                         "path": '',
                         "byte": 0,
-                        "current": 0}
+                        "current": 0,
+                        "files": 0}
 
-    def is_pull_error(self):
-        return self._pull_db_error
+    @property
+    def dest_byte(self):
+        """本地资源大小(KB)
 
-    def _local_byte(self, path):
-        return int(subprocess.check_output(['du', '-sk', path]).split()[
-                       0].decode('utf-8'))
+        由拉取前已有的字节数和拉取时累计的字节数得出，不遍历本地目录
 
-    def _remote_byte(self, path):
-        return int(
-            self._device.shell(f"du -sk {path}").split()[0])
+        :return: 千字节数
+        """
+        return (self._dest_base_byte + self._pulled_byte) // 1024
+
+    @property
+    def pulled_files(self):
+        return self._pulled_files
+
+    def eta(self):
+        """按本次拉取的平均速度估算剩余秒数
+
+        :return: 剩余秒数，尚无法估算时为-1
+        """
+        if not self._pull_timestamp or not self._pulled_byte:
+            return -1
+        elapsed = max(time.time() - self._pull_timestamp, 0.001)
+        speed = self._pulled_byte / elapsed
+        remain = self._src_byte * 1024 - self._dest_base_byte -\
+            self._pulled_byte
+        return int(max(0, remain) / speed)
+
+    def is_pull_error(self):
+        return self._pull_error
 
     def _get_stop_success_message(self):
         return _('Pull has been stopped')
@@ -540,13 +1716,118 @@ class ResPullRunner(TaskRunner):
         return _('Stop pull was failed')
 
     def _add_checker(self):
-        from server import _daemon
-        _daemon.add_task(HeartbeatRunner,
-                         f'Resource progress checker - {self.name}',
-                         callback = self._callback,
-                         params = {'command': "check_resource_progress",
-                                   'interval': 1,
-                                   'progress': self.progress})
+        from server import _ticker
+        _ticker.register(f'Resource progress checker - {self.name}',
+                         'check_resource_progress',
+                         params = {'progress': self.progress},
+                         owner = self)
+
+
+class ExportRunner(TaskRunner):
+    """消息导出运行器
+
+    把解密后数据库中的消息、联系人和群聊流式导出为JSON Lines、CSV或
+    静态HTML
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        try:
+            params = kwargs.get('params', None)
+            assert params
+            self._format = params.get('format', EXPORT_FORMAT)
+            assert self._format in FORMATS
+            self._tables = tuple(params.get('tables', None) or TABLES)
+            assert all(table in TABLES for table in self._tables)
+
+            self._task_alive_timeout = params.get('timeout', 30)
+            self._task_alive_timestamp = time.time()
+        except AssertionError:
+            raise ExportRunnerInitError()
+
+        self._src_db_path = f'data/{self.name}/{MM_DB_DECODE_NAME}.db'
+        self._dest_path = f'data/{self.name}/export/{self._format}'
+        self._rows = (0, 0)  # (已导出行数, 总行数)
+        self._task_alive_rows = -1
+        self._finished = False
+        self._export_error = False
+
+    def _on_before_runloop(self):
+        self._add_checker()
+
+    def _on_runloop(self):
+        logger.debug(f"[{self.name}] ExportRunner export start")
+        try:
+            with self._stage(f'export_{self._format}'):
+                export_messages(self._src_db_path, self._dest_path,
+                                self._format, self._tables,
+                                progress = self._on_rows,
+                                cancelled = self._cancel.is_set)
+            self._finished = True
+        except Exception as e:
+            if not self._cancel.is_set():
+                logger.debug(
+                    f"[{self.name}] ExportRunner export error: {e!r}")
+                self._export_error = True
+        finally:
+            logger.debug(f"[{self.name}] ExportRunner export end")
+            self.stop()
+
+    def _on_rows(self, done, total):
+        self._rows = (done, total)
+
+    def is_task_alive(self):
+        alive = True
+        try:
+            if self._rows[0] != self._task_alive_rows:
+                self._task_alive_rows = self._rows[0]
+                self._task_alive_timestamp = time.time()
+            elif time.time() - self._task_alive_timestamp >\
+                    self._task_alive_timeout:
+                alive = False
+        except Exception:
+            alive = False
+        finally:
+            return alive
+
+    def is_kill_when_stop(self):
+        return True
+
+    def alive_interval(self):
+        return max(1, self._task_alive_timeout / 2)
+
+    def progress(self):
+        done, total = self._rows
+        if self._export_error:
+            return {"projectName": self.name,
+                    "progress": -1,
+                    "format": self._format,
+                    "step_name": _('Export failed'),
+                    "path": self._dest_path,
+                    "rows": done}
+        elif self._finished:
+            return {"projectName": self.name,
+                    "progress": 1,
+                    "format": self._format,
+                    "step_name": _('Export completed'),
+                    "path": self._dest_path,
+                    "rows": done}
+        else:
+            p = done / total if total else 0
+            return {"projectName": self.name,
+                    "progress": min(float(str(p)[:6]), 0.9999),
+                    "format": self._format,
+                    "step_name": _('Exporting'),
+                    "path": self._dest_path,
+                    "rows": done,
+                    "total_rows": total}
+
+    def _add_checker(self):
+        from server import _ticker
+        _ticker.register(f'Export checker - {self.name}',
+                         'check_export_progress',
+                         params = {'progress': self.progress},
+                         owner = self)
 
 
 task_categories = {
@@ -554,5 +1835,15 @@ task_categories = {
     'once': OnceRunner,
     'pull_db': DbPullRunner,
     'decrypt': DbDecryptRunner,
-    'pull_res': ResPullRunner
+    'pull_res': ResPullRunner,
+    'export': ExportRunner
 }
+
+# 异步模式下心跳、一次性命令和数据库拉取在事件循环中运行，
+# 解密和资源拉取仍使用线程
+if TASK_EXECUTION_MODE == 'asyncio':
+    task_categories.update({
+        'heartbeat': AsyncHeartbeatRunner,
+        'once': AsyncOnceRunner,
+        'pull_db': AsyncDbPullRunner
+    })
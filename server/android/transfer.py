@@ -0,0 +1,212 @@
+import io
+import logging
+import os
+import socket
+import tempfile
+import uuid
+
+from adb.sync import Sync as AdbSync
+
+from config import LOG_NAME
+from ..metrics import adb_request_seconds
+
+logger = logging.getLogger(LOG_NAME)
+
+
+class ExecStream(io.RawIOBase):
+    """设备原始执行流
+
+    通过adb的exec服务在设备上执行命令，命令的标准输出不经过pty转换，
+    以二进制只读文件对象的方式按块读取，无需base64编码也无需整体缓存
+    """
+
+    def __init__(self, device, cmd, timeout = None, cancel = None):
+        """
+        :param device: adb设备
+        :param cmd: 在设备上执行的命令
+        :param timeout: 连接超时
+        :param cancel: 取消令牌，取消时中断连接，读取抛出InterruptedError
+        """
+        super().__init__()
+        self._cmd = cmd
+        self._cancel = cancel
+        self._cancel_key = None
+        with adb_request_seconds.time(request = 'exec'):
+            self._connection = device.create_connection(timeout = timeout)
+            try:
+                self._connection.send(f'exec:{cmd}')
+            except Exception:
+                self._connection.close()
+                raise
+        if cancel:
+            self._cancel_key = cancel.register(
+                lambda: interrupt(self._connection))
+        logger.debug(f'exec stream open: {cmd}')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._connection.socket.recv_into(buffer)
+        if size == 0 and self._cancel and self._cancel.is_set():
+            # 被取消中断的流不能当作正常结束
+            raise InterruptedError(f'exec stream cancelled: {self._cmd}')
+        return size
+
+    def close(self):
+        if not self.closed:
+            if self._cancel:
+                self._cancel.unregister(self._cancel_key)
+            self._connection.close()
+            logger.debug(f'exec stream close: {self._cmd}')
+        super().close()
+
+
+def interrupt(connection):
+    """中断连接上阻塞的读写
+
+    只关闭连接的收发，连接本身仍由使用方在原线程中关闭，避免在其他线程
+    关闭正在使用的套接字
+
+    :param connection: adb连接
+    :return: 无
+    """
+    try:
+        connection.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def exec_out(device, cmd, buffer_size = 65536, timeout = None,
+             cancel = None):
+    """打开设备命令的二进制输出流
+
+    :param device: adb设备
+    :param cmd: 在设备上执行的命令
+    :param buffer_size: 读取缓冲区大小
+    :param timeout: 连接超时
+    :param cancel: 取消令牌
+    :return: 带缓冲的只读文件对象
+    """
+    return io.BufferedReader(ExecStream(device, cmd, timeout = timeout,
+                                        cancel = cancel),
+                             buffer_size = buffer_size)
+
+
+def push_lines(device, lines):
+    """把文本行写入设备上的临时文件
+
+    用于向设备传递较长的文件列表，避免命令行超长
+
+    :param device: adb设备
+    :param lines: 文本行
+    :return: 设备上的临时文件路径
+    """
+    dest = f'{AdbSync.TEMP_PATH}/wechatBackup-{uuid.uuid4().hex}.list'
+    with tempfile.NamedTemporaryFile('w', suffix = '.list',
+                                     delete = False) as f:
+        f.write('\n'.join(lines) + '\n')
+    try:
+        connection = device.sync()
+        with connection:
+            AdbSync(connection).push(f.name, dest, 0o644)
+    finally:
+        os.remove(f.name)
+    return dest
+
+
+def read_chunk(device, path, index, chunk_byte, timeout = None,
+               cancel = None):
+    """读取设备文件的一个分块
+
+    :param device: adb设备
+    :param path: 设备上的文件路径
+    :param index: 分块序号
+    :param chunk_byte: 分块大小
+    :param timeout: 连接超时
+    :param cancel: 取消令牌
+    :return: 分块数据，最后一块可能不足chunk_byte
+    """
+    with exec_out(device,
+                  f'busybox dd if={path} bs={chunk_byte} skip={index} '
+                  f'count=1 2>/dev/null', timeout = timeout,
+                  cancel = cancel) as stream:
+        return stream.read()
+
+
+def remote_file_md5(device, path, cancel = None):
+    """在设备上计算整个文件的md5
+
+    :param device: adb设备
+    :param path: 设备上的文件路径
+    :param cancel: 取消令牌
+    :return: 十六进制md5，读取失败时为空
+    """
+    with exec_out(device, f'busybox md5sum {path} 2>/dev/null',
+                  cancel = cancel) as stream:
+        output = stream.read().split()
+    return output[0].decode('ascii') if output else ''
+
+
+def remote_md5(device, cwd, paths, cancel = None):
+    """在设备上批量计算文件的md5
+
+    :param device: adb设备
+    :param cwd: 工作目录，paths为相对此目录的路径
+    :param paths: 文件路径列表
+    :param cancel: 取消令牌
+    :return: {路径: 十六进制md5}，读取失败的文件不在结果中
+    """
+    file_list = push_lines(device, paths)
+    digests = {}
+    try:
+        with exec_out(device,
+                      f'cd {cwd} && busybox xargs busybox md5sum '
+                      f'< {file_list} 2>/dev/null',
+                      cancel = cancel) as stream:
+            for line in stream:
+                try:
+                    digest, path = line.decode('utf-8').rstrip(
+                        '\r\n').split('  ', 1)
+                    digests[path] = digest
+                except ValueError:
+                    pass
+    finally:
+        device.shell(f'rm -f {file_list}')
+    return digests
+
+
+def block_md5_cmd(path, block_byte, count, start = 0):
+    """生成在设备上逐块计算文件md5的命令，每块输出一行
+
+    :param path: 设备上的文件路径
+    :param block_byte: 分块大小
+    :param count: 分块数
+    :param start: 起始分块序号
+    :return: 命令
+    """
+    return f'i={start}; while [ $i -lt {count} ]; do '\
+           f'busybox dd if={path} bs={block_byte} skip=$i count=1 '\
+           f'2>/dev/null | busybox md5sum; i=$((i+1)); done'
+
+
+def remote_block_md5(device, path, block_byte, count, start = 0,
+                     timeout = None, cancel = None):
+    """在设备上逐块计算文件的md5
+
+    一次执行完成所有分块，结果按块的顺序逐行返回。设备边计算边输出，
+    与分块读取同时进行时两者读到的多是页缓存中的同一份数据
+
+    :param device: adb设备
+    :param path: 设备上的文件路径
+    :param block_byte: 分块大小
+    :param count: 分块数
+    :param start: 起始分块序号
+    :param timeout: 连接超时
+    :param cancel: 取消令牌
+    :return: 十六进制md5生成器
+    """
+    with exec_out(device, block_md5_cmd(path, block_byte, count, start),
+                  timeout = timeout, cancel = cancel) as stream:
+        for line in stream:
+            yield line.split()[0].decode('ascii')
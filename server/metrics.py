@@ -0,0 +1,339 @@
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+from urllib.parse import unquote
+
+from config import LOG_NAME
+
+logger = logging.getLogger(LOG_NAME)
+
+# 耗时直方图的默认分桶(秒)，覆盖adb往返到整个备份阶段
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 300, 900, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+class Metric:
+    """指标
+
+    按标签值分别计数，标签值按声明的标签名顺序组成元组作为键
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels = ()):
+        """
+        :param name: 指标名称
+        :param help: 说明
+        :param labels: 标签名
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """
+        :return: (后缀, 标签对, 值)列表
+        """
+        with self._lock:
+            return [('', tuple(zip(self.labels, key)), value)
+                    for key, value in sorted(self._values.items())]
+
+    def remove(self, **labels):
+        """删除匹配标签的值，用于清理已结束任务的指标
+
+        :param labels: 需匹配的标签
+        :return: 无
+        """
+        with self._lock:
+            for key in list(self._values):
+                if all(key[self.labels.index(name)] == str(value)
+                       for name, value in labels.items()):
+                    del self._values[key]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels = (), collect = None):
+        """
+        :param collect: 读取时调用的方法，返回{标签值元组: 值}，
+        为空时使用set设置的值
+        """
+        super().__init__(name, help, labels)
+        self._collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self._collect is None:
+            return super().samples()
+        try:
+            values = self._collect()
+        except Exception as e:
+            logger.debug(f'metric {self.name} collect error: {e!r}')
+            return []
+        return [('', tuple(zip(self.labels, key)), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ((0,) * len(self.buckets), 0, 0))
+            self._values[key] = (
+                tuple(c + 1 if value <= bound else c
+                      for c, bound in zip(counts, self.buckets)),
+                total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """以with语句计时
+
+        :param labels: 标签
+        :return: 无
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, (counts, total, count) in items:
+            pairs = tuple(zip(self.labels, key))
+            for bound, bucket in zip(self.buckets, counts):
+                result.append(('_bucket', pairs + (('le', f'{bound}'),),
+                               bucket))
+            result.append(('_bucket', pairs + (('le', '+Inf'),), count))
+            result.append(('_sum', pairs, total))
+            result.append(('_count', pairs, count))
+        return result
+
+
+class MetricsRegistry:
+    """指标注册表
+
+    汇总服务中的所有指标，输出为Prometheus文本格式或可经socket推送的
+    字典
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            assert metric.name not in self._metrics
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels = ()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels = (), collect = None):
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def remove(self, **labels):
+        """从带有这些标签的指标中删除匹配的值
+
+        :param labels: 需匹配的标签
+        :return: 无
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            if all(name in metric.labels for name in labels):
+                metric.remove(**labels)
+
+    def render(self):
+        """输出Prometheus文本格式
+
+        :return: 文本
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, pairs, value in metric.samples():
+                labels = ','.join(f'{name}="{_escape(label)}"'
+                                  for name, label in pairs)
+                if labels:
+                    labels = '{' + labels + '}'
+                lines.append(f'{metric.name}{suffix}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """输出可序列化为JSON的字典
+
+        直方图只给出次数和总和
+
+        :return: {指标名称: [{'labels', 'value'}]}
+        """
+        result = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            items = []
+            for suffix, pairs, value in metric.samples():
+                if suffix == '_bucket':
+                    continue
+                labels = dict(pairs)
+                if suffix:
+                    labels['stat'] = suffix[1:]
+                items.append({'labels': labels, 'value': value})
+            result[metric.name] = items
+        return result
+
+
+registry = MetricsRegistry()
+
+# 任务
+task_stage_seconds = registry.histogram(
+    'wechatbackup_task_stage_seconds',
+    'Duration of task stages by runner',
+    ('runner', 'stage'))
+task_stage_seconds_total = registry.counter(
+    'wechatbackup_task_stage_seconds_total',
+    'Time spent in each stage by task',
+    ('task', 'stage'))
+transfer_bytes = registry.counter(
+    'wechatbackup_transfer_bytes_total',
+    'Bytes transferred by task',
+    ('task', 'kind'))
+transfer_files = registry.counter(
+    'wechatbackup_transfer_files_total',
+    'Files transferred by task',
+    ('task', 'kind'))
+transfer_bytes_rate = registry.gauge(
+    'wechatbackup_transfer_bytes_per_second',
+    'Average transfer rate of running tasks in bytes per second',
+    ('task', 'kind'))
+transfer_files_rate = registry.gauge(
+    'wechatbackup_transfer_files_per_second',
+    'Average transfer rate of running tasks in files per second',
+    ('task', 'kind'))
+# adb
+adb_request_seconds = registry.histogram(
+    'wechatbackup_adb_request_seconds',
+    'Duration of adb shell round trips and connection setups',
+    ('request',))
+# 守护线程
+_LAG_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1, 5)
+daemon_event_lag_seconds = registry.histogram(
+    'wechatbackup_daemon_event_lag_seconds',
+    'Delay between the due time and the execution of daemon events',
+    buckets = _LAG_BUCKETS)
+task_queue_seconds = registry.histogram(
+    'wechatbackup_task_queue_seconds',
+    'Time from adding a task to starting it',
+    ('runner',))
+task_slot_wait_seconds = registry.histogram(
+    'wechatbackup_task_slot_wait_seconds',
+    'Time tasks waited for a free concurrency slot',
+    ('runner',))
+daemon_tasks = registry.gauge(
+    'wechatbackup_daemon_tasks',
+    'Tasks known to the daemon by state',
+    ('state',))
+
+_transfers = {}  # (任务, 类别) -> [开始时间, 字节数, 文件数]
+_transfers_lock = Lock()
+
+
+def _task_name(task):
+    return unquote(task if isinstance(task, str) else task.name)
+
+
+def observe_stage(task, stage, seconds):
+    """记录任务一个阶段的耗时
+
+    :param task: 任务
+    :param stage: 阶段名
+    :param seconds: 秒数
+    :return: 无
+    """
+    task_stage_seconds.observe(seconds, runner = type(task).__name__,
+                               stage = stage)
+    task_stage_seconds_total.inc(seconds, task = _task_name(task),
+                                 stage = stage)
+
+
+def observe_transfer(task, kind, byte, files = 0):
+    """记录任务传输的数据量，并按首次传输以来的时间更新平均速率
+
+    :param task: 任务或任务名称
+    :param kind: 类别，如database、resource
+    :param byte: 字节数
+    :param files: 文件数
+    :return: 无
+    """
+    name = _task_name(task)
+    transfer_bytes.inc(byte, task = name, kind = kind)
+    if files:
+        transfer_files.inc(files, task = name, kind = kind)
+    now = time.monotonic()
+    with _transfers_lock:
+        state = _transfers.setdefault((name, kind), [now, 0, 0])
+        state[1] = state[1] + byte
+        state[2] = state[2] + files
+        start, total_byte, total_files = state
+    elapsed = now - start
+    if elapsed > 0:
+        transfer_bytes_rate.set(total_byte / elapsed, task = name,
+                                kind = kind)
+        transfer_files_rate.set(total_files / elapsed, task = name,
+                                kind = kind)
+
+
+def forget_task(task):
+    """清除已结束任务的速率，累计值保留
+
+    :param task: 任务或任务名称
+    :return: 无
+    """
+    name = _task_name(task)
+    with _transfers_lock:
+        for key in [key for key in _transfers if key[0] == name]:
+            del _transfers[key]
+    transfer_bytes_rate.remove(task = name)
+    transfer_files_rate.remove(task = name)
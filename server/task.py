@@ -1,11 +1,19 @@
+import asyncio
+import functools
+import heapq
+import importlib
+import itertools
 import logging
 import time
+from collections import Counter
+from contextlib import contextmanager
 from urllib.parse import unquote as urldecode
-from threading import Thread, Event
+from threading import Thread, Event, Condition, Lock, RLock
 
 from flask_babel import gettext as _
 
-from config import LOG_NAME
+from config import LOG_NAME, PROGRESS_TICK_INTERVAL, TASK_SLOT_LIMITS
+from . import metrics
 
 logger = logging.getLogger(LOG_NAME)
 
@@ -16,69 +24,122 @@ class TaskRunnerInitError(RuntimeError):
 
 class TaskDaemon(Thread):
     """任务守护线程
+
+    守护线程按事件调度任务：加入任务、任务停止、存活检查到期都会作为
+    定时事件放入调度堆，按(时间, 优先级, 加入顺序)依次执行，没有到期
+    事件时一直休眠，不再每秒轮询。任务可声明占用的并发名额，名额已满
+    的任务排队等待，直到其他任务停止后释放名额
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, slot_limits = None, **kwargs):
         super().__init__(**kwargs)
         self._exit = Event()  # 守护线程退出标识
         self._tasks = {}  # 所有任务列表
         self._tasks_running = []  # 在运行任务列表
+        self._condition = Condition(RLock())  # 任务列表和调度堆的锁
+        self._schedule = []  # 调度堆
+        self._sequence = itertools.count()  # 同时同优先级事件的先后顺序
+        self._loop = None  # 异步任务的事件循环线程，首次使用时启动
+        # 各类名额的上限，没有列出的类别不限
+        self._slot_limits = dict(TASK_SLOT_LIMITS
+                                 if slot_limits is None else slot_limits)
+        self._slots = Counter()  # 名额键 -> 占用数
+        self._holding = {}  # 任务 -> 占用的名额键
+        self._waiting = []  # 等待名额的任务
+        self._added_at = {}  # 任务 -> 加入时间
+        self._waiting_since = {}  # 任务 -> 开始等待名额的时间
 
     def run(self):
         logger.debug('daemon run start')
         while not self._exit.is_set():
-            # 清理在运行任务列表中已结束的任务
-            self._tasks_running[:] = [
-                t for t in self._tasks_running if t]
-            # 每个任务按加入的顺序执行
-            for i in range(len(self._tasks_running)):
-                task = self._tasks_running[i]
-                # 如任务已被杀死则忽略
-                if not task:
-                    continue
-                # 如是新加入的任务则启动任务
-                if not task._started.is_set():
-                    task.start()
-                # 如任务没有存活则停止任务
-                if not task.is_task_alive():
-                    logger.debug('daemon run stop')
-                    task.stop()
-                # 如果任务已经停止则清理任务
-                if task._stopped.is_set():
-                    if task.is_kill_when_stop():
-                        # 杀掉任务
-                        self.kill_task(task.name)
-                    else:
-                        # 设置为待清理
-                        self._tasks_running[i] = None
-            # 每秒轮询
-            time.sleep(1)
+            with self._condition:
+                while not self._exit.is_set():
+                    timeout = self._schedule[0][0] - time.monotonic()\
+                        if self._schedule else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if self._exit.is_set():
+                    break
+                when, _, _, func, args = heapq.heappop(self._schedule)
+            metrics.daemon_event_lag_seconds.observe(
+                time.monotonic() - when)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.debug(f'daemon event error: {e!r}')
+            self._report()
         logger.debug('daemon run finish')
 
+    def call_later(self, delay, func, *args, priority = 0):
+        """在守护线程中延时执行
+
+        :param delay: 延时秒数
+        :param func: 执行的方法
+        :param args: 方法参数
+        :param priority: 优先级，数值小的先执行
+        :return: 无
+        """
+        with self._condition:
+            heapq.heappush(self._schedule,
+                           (time.monotonic() + delay, priority,
+                            next(self._sequence), func, args))
+            self._condition.notify()
+
     def exit(self):
         '''退出守护线程
 
         :return:
         '''
         logger.debug('daemon exit start')
-        # 结束所有在运行的任务
-        for task in self._tasks_running:
+        with self._condition:
+            tasks, self._tasks_running = self._tasks_running, []
+        # 结束所有在运行的任务。异步任务的停止要等事件循环执行完停止
+        # 钩子，停止监听又要获取锁，因此不能持有锁停止
+        for task in tasks:
             task.stop()
-        # 清空任务列表和在运行任务列表
-        self._tasks = {}
-        self._tasks_running = []
-        # 设置退出标识
-        self._exit.set()
+        with self._condition:
+            # 清空任务列表、在运行任务列表、名额和调度堆
+            self._tasks = {}
+            self._tasks_running = []
+            self._slots.clear()
+            self._holding = {}
+            self._waiting = []
+            self._added_at = {}
+            self._waiting_since = {}
+            self._schedule = []
+            # 设置退出标识
+            self._exit.set()
+            self._condition.notify()
+            if self._loop:
+                self._loop.exit()
         logger.debug('daemon exit finish')
 
+    def loop(self):
+        """获取运行异步任务的事件循环线程
+
+        :return: 事件循环线程
+        """
+        with self._condition:
+            if self._loop is None:
+                self._loop = EventLoopThread(name = 'Task event loop',
+                                             daemon = True)
+                self._loop.start()
+            return self._loop
+
     def add_task(self, class_, name, callback = None, params = None,
-                 **kwargs):
+                 priority = 0, **kwargs):
         task = class_(name = name, callback = callback,
                       params = params, **kwargs)
-        if self.has_task(name):
-            return False
-        self._tasks[name] = task
-        self._tasks_running.append(task)
+        with self._condition:
+            if self.has_task(name):
+                return False
+            self._tasks[name] = task
+            self._tasks_running.append(task)
+            self._added_at[task] = time.monotonic()
+            task.set_stop_listener(self._on_task_stopped)
+            self.call_later(0, self._start_task, task,
+                            priority = priority)
         return True
 
     def has_task(self, name):
@@ -86,15 +147,25 @@ class TaskDaemon(Thread):
 
     def kill_task(self, name):
         try:
-            task = self._tasks.get(name, None)
-            assert task
+            with self._condition:
+                task = self._tasks.get(name, None)
+                assert task
+                if task in self._tasks_running:
+                    self._tasks_running.remove(task)
+                if task in self._waiting:
+                    self._waiting.remove(task)
+                self._added_at.pop(task, None)
+                self._waiting_since.pop(task, None)
+            # 先移出在运行任务列表，停止事件不再重复清理；停止时不持有锁，
+            # 原因同exit
             if task.is_task_alive():
                 task.stop()
             task.on_kill()
-            if task in self._tasks_running:
-                index = self._tasks_running.index(task)
-                self._tasks_running[index] = None
-            self._tasks.pop(name)
+            self._release_slots(task)
+            with self._condition:
+                if self._tasks.get(name, None) is task:
+                    self._tasks.pop(name)
+            metrics.forget_task(task)
             return True
         except AssertionError:
             return True
@@ -105,7 +176,7 @@ class TaskDaemon(Thread):
         return [{'name': task.name,
                  'running': True if task in self._tasks_running else
                  False}
-                for task in self._tasks]
+                for task in self._tasks.values()]
 
     def has_task_running(self):
         return len(self._tasks_running) > 0
@@ -125,6 +196,179 @@ class TaskDaemon(Thread):
         if task:
             return setattr(task, attribute, value)
 
+    def _is_task_running(self, task):
+        with self._condition:
+            return task in self._tasks_running
+
+    def _start_task(self, task):
+        # 启动前已被杀死的任务忽略
+        if not self._is_task_running(task) or task._started.is_set():
+            return
+        # 名额已满时排队，等其他任务释放名额后再启动
+        if not self._acquire_slots(task):
+            with self._condition:
+                if task not in self._waiting:
+                    logger.debug(f'[{urldecode(task.name)}] wait slots')
+                    self._waiting.append(task)
+                self._waiting_since.setdefault(task, time.monotonic())
+            return
+        self._observe_start(task)
+        if isinstance(task, AsyncTaskRunner):
+            task.start(self.loop())
+        else:
+            task.start()
+        self.call_later(task.alive_interval(), self._check_task, task)
+
+    def _observe_start(self, task):
+        now = time.monotonic()
+        runner = type(task).__name__
+        with self._condition:
+            added = self._added_at.pop(task, None)
+            waiting = self._waiting_since.pop(task, None)
+        if added is not None:
+            metrics.task_queue_seconds.observe(now - added,
+                                               runner = runner)
+        if waiting is not None:
+            metrics.task_slot_wait_seconds.observe(now - waiting,
+                                                   runner = runner)
+
+    def _report(self):
+        with self._condition:
+            running = len(self._tasks_running) - len(self._waiting)
+            waiting = len(self._waiting)
+            stopped = len(self._tasks) - len(self._tasks_running)
+            scheduled = len(self._schedule)
+        metrics.daemon_tasks.set(running, state = 'running')
+        metrics.daemon_tasks.set(waiting, state = 'waiting')
+        metrics.daemon_tasks.set(stopped, state = 'stopped')
+        metrics.daemon_tasks.set(scheduled, state = 'scheduled_events')
+
+    def _check_task(self, task):
+        # 已清理或已停止的任务不再检查
+        if not self._is_task_running(task) or task._stopped.is_set():
+            return
+        # 如任务没有存活则停止任务，停止后由停止事件清理
+        if not task.is_task_alive():
+            logger.debug('daemon run stop')
+            task.stop()
+        else:
+            self.call_later(task.alive_interval(), self._check_task, task)
+
+    def _on_task_stopped(self, task):
+        # 任务停止时立即安排清理，优先于其他事件
+        self.call_later(0, self._reap_task, task, priority = -1)
+
+    def _reap_task(self, task):
+        self._release_slots(task)
+        if not self._is_task_running(task):
+            return
+        if task.is_kill_when_stop():
+            # 杀掉任务
+            self.kill_task(task.name)
+        else:
+            with self._condition:
+                self._tasks_running.remove(task)
+
+    def _acquire_slots(self, task):
+        """为任务占用名额
+
+        :param task: 任务
+        :return: 是否占用成功，任一名额已满时不占用
+        """
+        keys = list(task.slot_keys())
+        with self._condition:
+            for key in keys:
+                limit = self._slot_limits.get(key[0], None)
+                if limit is not None and self._slots[key] >= limit:
+                    return False
+            for key in keys:
+                self._slots[key] = self._slots[key] + 1
+            self._holding[task] = keys
+            return True
+
+    def _release_slots(self, task):
+        """释放任务占用的名额，并重新尝试启动排队的任务
+
+        :param task: 任务
+        :return: 无
+        """
+        with self._condition:
+            keys = self._holding.pop(task, None)
+            if not keys:
+                return
+            for key in keys:
+                self._slots[key] = self._slots[key] - 1
+                if self._slots[key] <= 0:
+                    del self._slots[key]
+            waiting, self._waiting = self._waiting, []
+            for waiting_task in waiting:
+                self.call_later(0, self._start_task, waiting_task)
+
+
+class CancelToken:
+    """取消令牌
+
+    任务停止时取消令牌。传输和解密代码在分块或分页的边界检查is_set，
+    正阻塞在读写中的操作则登记中止方法(如中断在途的连接)，取消时
+    立即调用，使阻塞的调用尽快返回，连接仍由使用方在原线程中关闭
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = {}  # 登记号 -> 中止方法
+        self._sequence = itertools.count()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """取消，并调用所有已登记的中止方法
+
+        :return: 无
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, {}
+        for callback in callbacks.values():
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f'cancel callback error: {e!r}')
+
+    def register(self, callback):
+        """登记中止方法，已取消时立即调用
+
+        :param callback: 中止方法
+        :return: 登记号，已取消时为None
+        """
+        with self._lock:
+            if not self._event.is_set():
+                key = next(self._sequence)
+                self._callbacks[key] = callback
+                return key
+        callback()
+        return None
+
+    def unregister(self, key):
+        with self._lock:
+            self._callbacks.pop(key, None)
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """在with语句内登记中止方法
+
+        :param callback: 中止方法
+        :return: 无
+        """
+        key = self.register(callback)
+        try:
+            yield
+        finally:
+            self.unregister(key)
+
 
 class TaskRunner(Thread):
     """任务运行器
@@ -147,31 +391,50 @@ class TaskRunner(Thread):
                     setattr(self, f'_{k}', v)
             # 线程控制成员
             self._stopped = Event()  # 线程停止标识
+            self._cancel = CancelToken()  # 中止在途传输的取消令牌
             self._stop_by_user = False  # 被用户终止标识
             self._stop_by_self = False  # 被任务自身终止标识
             self._stop_by_daemon = False  # 被守护线程终止标识
+            self._stop_listener = None  # 停止事件监听者
             self._run_times = 0  # 运行次数
         except AssertionError:
             raise TaskRunnerInitError()
 
     def run(self):
         # 前置运行，获得轮询间隔
-        interval = self._on_before_runloop()
+        with self._stage('before_runloop'):
+            interval = self._on_before_runloop()
         interval = interval\
             if interval and (isinstance(interval, int)
                              or isinstance(interval, float)) else 0.1
-        while not self._stopped.is_set():
-            self._run_times = self._run_times + 1
-            logger.debug(
-                f"[{urldecode(self.name)}] run loop start ({self._run_times})")
-            # 主体运行
-            self._on_runloop()
-            # 按间隔轮询
-            time.sleep(interval)
-            logger.debug(
-                f"[{urldecode(self.name)}] run loop end ({self._run_times})")
+        with self._stage('runloop'):
+            while not self._stopped.is_set():
+                self._run_times = self._run_times + 1
+                logger.debug(f"[{urldecode(self.name)}] run loop start "
+                             f"({self._run_times})")
+                # 主体运行
+                self._on_runloop()
+                # 按间隔轮询
+                time.sleep(interval)
+                logger.debug(f"[{urldecode(self.name)}] run loop end "
+                             f"({self._run_times})")
         # 后置运行，用于清场
-        self._on_after_runloop()
+        with self._stage('after_runloop'):
+            self._on_after_runloop()
+
+    @contextmanager
+    def _stage(self, stage):
+        """记录一个阶段的耗时
+
+        :param stage: 阶段名
+        :return: 无
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            metrics.observe_stage(self, stage,
+                                  time.perf_counter() - start)
 
     def stop(self):
         try:
@@ -179,18 +442,39 @@ class TaskRunner(Thread):
             self._on_before_stop()
             self._stopped.set()
             self._stop_by_user = True
+            # 中止在途的传输，运行线程在下一个边界处结束
+            self._cancel.cancel()
             self._on_after_stop()
+            if self._stop_listener:
+                self._stop_listener(self)
             logger.debug(f"[{urldecode(self.name)}] stop server end")
             return True, True, self._get_stop_success_message()
         except Exception:
             return False, False, self._get_stop_success_message()
 
+    def set_stop_listener(self, listener):
+        self._stop_listener = listener
+
     def is_task_alive(self):
         pass
 
     def is_kill_when_stop(self):
         pass
 
+    def alive_interval(self):
+        """距下一次存活检查的秒数
+
+        :return: 秒数
+        """
+        return 1
+
+    def slot_keys(self):
+        """任务占用的并发名额
+
+        :return: (类别, 键)列表，守护线程按类别的上限限制同时运行的任务
+        """
+        return ()
+
     def on_kill(self):
         pass
 
@@ -216,6 +500,215 @@ class TaskRunner(Thread):
         return _('Task stop failed')
 
 
+class EventLoopThread(Thread):
+    """事件循环线程
+
+    在一个线程中运行asyncio事件循环，所有异步任务共用，
+    其他线程通过submit提交协程
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self._loop)
+        logger.debug('event loop start')
+        self._loop.run_forever()
+        self._loop.close()
+        logger.debug('event loop finish')
+
+    def submit(self, coro):
+        """提交协程
+
+        :param coro: 协程
+        :return: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def in_loop(self):
+        """当前是否在事件循环线程中
+
+        :return: 是否在事件循环线程中
+        """
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def exit(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class AsyncTaskRunner:
+    """异步任务运行器
+
+    与TaskRunner的生命周期相同，但不独占线程：运行循环是在守护线程的
+    事件循环中执行的协程，各个钩子方法均为协程，轮询间隔的等待不阻塞
+    其他任务。守护线程通过start、stop、is_task_alive等方法像对待
+    TaskRunner一样调度
+    """
+
+    def __init__(self, **kwargs):
+        try:
+            # 任务名称
+            self.name = kwargs.get('name', None)
+            assert self.name
+            # 回调句柄
+            self._callback = kwargs.get('callback', None)
+            # 运行参数
+            self._params = kwargs.get('params', None)
+            if self._params:
+                for k, v in self._params.items():
+                    setattr(self, f'_{k}', v)
+            # 任务控制成员
+            self._started = Event()  # 任务启动标识
+            self._stopped = Event()  # 任务停止标识
+            self._cancel = CancelToken()  # 中止在途传输的取消令牌
+            self._stop_by_user = False  # 被用户终止标识
+            self._stop_listener = None  # 停止事件监听者
+            self._run_times = 0  # 运行次数
+            self._loop = None  # 事件循环线程
+            self._wakeup = None  # 打断轮询等待的事件
+            self._future = None  # 运行循环的Future
+        except AssertionError:
+            raise TaskRunnerInitError()
+
+    def start(self, loop):
+        """在事件循环中启动运行循环
+
+        :param loop: 事件循环线程
+        :return: 无
+        """
+        self._loop = loop
+        self._started.set()
+        self._future = loop.submit(self._run())
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        try:
+            # 前置运行，获得轮询间隔
+            with self._stage('before_runloop'):
+                interval = await self._on_before_runloop()
+            interval = interval\
+                if interval and (isinstance(interval, int)
+                                 or isinstance(interval, float)) else 0.1
+            with self._stage('runloop'):
+                while not self._stopped.is_set():
+                    self._run_times = self._run_times + 1
+                    logger.debug(f"[{urldecode(self.name)}] async run "
+                                 f"loop start ({self._run_times})")
+                    # 主体运行
+                    await self._on_runloop()
+                    # 按间隔等待，停止时立即结束等待
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(),
+                                               interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    logger.debug(f"[{urldecode(self.name)}] async run "
+                                 f"loop end ({self._run_times})")
+        except Exception as e:
+            logger.debug(
+                f"[{urldecode(self.name)}] async run error: {e!r}")
+            if not self._stopped.is_set():
+                await self.astop()
+        finally:
+            # 后置运行，用于清场
+            with self._stage('after_runloop'):
+                await self._on_after_runloop()
+
+    _stage = TaskRunner._stage
+
+    def stop(self):
+        """停止任务，可在任意线程中调用
+
+        在事件循环线程中调用时只安排停止，不等待停止钩子完成
+
+        :return: (是否成功, 业务数据, 提示消息)
+        """
+        if self._loop is None:
+            self._stopped.set()
+            self._cancel.cancel()
+            return True, True, self._get_stop_success_message()
+        if self._loop.in_loop():
+            asyncio.ensure_future(self.astop())
+            return True, True, self._get_stop_success_message()
+        try:
+            return self._loop.submit(self.astop()).result()
+        except Exception:
+            return False, False, self._get_stop_fail_message()
+
+    async def astop(self):
+        """在事件循环中停止任务
+
+        :return: (是否成功, 业务数据, 提示消息)
+        """
+        try:
+            logger.debug(f"[{urldecode(self.name)}] stop server start")
+            await self._on_before_stop()
+            self._stopped.set()
+            self._stop_by_user = True
+            # 在事件循环中中止在途的连接
+            self._cancel.cancel()
+            if self._wakeup:
+                self._wakeup.set()
+            await self._on_after_stop()
+            if self._stop_listener:
+                self._stop_listener(self)
+            logger.debug(f"[{urldecode(self.name)}] stop server end")
+            return True, True, self._get_stop_success_message()
+        except Exception:
+            return False, False, self._get_stop_fail_message()
+
+    def set_stop_listener(self, listener):
+        self._stop_listener = listener
+
+    def is_task_alive(self):
+        return not self._stopped.is_set()
+
+    def is_kill_when_stop(self):
+        pass
+
+    def alive_interval(self):
+        """距下一次存活检查的秒数
+
+        :return: 秒数
+        """
+        return 1
+
+    def slot_keys(self):
+        """任务占用的并发名额
+
+        :return: (类别, 键)列表，守护线程按类别的上限限制同时运行的任务
+        """
+        return ()
+
+    def on_kill(self):
+        pass
+
+    async def _on_before_runloop(self):
+        return 0.1
+
+    async def _on_runloop(self):
+        pass
+
+    async def _on_after_runloop(self):
+        pass
+
+    async def _on_before_stop(self):
+        pass
+
+    async def _on_after_stop(self):
+        pass
+
+    def _get_stop_success_message(self):
+        return _('Task has stopped')
+
+    def _get_stop_fail_message(self):
+        return _('Task stop failed')
+
+
 class HeartbeatInitError(RuntimeError):
     pass
 
@@ -235,12 +728,12 @@ class HeartbeatRunner(TaskRunner):
             assert self._callback
             assert self._interval
             assert self._command
-            from server.android.device import\
-                _client  # todo change to current_client
-            self._command_func = getattr(_client,
+            # 命令由添加任务时传入的设备客户端执行
+            assert self._device
+            self._command_func = getattr(self._device,
                                          f'cmd_{self._command}',
                                          None)
-            self._alive_func = getattr(_client,
+            self._alive_func = getattr(self._device,
                                        f'alive_{self._command}',
                                        None)
             assert self._command_func
@@ -271,6 +764,9 @@ class HeartbeatRunner(TaskRunner):
         else:
             return True
 
+    def alive_interval(self):
+        return self._interval
+
     def is_kill_when_stop(self):
         return True
 
@@ -285,9 +781,9 @@ class OnceRunner(TaskRunner):
         try:
             assert self._callback
             assert self._command
-            from server.android.device import\
-                _client  # todo change to current_client
-            self._command_func = getattr(_client,
+            # 命令由添加任务时传入的设备客户端执行
+            assert self._device
+            self._command_func = getattr(self._device,
                                          f'cmd_{self._command}',
                                          None)
             assert self._command_func
@@ -296,13 +792,229 @@ class OnceRunner(TaskRunner):
             raise OnceInitError()
 
     def _on_runloop(self):
-        self._callback('android',
-                       (self._command, self.name) +
-                       self._command_func(self.name,
-                                          **self._params))
+        try:
+            self._callback('android',
+                           (self._command, self.name) +
+                           self._command_func(self.name,
+                                              **self._params))
+        finally:
+            self.stop()
 
     def is_task_alive(self):
-        return False
+        return not self._stopped.is_set()
 
     def is_kill_when_stop(self):
         return True
+
+
+class AsyncHeartbeatRunner(AsyncTaskRunner):
+    """异步心跳运行器
+
+    与HeartbeatRunner相同，命令在事件循环的线程池中执行，
+    轮询间隔内不占用线程
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        try:
+            assert self._callback
+            assert self._interval
+            assert self._command
+            # 命令由添加任务时传入的设备客户端执行
+            assert self._device
+            self._command_func = getattr(self._device,
+                                         f'cmd_{self._command}',
+                                         None)
+            self._alive_func = getattr(self._device,
+                                       f'alive_{self._command}',
+                                       None)
+            assert self._command_func
+
+        except AssertionError:
+            raise HeartbeatInitError()
+
+    async def _on_before_runloop(self):
+        return self._interval
+
+    async def _on_runloop(self):
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._command_func, self.name,
+                                    **self._params))
+        self._callback('android', (self._command, self.name) + result)
+
+    async def _on_after_runloop(self):
+        logger.debug(f'[{urldecode(self.name)}] after run loop')
+
+    def is_task_alive(self):
+        if self._alive_func:
+            return self._alive_func(self.name, **self._params)
+        else:
+            return True
+
+    def alive_interval(self):
+        return self._interval
+
+    def is_kill_when_stop(self):
+        return True
+
+
+class AsyncOnceRunner(AsyncTaskRunner):
+    """异步一次性运行器
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        try:
+            assert self._callback
+            assert self._command
+            # 命令由添加任务时传入的设备客户端执行
+            assert self._device
+            self._command_func = getattr(self._device,
+                                         f'cmd_{self._command}',
+                                         None)
+            assert self._command_func
+
+        except AssertionError:
+            raise OnceInitError()
+
+    async def _on_runloop(self):
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self._command_func, self.name,
+                                        **self._params))
+            self._callback('android', (self._command, self.name) + result)
+        finally:
+            await self.astop()
+
+    def is_kill_when_stop(self):
+        return True
+
+
+class ProgressTicker:
+    """进度合并推送器
+
+    由守护线程按固定间隔调度，在工作线程中一次轮询所有登记的进度源，
+    避免设备命令阻塞守护线程，结果交回守护线程按信道合并为一次推送。
+    每个进度源只推送与上次相比有变化的字段，已移除的字段推送为None，
+    页面据此从合并的数据中删除。进度源不再存活、所属任务停止或轮询出错
+    后自动注销，出错时先推送一次失败结果，没有进度源时不再调度
+    """
+
+    def __init__(self, daemon, emit, interval = PROGRESS_TICK_INTERVAL):
+        """
+        :param daemon: 任务守护线程
+        :param emit: 推送方法，参数为(信道, 数据列表)
+        :param interval: 轮询间隔秒数
+        """
+        self._daemon = daemon
+        self._emit = emit
+        self._interval = interval
+        self._sources = {}  # 名称 -> 进度源
+        self._lock = RLock()
+        self._ticking = False  # 已安排下一次轮询标识
+
+    def register(self, name, command, params = None, channel = 'android',
+                 owner = None):
+        """登记进度源
+
+        :param name: 名称
+        :param command: 命令名，按cmd_前缀和alive_前缀查找进度和存活方法
+        :param params: 命令参数
+        :param channel: 信道
+        :param owner: 所属任务，任务停止后推送最后一次进度再注销
+        :return: 是否登记成功
+        """
+        client = getattr(importlib.import_module(
+            f'server.{channel}.device'), '_client')
+        command_func = getattr(client, f'cmd_{command}', None)
+        if not command_func:
+            return False
+        with self._lock:
+            self._sources[name] = {
+                'command': command,
+                'channel': channel,
+                'params': params or {},
+                'owner': owner,
+                'command_func': command_func,
+                'alive_func': getattr(client, f'alive_{command}', None),
+                'last': None}
+            if not self._ticking:
+                self._ticking = True
+                self._daemon.call_later(0, self._tick)
+        return True
+
+    def unregister(self, name):
+        with self._lock:
+            self._sources.pop(name, None)
+
+    def _tick(self):
+        with self._lock:
+            sources = list(self._sources.items())
+        Thread(target = self._poll_all, args = (sources,),
+               name = 'Progress ticker', daemon = True).start()
+
+    def _poll_all(self, sources):
+        """在工作线程中轮询进度源，结果交回守护线程推送
+
+        :param sources: (名称, 进度源)列表
+        :return: 无
+        """
+        batches = {}
+        for name, source in sources:
+            try:
+                item = self._poll(name, source)
+                if item:
+                    batches.setdefault(source['channel'], []).append(item)
+                if not self._is_alive(name, source):
+                    self.unregister(name)
+            except Exception as e:
+                logger.debug(f'[{urldecode(name)}] ticker error: {e!r}')
+                batches.setdefault(source['channel'], []).append(
+                    (source['command'], name, False, None,
+                     _('Progress check failed: {}').format(e)))
+                self.unregister(name)
+        self._daemon.call_later(0, self._deliver, batches)
+
+    def _deliver(self, batches):
+        for channel, items in batches.items():
+            self._emit(channel, items)
+        with self._lock:
+            self._ticking = len(self._sources) > 0
+            if self._ticking:
+                self._daemon.call_later(self._interval, self._tick)
+
+    def _poll(self, name, source):
+        """读取进度源的当前进度
+
+        :param name: 名称
+        :param source: 进度源
+        :return: (命令名, 名称, 是否成功, 变化的数据, 消息)，没有变化时
+                 返回None
+        """
+        success, data, message = source['command_func'](
+            name, **source['params'])
+        last = source['last']
+        source['last'] = (success, data, message)
+        if last is None:
+            return source['command'], name, success, data, message
+        last_success, last_data, last_message = last
+        if isinstance(data, dict) and isinstance(last_data, dict):
+            changed = {k: v for k, v in data.items()
+                       if k not in last_data or last_data[k] != v}
+            changed.update({k: None for k in last_data if k not in data})
+        else:
+            changed = data if data != last_data else None
+        if not changed and success == last_success and\
+                message == last_message:
+            return None
+        return source['command'], name, success, changed, message
+
+    def _is_alive(self, name, source):
+        owner = source['owner']
+        if owner is not None and owner._stopped.is_set():
+            return False
+        if source['alive_func']:
+            return source['alive_func'](name, **source['params'])
+        return True
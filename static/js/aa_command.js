@@ -17,6 +17,7 @@ function execCommand(args, notEvent) {
         } else {
             args["channel"] = "android";
         }
+        attachDeviceSerial(args);
         socketio.emit("exec_command", args, callback = execCommandCallback);
     }
 }
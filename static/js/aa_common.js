@@ -79,4 +79,22 @@ function sendFootInfo(lifecycle) {
             "<span class='foot-event'>{3}</span>").format(
             lifecycle.transition, lifecycle.from, lifecycle.to, lifecycle.event));
     }
-}
\ No newline at end of file
+}
+
+/**
+ * 为命令或任务参数附加当前设备的序列号
+ *
+ * 已指定serial(包括null)的参数保持不变，null表示使用第一台设备
+ *
+ * @param args 命令或任务参数
+ * @returns 参数
+ */
+function attachDeviceSerial(args) {
+    if (args.serial === undefined) {
+        var serial = $("#status_device").attr("data-serial");
+        if (serial) {
+            args.serial = serial;
+        }
+    }
+    return args;
+}
@@ -86,6 +86,7 @@ function startupDeviceChecker() {
     addTask({
         name: encodeURI(_("Device checker")),
         category: "heartbeat",
+        serial: null,
         params: {
             command: "check_device",
             interval: 3,
@@ -107,6 +108,7 @@ function startupRootChecker() {
     addTask({
         name: encodeURI(_("Root checker")),
         category: "heartbeat",
+        serial: null,
         params: {
             command: "check_root",
             interval: 3 ,
@@ -5,6 +5,7 @@
  * {
  *     name: #[必选]名称
  *     category: #[必选]类别
+ *     serial: #[可选]设备序列号，不指定时使用当前设备
  *     params: #[可选]参数
  * }
  *
@@ -14,6 +15,7 @@ function addTask(args) {
     if (isServerConnected(true)) {
         args["channel"] = "android";
     }
+    attachDeviceSerial(args);
     socketio.emit("add_task", args, callback = addTaskCallback);
 }
 
@@ -23,6 +25,12 @@ function addTask(args) {
  */
 function killTask(taskname) {
     socketio.emit("kill_task", {name: taskname, channel: "android"});
+    // 进度源名称以" - 任务名"结尾，任务重新开始时不再合并旧的字段
+    for (let key of Object.keys(taskProgressCache)) {
+        if (key.endsWith(" - " + taskname)) {
+            delete taskProgressCache[key];
+        }
+    }
 }
 
 /**
@@ -71,6 +79,48 @@ function taskResponse(command, name, success, data, message) {
     }
 }
 
+/**
+ * 合并的任务进度缓存，按命令名和任务名保存最近一次的完整业务数据
+ */
+var taskProgressCache = {};
+
+/**
+ * 任务进度合并回调
+ *
+ * 每项格式同taskResponse，业务数据只包含有变化的字段，已移除的字段
+ * 值为null，与缓存合并为完整数据后按单项回调处理。任务完成或失败后
+ * 删除缓存
+ *
+ * @param items 任务进度列表
+ */
+function taskBatchResponse(items) {
+    for (let item of items) {
+        var [command, name, success, data, message] = item;
+        var key = command + "/" + name;
+        var cached = taskProgressCache[key];
+        if (data !== null && typeof data === "object" &&
+            cached !== null && typeof cached === "object") {
+            data = Object.assign({}, cached, data);
+        } else if (data === null && cached !== undefined) {
+            data = cached;
+        }
+        if (data !== null && typeof data === "object") {
+            for (let field of Object.keys(data)) {
+                if (data[field] === null) {
+                    delete data[field];
+                }
+            }
+        }
+        if (data !== null && typeof data === "object" &&
+            (data.progress === 1 || data.progress < 0)) {
+            delete taskProgressCache[key];
+        } else {
+            taskProgressCache[key] = data;
+        }
+        taskResponse(command, name, success, data, message);
+    }
+}
+
 /**
  * 检查设备连接状态的前置响应
  * @param data 响应数据
@@ -273,4 +323,5 @@ function onPostTaskResponseCheckResourceProgress(data) {
 
 $(function () {
     socketio.on("task_response", taskResponse);
+    socketio.on("task_batch_response", taskBatchResponse);
 });
\ No newline at end of file
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """以临时目录为工作目录，data等相对路径都落在其中"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def make_message_db(path, messages, contacts = (), chatrooms = ()):
+    """生成与解密后的微信数据库结构相同的明文数据库
+
+    :param path: 数据库路径
+    :param messages: (msgId, type, isSend, createTime, talker, content)列表
+    :param contacts: (username, conRemark, nickname)列表
+    :param chatrooms: (chatroomname, displayname, roomowner, memberlist)列表
+    :return: 路径
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        "CREATE TABLE message (msgId INTEGER PRIMARY KEY, msgSvrId INTEGER, "
+        "type INT, isSend INT, status INT, createTime INTEGER, talker TEXT, "
+        "content TEXT, imgPath TEXT);"
+        "CREATE TABLE rcontact (username TEXT PRIMARY KEY, alias TEXT, "
+        "conRemark TEXT, nickname TEXT, type INT);"
+        "CREATE TABLE chatroom (chatroomname TEXT PRIMARY KEY, "
+        "displayname TEXT, roomowner TEXT, memberlist TEXT);")
+    conn.executemany(
+        "INSERT INTO message (msgId, msgSvrId, type, isSend, status, "
+        "createTime, talker, content) VALUES (?, ?, ?, ?, 0, ?, ?, ?);",
+        [(msg_id, msg_id, type_, is_send, created, talker, content)
+         for msg_id, type_, is_send, created, talker, content in messages])
+    conn.executemany(
+        "INSERT INTO rcontact (username, alias, conRemark, nickname, type) "
+        "VALUES (?, '', ?, ?, 1);", contacts)
+    conn.executemany("INSERT INTO chatroom VALUES (?, ?, ?, ?);", chatrooms)
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def fake_adb(workdir):
+    """本地的模拟设备和adb服务
+
+    设备上的命令在本地的sh中执行，数据库和资源由测试自行写入
+
+    :return: (模拟设备, 模拟adb服务)
+    """
+    pytest.importorskip('adb')
+    from benchmarks.fakeadb import FakeAdbServer, FakeDevice
+
+    device = FakeDevice(str(workdir / 'device'))
+    device.prepare()
+    os.makedirs(os.path.dirname(device.db_path))
+    adb = FakeAdbServer(device).start()
+    yield device, adb
+    adb.stop()
+
+
+@pytest.fixture
+def daemon(fake_adb, monkeypatch):
+    """经守护线程运行任务，进度推送记入daemon.emitted
+
+    :return: 守护线程
+    """
+    import server
+    from server.android import AndroidDevice, device as channel_device
+    from server.task import ProgressTicker, TaskDaemon
+
+    _, adb = fake_adb
+    client = AndroidDevice(port = adb.port)
+    task_daemon = TaskDaemon()
+    task_daemon.daemon = True
+    task_daemon.client = client
+    task_daemon.emitted = []
+    task_daemon.start()
+    monkeypatch.setattr(channel_device, '_client', client, raising = False)
+    monkeypatch.setattr(server, '_daemon', task_daemon)
+    monkeypatch.setattr(server, '_ticker', ProgressTicker(
+        task_daemon,
+        lambda channel, items: task_daemon.emitted.extend(items),
+        interval = 0.05))
+    yield task_daemon
+    task_daemon.exit()
+
+
+def run_task(daemon, class_, name, params, timeout = 30):
+    """经守护线程运行任务直到结束
+
+    :param daemon: 守护线程
+    :param class_: 任务类
+    :param name: 任务名称
+    :param params: 任务参数，补上设备和序列号
+    :param timeout: 最长等待秒数
+    :return: 任务
+    """
+    params = dict(params, device = daemon.client,
+                  serial = daemon.client.device().serial)
+    # 持有守护线程的锁，任务在取得之前不会被清理
+    with daemon._condition:
+        assert daemon.add_task(class_, name, params = params)
+        task = daemon._tasks[name]
+    wait_until(lambda: not daemon.has_task(name), timeout,
+               f'{name} did not finish')
+    return task
+
+
+def wait_until(predicate, timeout = 10, message = 'timed out'):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, message
+        time.sleep(0.01)
@@ -0,0 +1,119 @@
+import io
+import os
+import random
+import threading
+
+import pytest
+
+from conftest import run_task
+
+from server.android.archive import PackArchive
+
+
+def add(archive, path, data, mtime = 1):
+    archive.add(path, io.BytesIO(data), len(data), mtime)
+
+
+def packs(root):
+    return sorted(name for name in os.listdir(root)
+                  if name.startswith('pack-'))
+
+
+def test_add_read_and_replace(workdir):
+    archive = PackArchive('pack')
+    add(archive, 'image2/a', b'first')
+    add(archive, 'image2/b', b'second')
+    add(archive, 'image2/a', b'replaced', mtime = 2)
+    assert archive.read('image2/a') == b'replaced'
+    assert archive.read('image2/b') == b'second'
+    assert 'image2/a' in archive and 'image2/c' not in archive
+    with pytest.raises(FileNotFoundError):
+        archive.read('image2/c')
+    archive.extract('image2/b', 'b')
+    with open('b', 'rb') as f:
+        assert f.read() == b'second'
+    archive.close()
+    # 关闭后重新打开，索引和内容都保留
+    archive = PackArchive('pack')
+    assert archive.list() == [('image2/a', 8, 2), ('image2/b', 6, 1)]
+    archive.close()
+
+
+def test_truncated_member_is_not_indexed(workdir):
+    archive = PackArchive('pack')
+    with pytest.raises(OSError):
+        archive.add('image2/a', io.BytesIO(b'abc'), 4, 1)
+    assert 'image2/a' not in archive
+    archive.close()
+
+
+def test_list_stat_and_remove_by_prefix(workdir):
+    archive = PackArchive('pack')
+    for path in ['image2/a', 'image2/b', 'image20/c', 'voice2/d']:
+        add(archive, path, path.encode())
+    assert [row[0] for row in archive.list('image2/')] ==\
+        ['image2/a', 'image2/b']
+    assert [row[0] for row in archive.list(limit = 2, offset = 1)] ==\
+        ['image2/b', 'image20/c']
+    assert archive.stat('image2/') == (2, 16)
+    assert archive.stat() == (4, 33)
+    assert archive.remove('image2/') == 2
+    assert archive.stat() == (2, 17)
+    assert archive.stat('missing/') == (0, 0)
+    archive.close()
+
+
+def test_packs_roll_over_and_prune(workdir):
+    archive = PackArchive('pack', pack_byte = 10)
+    for i in range(4):
+        add(archive, f'image2/{i}', b'x' * 8)
+    assert len(packs('pack')) == 2
+    archive.close()
+    archive = PackArchive('pack', pack_byte = 10)
+    archive.remove('image2/')
+    assert archive.prune() == 2
+    assert packs('pack') == []
+    archive.close()
+
+
+def test_threads_write_own_packs(workdir):
+    archive = PackArchive('pack')
+
+    def write(name):
+        for i in range(50):
+            add(archive, f'{name}/{i}', f'{name}{i}'.encode())
+
+    threads = [threading.Thread(target = write, args = (f't{n}',))
+               for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    archive.flush()
+    assert archive.stat()[0] == 200
+    assert len(packs('pack')) == 4
+    assert archive.read('t2/17') == b't217'
+    archive.close()
+
+
+def test_resource_pull_into_archive(daemon, fake_adb):
+    from benchmarks.fakeadb import generate_res
+    from server.android.task import ResPullRunner
+
+    device = fake_adb[0]
+    generate_res(device.res_path, 20, 256 * 1024, random.Random(1))
+    task = run_task(daemon, ResPullRunner, 'p', {
+        'user': device.user, 'output': 'archive', 'incremental': False,
+        'encoding': 'gzip'})
+    assert task.progress()['progress'] == 1
+    archive = PackArchive('data/p/Resource.pack')
+    files = 0
+    for folder, _, names in os.walk(device.res_path):
+        for name in names:
+            path = f'{folder}/{name}'
+            with open(path, 'rb') as f:
+                assert archive.read(os.path.relpath(
+                    path, device.res_path)) == f.read()
+            files = files + 1
+    assert archive.stat()[0] == files == 20
+    archive.close()
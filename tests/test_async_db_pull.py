@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from conftest import run_task
+
+pytest.importorskip('adb')
+
+from server.android.task import AsyncDbPullRunner  # noqa: E402
+
+CHUNK = 16 * 1024
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def device(fake_adb):
+    device = fake_adb[0]
+    with open(device.db_path, 'wb') as f:
+        f.write(os.urandom(CHUNK * 3 + 100))
+    return device
+
+
+def pull(daemon, device, name = 'p'):
+    return run_task(daemon, AsyncDbPullRunner, name,
+                    {'user': device.user, 'chunk': CHUNK})
+
+
+def record_reads(monkeypatch, corrupt = ()):
+    """记录读取的分块，corrupt中的分块第一次读取时返回错误的数据"""
+    reads = []
+    read_chunk = AsyncDbPullRunner._read_chunk
+
+    async def recording(self, index):
+        reads.append(index)
+        data = await read_chunk(self, index)
+        if index in corrupt and reads.count(index) == 1:
+            return b'\0' * len(data)
+        return data
+
+    monkeypatch.setattr(AsyncDbPullRunner, '_read_chunk', recording)
+    return reads
+
+
+def test_init_does_not_touch_device(daemon, device, monkeypatch):
+    def shell(*args, **kwargs):
+        raise AssertionError('blocking shell in __init__')
+
+    monkeypatch.setattr(type(daemon.client.device()), 'shell', shell)
+    runner = AsyncDbPullRunner(name = 'p', params = {
+        'device': daemon.client, 'serial': device.serial,
+        'user': device.user})
+    assert runner.src_byte is None
+    assert runner.progress()['progress'] == 0
+
+
+def test_pull_all_chunks(daemon, device, monkeypatch):
+    reads = record_reads(monkeypatch)
+    task = pull(daemon, device)
+    assert reads == [0, 1, 2, 3]
+    assert task.src_byte == os.path.getsize(device.db_path)
+    assert task.progress()['progress'] == 1
+    assert read('data/p/EnMicroMsg.db') == read(device.db_path)
+
+
+def test_resume_from_offset(daemon, device, monkeypatch):
+    data = read(device.db_path)
+    os.makedirs('data/p')
+    with open('data/p/EnMicroMsg.db.part', 'wb') as f:
+        f.write(data[:CHUNK * 2])
+    with open('data/p/EnMicroMsg.db.part.json', 'w') as f:
+        f.write(f'{{"src_byte": {len(data)}, "src_mtime": '
+                f'{int(os.stat(device.db_path).st_mtime)}, '
+                f'"offset": {CHUNK * 2}}}')
+    reads = record_reads(monkeypatch)
+    task = pull(daemon, device)
+    assert reads == [2, 3]
+    assert task.progress()['progress'] == 1
+    assert read('data/p/EnMicroMsg.db') == data
+
+
+def test_corrupt_chunk_is_retried(daemon, device, monkeypatch):
+    reads = record_reads(monkeypatch, corrupt = (1,))
+    task = pull(daemon, device)
+    assert reads == [0, 1, 1, 2, 3]
+    assert task.progress()['progress'] == 1
+    assert read('data/p/EnMicroMsg.db') == read(device.db_path)
+
+
+def test_unchanged_db_is_skipped(daemon, device, monkeypatch):
+    pull(daemon, device)
+    reads = record_reads(monkeypatch)
+    task = pull(daemon, device, 'p')
+    assert reads == []
+    assert task._unchanged
+    assert task.progress()['progress'] == 1
+
+
+def test_missing_db_reports_error(daemon, device):
+    os.remove(device.db_path)
+    task = pull(daemon, device)
+    assert task.progress()['progress'] == -1
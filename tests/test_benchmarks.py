@@ -0,0 +1,80 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip('adb')
+
+import server  # noqa: E402
+from benchmarks import run  # noqa: E402
+from benchmarks.fakeadb import FakeAdbServer, FakeDevice  # noqa: E402
+from server.android.transfer import exec_out, push_lines  # noqa: E402
+
+
+def test_percentiles_and_median():
+    samples = [i / 1000 for i in range(1, 101)]
+    result = run._percentiles('event', samples)
+    assert result['event p50 ms'] == pytest.approx(51)
+    assert result['event max ms'] == pytest.approx(100)
+    assert run._median([{'a': 1}, {'a': 5}, {'a': 2}]) == {'a': 2}
+
+
+def test_device_paths_are_mapped(workdir):
+    device = FakeDevice('device')
+    assert device.map_path('/data/data/com.tencent.mm/MicroMsg/x') ==\
+        f'{device.root}/db/MicroMsg/x'
+    assert device.map_path('/system/bin') == '/system/bin'
+    assert device.map_cmd('ls /mnt/sdcard/tencent/MicroMsg/a') ==\
+        f'ls {device.root}/res/a'
+
+
+def test_push_and_exec(daemon, fake_adb):
+    adb_device = daemon.client.device()
+    path = push_lines(adb_device, ['a', 'b c'])
+    with exec_out(adb_device, f'cat {path}') as stream:
+        assert stream.read() == b'a\nb c\n'
+    adb_device.shell(f'rm -f {path}')
+
+
+def test_bandwidth_is_shared(workdir):
+    device = FakeDevice('device')
+    adb = FakeAdbServer(device, bandwidth = 1000)
+    try:
+        start = time.monotonic()
+        adb.throttle(100)
+        adb.throttle(100)
+        assert time.monotonic() - start >= 0.15
+    finally:
+        adb.server_close()
+
+
+def test_schedule_benchmark(workdir, monkeypatch):
+    # Bench替换服务的守护线程和推送器，测试结束后恢复
+    monkeypatch.setattr(server, '_daemon', server._daemon)
+    monkeypatch.setattr(server, '_ticker', server._ticker)
+    device = FakeDevice('device')
+    device.prepare()
+    adb = FakeAdbServer(device).start()
+    bench = run.Bench(device, adb.port)
+    try:
+        result = bench.bench_schedule(events = 50, tasks = 5)
+    finally:
+        bench.close()
+        adb.stop()
+    assert set(result) == {f'{kind} {stat}' for kind in ('event', 'task')
+                           for stat in ('p50 ms', 'p95 ms', 'p99 ms',
+                                        'max ms')}
+    assert all(value >= 0 for value in result.values())
+
+
+def test_full_run(workdir, monkeypatch):
+    pytest.importorskip('pysqlcipher3')
+    monkeypatch.setattr(server, '_daemon', server._daemon)
+    monkeypatch.setattr(server, '_ticker', server._ticker)
+    results = run.main(['--work', str(workdir), '--db-mb', '0.25',
+                        '--res-files', '20', '--res-mb', '0.5',
+                        '--repeat', '1', '--workers', '2',
+                        '--only', 'db,res', '--json', 'out.json'])
+    assert 'db pull chunked' in results
+    with open(workdir / 'out.json', 'r') as f:
+        assert json.load(f)['results'] == results
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from conftest import wait_until
+
+from server.task import CancelToken
+
+
+def test_cancel_calls_registered_callbacks_once():
+    token = CancelToken()
+    calls = []
+    key = token.register(lambda: calls.append('a'))
+    token.register(lambda: calls.append('b'))
+    token.unregister(key)
+    token.unregister(None)
+    assert not token.is_set()
+    token.cancel()
+    token.cancel()
+    assert token.is_set()
+    assert calls == ['b']
+
+
+def test_register_after_cancel_runs_at_once():
+    token = CancelToken()
+    token.cancel()
+    calls = []
+    assert token.register(lambda: calls.append(1)) is None
+    assert calls == [1]
+
+
+def test_failed_callback_does_not_stop_others():
+    token = CancelToken()
+    calls = []
+    token.register(lambda: 1 / 0)
+    token.register(lambda: calls.append(1))
+    token.cancel()
+    assert calls == [1]
+
+
+def test_on_cancel_only_inside_block():
+    token = CancelToken()
+    calls = []
+    with token.on_cancel(lambda: calls.append('inside')):
+        pass
+    token.cancel()
+    assert calls == []
+
+
+def test_cancel_interrupts_exec_stream(daemon):
+    from server.android.transfer import exec_out
+
+    token = CancelToken()
+    stream = exec_out(daemon.client.device(), 'echo start; sleep 30',
+                      cancel = token)
+    assert stream.readline() == b'start\n'
+    timer = threading.Timer(0.2, token.cancel)
+    timer.start()
+    start = time.monotonic()
+    with pytest.raises(InterruptedError):
+        stream.read()
+    assert time.monotonic() - start < 5
+    stream.close()
+    assert token._callbacks == {}
+
+
+def test_stop_interrupts_running_pull(daemon, fake_adb, monkeypatch):
+    from server.android import task as android_task
+    from server.android.task import DbPullRunner
+
+    device = fake_adb[0]
+    with open(device.db_path, 'wb') as f:
+        f.write(b'\0' * 4096)
+    read_chunk = android_task.read_chunk
+    reading = threading.Event()
+
+    def slow(device, path, index, *args, **kwargs):
+        reading.set()
+        # 设备端一直不返回数据，只能由取消中断
+        return read_chunk(device, f'{path}; sleep 30 #', index, *args,
+                          **kwargs)
+
+    monkeypatch.setattr(android_task, 'read_chunk', slow)
+    params = {'device': daemon.client, 'serial': device.serial,
+              'user': device.user, 'chunk': 4096}
+    with daemon._condition:
+        assert daemon.add_task(DbPullRunner, 'p', params = params)
+        task = daemon._tasks['p']
+    assert reading.wait(10)
+    time.sleep(0.2)
+    start = time.monotonic()
+    daemon.kill_task('p')
+    wait_until(lambda: not task.is_alive(), 5)
+    assert time.monotonic() - start < 5
+    assert task.progress()['progress'] < 1
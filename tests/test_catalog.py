@@ -0,0 +1,75 @@
+import os
+
+from server.android.catalog import ProjectCatalog, read_conf
+
+
+def catalog(workdir, **kwargs):
+    kwargs.setdefault('flush_interval', 3600)
+    return ProjectCatalog(path = str(workdir / 'catalog.db'), **kwargs)
+
+
+def test_create_and_list(workdir):
+    projects = catalog(workdir)
+    projects.create('p', 'wxid_p', 'abc1234')
+    assert projects.projects() == {
+        'p': {'user': 'wxid_p', 'password': 'abc1234', 'files': []}}
+    assert read_conf('data/p/backup.conf') == ('p', 'wxid_p', 'abc1234', 0)
+
+
+def test_sizes_are_batched(workdir):
+    projects = catalog(workdir)
+    projects.create('p', 'wxid_p', 'abc1234')
+    projects.set_size('p', 'data/p/EnMicroMsg.db', 10)
+    projects.set_size('q', 'data/q/EnMicroMsg.db', 10)
+    # 未写入的大小也出现在列表中
+    assert projects.projects()['p']['files'] ==\
+        [('data/p/EnMicroMsg.db', 10)]
+    assert catalog(workdir).projects()['p']['files'] == []
+    projects.flush()
+    assert catalog(workdir).projects()['p']['files'] ==\
+        [('data/p/EnMicroMsg.db', 10)]
+
+
+def test_resource_size_is_written_to_conf(workdir):
+    projects = catalog(workdir)
+    projects.create('p', 'wxid_p', 'abc1234')
+    projects.set_size('p', 'data/p/Resource', 2048)
+    projects.flush()
+    assert read_conf('data/p/backup.conf')[3] == 2048
+
+
+def test_remove_drops_size_and_checksum(workdir):
+    projects = catalog(workdir)
+    projects.create('p', 'wxid_p', 'abc1234')
+    projects.set_size('p', 'data/p/EnMicroMsg.db', 10)
+    projects.set_checksum('p', 'data/p/EnMicroMsg.db', 10, 'md5')
+    assert projects.checksum('p', 'data/p/EnMicroMsg.db') == (10, 'md5')
+    projects.remove('p', 'data/p/EnMicroMsg.db')
+    assert projects.projects()['p']['files'] == []
+    assert projects.checksum('p', 'data/p/EnMicroMsg.db') is None
+
+
+def test_rebuild_from_data_dir(workdir):
+    projects = catalog(workdir)
+    projects.create('p', 'wxid_p', 'abc1234')
+    projects.set_checksum('p', 'data/p/EnMicroMsg.db', 3, 'md5')
+    with open('data/p/EnMicroMsg.db', 'wb') as f:
+        f.write(b'abc')
+    os.makedirs('data/p/Resource')
+    projects.set_size('p', 'data/p/Resource', 4096)
+    projects.flush()
+    os.makedirs('data/broken')
+    with open('data/broken/backup.conf', 'w') as f:
+        f.write('[project]\n')
+    projects.set_size('p', 'data/p/stale', 1)
+    assert projects.rebuild() == 1
+    assert projects.projects()['p']['files'] == [
+        ('data/p/EnMicroMsg.db', 3), ('data/p/Resource', 4096)]
+    # 校验和不能由data目录重建，保留
+    assert projects.checksum('p', 'data/p/EnMicroMsg.db') == (3, 'md5')
+
+
+def test_missing_index_is_rebuilt(workdir):
+    catalog(workdir).create('p', 'wxid_p', 'abc1234')
+    os.remove(workdir / 'catalog.db')
+    assert list(catalog(workdir).projects()) == ['p']
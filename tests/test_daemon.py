@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from conftest import wait_until
+
+from server.task import TaskDaemon, TaskRunner
+
+
+class Job(TaskRunner):
+    """直到release或存活检查失败才结束的任务"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release = threading.Event()
+        self.alive = True
+        self.started_at = None
+
+    def _on_before_runloop(self):
+        self.started_at = time.monotonic()
+        return 0.01
+
+    def _on_runloop(self):
+        if self.release.is_set():
+            self.stop()
+
+    def is_task_alive(self):
+        return self.alive
+
+    def is_kill_when_stop(self):
+        return True
+
+    def alive_interval(self):
+        return 0.05
+
+    def slot_keys(self):
+        return getattr(self, '_slots', ())
+
+
+@pytest.fixture
+def daemon():
+    daemon = TaskDaemon(slot_limits = {'device': 1, 'bus': 2})
+    daemon.daemon = True
+    daemon.start()
+    yield daemon
+    daemon.exit()
+
+
+def add(daemon, name, **params):
+    with daemon._condition:
+        assert daemon.add_task(Job, name, params = params or None)
+        return daemon._tasks[name]
+
+
+def test_events_run_in_time_order(daemon):
+    ran = []
+    with daemon._condition:
+        daemon.call_later(0.1, ran.append, 'last')
+        daemon.call_later(0.05, ran.append, 'third')
+        daemon.call_later(0, ran.append, 'first')
+        daemon.call_later(0, ran.append, 'second')
+    wait_until(lambda: len(ran) == 4)
+    assert ran == ['first', 'second', 'third', 'last']
+
+
+def test_events_do_not_wait_for_a_poll(daemon):
+    # 守护线程空闲休眠时，新加入的事件立即执行
+    time.sleep(0.2)
+    ran = threading.Event()
+    start = time.monotonic()
+    daemon.call_later(0, ran.set)
+    assert ran.wait(1)
+    assert time.monotonic() - start < 0.5
+
+
+def test_failed_event_does_not_stop_daemon(daemon):
+    ran = threading.Event()
+    daemon.call_later(0, lambda: 1 / 0)
+    daemon.call_later(0, ran.set)
+    assert ran.wait(1)
+
+
+def test_stopped_task_is_reaped(daemon):
+    task = add(daemon, 'a')
+    wait_until(lambda: task.started_at)
+    assert daemon.query_tasks() == [{'name': 'a', 'running': True}]
+    task.release.set()
+    wait_until(lambda: not daemon.has_task('a'))
+    assert not daemon.has_task_running()
+
+
+def test_dead_task_is_stopped_by_check(daemon):
+    task = add(daemon, 'a')
+    wait_until(lambda: task.started_at)
+    task.alive = False
+    wait_until(lambda: not daemon.has_task('a'), 2)
+    assert task._stopped.is_set()
+
+
+def test_duplicate_name_is_rejected(daemon):
+    add(daemon, 'a')
+    assert not daemon.add_task(Job, 'a')
+    assert daemon.kill_task('a')
+    assert not daemon.has_task('a')
+    assert daemon.kill_task('missing')
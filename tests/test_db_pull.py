@@ -0,0 +1,234 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import run_task, wait_until
+
+pytest.importorskip('adb')
+
+from server.android import task as android_task  # noqa: E402
+from server.android.snapshot import Snapshots  # noqa: E402
+from server.android.task import DbPullRunner  # noqa: E402
+
+CHUNK = 16 * 1024
+BLOCK = 4096
+
+
+def write_db(device, data):
+    with open(device.db_path, 'wb') as f:
+        f.write(data)
+
+
+def pull(daemon, device, name, **params):
+    params.setdefault('chunk', CHUNK)
+    params.setdefault('block', BLOCK)
+    return run_task(daemon, DbPullRunner, name,
+                    dict(params, user = device.user))
+
+
+@pytest.fixture
+def device(fake_adb):
+    device = fake_adb[0]
+    write_db(device, os.urandom(CHUNK * 3 + 100))
+    return device
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def record_reads(monkeypatch):
+    reads = []
+    read_chunk = android_task.read_chunk
+
+    def recording(device, path, index, *args, **kwargs):
+        reads.append(index)
+        return read_chunk(device, path, index, *args, **kwargs)
+
+    monkeypatch.setattr(android_task, 'read_chunk', recording)
+    return reads
+
+
+@pytest.mark.parametrize('mode', ['chunked', 'snapshot', 'sync'])
+def test_pull_modes(daemon, device, mode):
+    task = pull(daemon, device, 'p', mode = mode)
+    assert read('data/p/EnMicroMsg.db') == read(device.db_path)
+    assert task.progress()['progress'] == 1
+    assert daemon.client.catalog.checksum('p', 'data/p/EnMicroMsg.db')[1]\
+        == hashlib.md5(read(device.db_path)).hexdigest()
+    assert not os.path.exists('data/p/EnMicroMsg.db.part')
+    assert not os.path.exists('data/p/EnMicroMsg.db.tmp')
+
+
+def test_progress_reaches_ticker(daemon, device):
+    pull(daemon, device, 'p')
+    name = 'Db size checker - p'
+
+    def merged():
+        data = {}
+        for item in list(daemon.emitted):
+            if item[1] == name and isinstance(item[3], dict):
+                data.update(item[3])
+        return data
+
+    wait_until(lambda: merged().get('progress') == 1)
+    assert merged()['dest_byte'] == os.path.getsize(device.db_path)
+
+
+def test_chunked_resumes_from_part(daemon, device, monkeypatch):
+    data = read(device.db_path)
+    os.makedirs('data/p')
+    with open('data/p/EnMicroMsg.db.part', 'wb') as f:
+        f.write(data[:CHUNK * 2])
+    st = os.stat(device.db_path)
+    with open('data/p/EnMicroMsg.db.part.json', 'w') as f:
+        f.write(f'{{"src_byte": {len(data)}, '
+                f'"src_mtime": {int(st.st_mtime)}, '
+                f'"offset": {CHUNK * 2}}}')
+    reads = record_reads(monkeypatch)
+    task = pull(daemon, device, 'p')
+    assert reads == [2, 3]
+    assert task.progress()['progress'] == 1
+    assert read('data/p/EnMicroMsg.db') == data
+
+
+def test_chunked_retries_corrupt_chunk(daemon, device, monkeypatch):
+    read_chunk = android_task.read_chunk
+    failed = []
+
+    def flaky(device, path, index, *args, **kwargs):
+        data = read_chunk(device, path, index, *args, **kwargs)
+        if index == 1 and not failed:
+            failed.append(index)
+            return b'\0' * len(data)
+        return data
+
+    monkeypatch.setattr(android_task, 'read_chunk', flaky)
+    task = pull(daemon, device, 'p')
+    assert failed == [1]
+    assert task.progress()['progress'] == 1
+    assert read('data/p/EnMicroMsg.db') == read(device.db_path)
+
+
+def test_chunked_does_not_hash_whole_file(daemon, device, monkeypatch):
+    calls = []
+    monkeypatch.setattr(android_task, 'remote_file_md5',
+                        lambda *args, **kwargs: calls.append(args))
+    task = pull(daemon, device, 'p')
+    assert task.progress()['progress'] == 1
+    assert calls == []
+
+
+def test_unchanged_db_is_skipped(daemon, device, monkeypatch):
+    pull(daemon, device, 'p')
+    reads = record_reads(monkeypatch)
+    task = pull(daemon, device, 'p')
+    assert reads == []
+    assert task._unchanged
+    assert task.progress()['progress'] == 1
+
+
+def test_slow_remote_md5_keeps_task_alive(daemon, device, monkeypatch):
+    pull(daemon, device, 'p')
+    remote_file_md5 = android_task.remote_file_md5
+
+    def slow(*args, **kwargs):
+        # 比存活超时更久才算出md5，期间没有数据写入
+        time.sleep(2.5)
+        return remote_file_md5(*args, **kwargs)
+
+    monkeypatch.setattr(android_task, 'remote_file_md5', slow)
+    task = pull(daemon, device, 'p', timeout = 1)
+    assert task._unchanged
+    assert task.progress()['progress'] == 1
+
+
+def test_stopped_remote_md5_is_not_success(daemon, device, monkeypatch):
+    pull(daemon, device, 'p')
+    release = threading.Event()
+    monkeypatch.setattr(android_task, 'remote_file_md5',
+                        lambda *args, **kwargs: release.wait(30))
+    params = {'device': daemon.client, 'serial': device.serial,
+              'user': device.user, 'chunk': CHUNK}
+    with daemon._condition:
+        assert daemon.add_task(DbPullRunner, 'p', params = params)
+        task = daemon._tasks['p']
+    try:
+        wait_until(task.is_alive)
+        time.sleep(0.2)
+        daemon.kill_task('p')
+        wait_until(lambda: not task.is_alive())
+    finally:
+        release.set()
+    assert not task._unchanged
+    assert task.progress()['progress'] < 1
+
+
+def test_timed_out_pull_reports_error(daemon, device):
+    runner = DbPullRunner(name = 'p', params = {
+        'device': daemon.client, 'serial': device.serial,
+        'user': device.user, 'timeout': 1})
+    assert runner.is_task_alive()
+    runner._task_alive_timestamp = time.time() - 5
+    assert not runner.is_task_alive()
+    assert runner.progress()['progress'] == -1
+
+
+def test_progress_counts_pulled_bytes(daemon, device):
+    # 上次拉取的数据库比设备上的大
+    os.makedirs('data/p')
+    with open('data/p/EnMicroMsg.db', 'wb') as f:
+        f.write(b'\0' * (CHUNK * 10))
+    runner = DbPullRunner(name = 'p', params = {
+        'device': daemon.client, 'serial': device.serial,
+        'user': device.user})
+    data = runner.progress()
+    assert data['progress'] == 0
+    assert data['src_byte'] == os.path.getsize(device.db_path)
+    success, result, _ = daemon.client.cmd_check_db_size(
+        'p', progress = runner.progress)
+    assert success and result == data
+    assert daemon.client.alive_check_db_size(
+        'p', progress = runner.progress)
+
+
+def test_check_db_size_without_progress(daemon):
+    success, data, message = daemon.client.cmd_check_db_size(
+        'p', progress = lambda: None)
+    assert not success and data is None and message
+    assert not daemon.client.alive_check_db_size(
+        'p', progress = lambda: None)
+
+
+def test_snapshot_pulls_only_changed_blocks(daemon, device, monkeypatch):
+    pull(daemon, device, 'p', mode = 'snapshot')
+    data = bytearray(read(device.db_path))
+    data[BLOCK * 5] ^= 0xff
+    write_db(device, bytes(data))
+    ranges = []
+    exec_out = android_task.exec_out
+
+    def recording(device, cmd, *args, **kwargs):
+        ranges.append(cmd.split(' skip=')[1].split(' 2>')[0])
+        return exec_out(device, cmd, *args, **kwargs)
+
+    monkeypatch.setattr(android_task, 'exec_out', recording)
+    task = pull(daemon, device, 'p', mode = 'snapshot')
+    assert ranges == ['5 count=1']
+    assert task.progress()['progress'] == 1
+    assert read('data/p/EnMicroMsg.db') == bytes(data)
+    assert len(Snapshots('data/p/snapshots', BLOCK).names()) == 2
+
+
+def test_snapshot_saved_only_after_verify(daemon, device, monkeypatch):
+    monkeypatch.setattr(android_task, 'remote_file_md5',
+                        lambda *args, **kwargs: 'mismatch')
+    task = pull(daemon, device, 'p', mode = 'snapshot')
+    assert task.progress()['progress'] == -1
+    assert Snapshots('data/p/snapshots', BLOCK).names() == []
+    assert not os.path.exists('data/p/EnMicroMsg.db')
+    assert not os.path.exists('data/p/EnMicroMsg.db.tmp')
@@ -0,0 +1,55 @@
+import random
+import sqlite3
+
+import pytest
+
+pytest.importorskip('pysqlcipher3')
+
+from benchmarks.fakeadb import generate_db  # noqa: E402
+from server.android.decrypt import export_plaintext,\
+    open_encrypted  # noqa: E402
+
+PASSWORD = 'c0ffee1'
+
+
+@pytest.fixture
+def src(workdir):
+    generate_db('EnMicroMsg.db', PASSWORD, 256 * 1024, random.Random(1))
+    return 'EnMicroMsg.db'
+
+
+def rows(conn, table):
+    return conn.execute(
+        f"SELECT rowid, * FROM {table} ORDER BY rowid;").fetchall()
+
+
+def test_export_copies_all_tables(src):
+    steps = []
+    total = export_plaintext(src, 'MicroMsg.db', PASSWORD, batch_rows = 100,
+                             progress = lambda done, total:
+                             steps.append((done, total)))
+    assert steps[-1] == (total, total)
+    assert [done for done, _ in steps] == sorted(done for done, _ in steps)
+    encrypted = open_encrypted(src, PASSWORD)
+    plain = sqlite3.connect('MicroMsg.db')
+    try:
+        for table in ('message', 'rcontact', 'chatroom'):
+            assert rows(plain, table) == rows(encrypted, table)
+        # 索引在数据复制完后建立
+        assert plain.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND "
+            "name = 'messageCreateTimeIndex';").fetchone()
+    finally:
+        plain.close()
+        encrypted.close()
+
+
+def test_export_can_be_cancelled(src):
+    with pytest.raises(Exception):
+        export_plaintext(src, 'MicroMsg.db', PASSWORD, batch_rows = 10,
+                         cancelled = lambda: True)
+
+
+def test_wrong_password_fails(src):
+    with pytest.raises(Exception):
+        export_plaintext(src, 'MicroMsg.db', 'wrong00')
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import random
+
+import pytest
+
+from config import DECRYPT_FALLBACK_IMEI
+from server.android import task as android_task
+from server.android.catalog import ProjectCatalog, read_conf
+from server.android.keys import candidate_passwords, derive_password,\
+    find_password
+from server.android.task import DbDecryptRunner
+
+
+class Client:
+    """只提供项目目录和密钥来源的设备"""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def key_sources(self, serial):
+        return ['123456789012345'], ['1']
+
+
+@pytest.fixture
+def runner(workdir, monkeypatch):
+    catalog = ProjectCatalog(path = str(workdir / 'catalog.db'))
+    catalog.create('p', 'wxid_p', 'stale00')
+    monkeypatch.setattr(android_task, 'find_password',
+                        lambda path, candidates: ('c0ffee1', 'legacy')
+                        if 'c0ffee1' in candidates else (None, None))
+    monkeypatch.setattr(android_task, 'candidate_passwords',
+                        lambda imeis, uins, passwords = ():
+                        list(passwords) + (['c0ffee1'] if imeis else []))
+    return DbDecryptRunner(name = 'p', params = {
+        'password': 'stale00', 'device': Client(catalog),
+        'serial': 'serial'})
+
+
+def test_corrected_password_stays_server_side(runner, caplog):
+    with caplog.at_level(logging.DEBUG):
+        assert runner._find_password() == ('c0ffee1', 'legacy')
+    assert 'password corrected' in caplog.text
+    assert 'c0ffee1' not in caplog.text
+    catalog = runner._client.catalog
+    assert catalog.projects()['p']['password'] == 'c0ffee1'
+    assert read_conf('data/p/backup.conf')[:3] == ('p', 'wxid_p', 'c0ffee1')
+
+    runner._password = 'c0ffee1'
+    runner._step = len(runner._step_processs)
+    progress = runner.progress()
+    assert progress['progress'] == 1
+    assert 'c0ffee1' not in repr(progress)
+
+
+def test_set_password_keeps_resource_size(workdir):
+    catalog = ProjectCatalog(path = str(workdir / 'catalog.db'))
+    catalog.create('p', 'wxid_p', 'stale00')
+    catalog._write_resource_byte('p', 42)
+    catalog.set_password('p', 'c0ffee1')
+    catalog.set_password('missing', 'c0ffee1')
+    assert read_conf('data/p/backup.conf') == ('p', 'wxid_p', 'c0ffee1', 42)
+    assert list(catalog.projects()) == ['p']
+
+
+def test_derive_password():
+    assert derive_password('867530900000001', '1234567890') ==\
+        hashlib.md5(b'8675309000000011234567890').hexdigest()[:7]
+
+
+def test_candidates_cover_imeis_and_uin_spellings():
+    candidates = candidate_passwords([' 1111 ', '', '2222'], ['-1'],
+                                     ['known', None, 'known'])
+    assert candidates[0] == 'known'
+    expected = [derive_password(imei, uin)
+                for imei in ['1111', '2222'] + list(DECRYPT_FALLBACK_IMEI)
+                for uin in ['-1', str(2 ** 32 - 1)]]
+    assert candidates[1:] == list(dict.fromkeys(expected))
+    assert candidate_passwords(['1111'], [str(2 ** 31)])[:2] ==\
+        [derive_password('1111', str(2 ** 31)),
+         derive_password('1111', str(-2 ** 31))]
+    assert candidate_passwords(['1111'], ['']) == []
+
+
+def test_find_password(workdir):
+    pytest.importorskip('pysqlcipher3')
+    from benchmarks.fakeadb import generate_db
+
+    generate_db('db', 'c0ffee1', 64 * 1024, random.Random(1))
+    assert find_password('db', ['wrong00', 'c0ffee1', 'wrong01']) ==\
+        ('c0ffee1', 'legacy')
+    assert find_password('db', ['wrong00']) == (None, None)
+    assert find_password('db', []) == (None, None)
@@ -0,0 +1,94 @@
+import json
+import os
+import random
+
+import pytest
+
+from conftest import run_task
+
+from config import MM_RES_DIR
+
+pytest.importorskip('adb')
+
+from benchmarks.fakeadb import generate_res  # noqa: E402
+from server.android import task as android_task  # noqa: E402
+from server.android.encoding import ENCODINGS, EncodingRecords,\
+    negotiate, probe_encodings, tar_command  # noqa: E402
+from server.android.task import ResPullRunner  # noqa: E402
+
+
+def test_tar_command():
+    assert tar_command('/res', '/tmp/a.list', 'none') ==\
+        'cd /res && busybox tar cf - -T /tmp/a.list 2>/dev/null'
+    assert tar_command('/res', '/tmp/a.list', 'gzip-fast') ==\
+        'cd /res && busybox tar cf - -T /tmp/a.list 2>/dev/null | '\
+        'busybox gzip -1 2>/dev/null'
+
+
+def test_records_expire(workdir):
+    records = EncodingRecords('data/encodings.json', ttl = 60)
+    assert records.get('a', 'image2') is None
+    records.put('a', 'image2', 'gzip-fast', {'gzip-fast': {'rate': 1}})
+    records.put('a', 'voice2', 'none', {})
+    assert records.get('a', 'image2') == 'gzip-fast'
+    assert records.get('a', 'voice2') == 'none'
+    assert records.get('b', 'image2') is None
+    with open('data/encodings.json', 'r') as f:
+        data = json.load(f)
+    data['a']['image2']['time'] = data['a']['image2']['time'] - 61
+    data['a']['voice2']['encoding'] = 'unknown'
+    with open('data/encodings.json', 'w') as f:
+        json.dump(data, f)
+    assert records.get('a', 'image2') is None
+    assert records.get('a', 'voice2') is None
+
+
+def test_broken_records_file(workdir):
+    with open('encodings.json', 'w') as f:
+        f.write('{')
+    assert EncodingRecords('encodings.json').get('a', 'image2') is None
+
+
+def test_probe_and_negotiate(daemon, fake_adb):
+    device = fake_adb[0]
+    generate_res(device.res_path, 20, 256 * 1024, random.Random(1))
+    adb_device = daemon.client.device()
+    available = probe_encodings(adb_device)
+    assert {'none', 'gzip-fast', 'gzip', 'gzip-strong'} <= set(available)
+    assert set(available) <= set(ENCODINGS)
+    paths = []
+    for folder, _, names in os.walk(device.res_path):
+        paths.extend(os.path.relpath(f'{folder}/{name}', device.res_path)
+                     for name in names)
+    best, rates = negotiate(adb_device, f'{MM_RES_DIR}/{device.user}',
+                            sorted(paths), ['none', 'gzip'],
+                            sample_byte = 64 * 1024, sample_files = 8)
+    assert best in ('none', 'gzip')
+    assert set(rates) == {'none', 'gzip'}
+    assert rates['none']['ratio'] == 1
+    assert all(rate['rate'] > 0 for rate in rates.values())
+    assert negotiate(adb_device, '/', [], ['none']) == (None, {})
+
+
+def test_auto_encoding_is_recorded(daemon, fake_adb, monkeypatch):
+    device = fake_adb[0]
+    generate_res(device.res_path, 20, 256 * 1024, random.Random(1))
+    monkeypatch.setattr(android_task, 'RES_ENCODING_MIN_BYTE', 1)
+    monkeypatch.setattr(android_task, 'probe_encodings',
+                        lambda device: ['none', 'gzip-fast'])
+    params = {'user': device.user, 'incremental': False, 'store': False,
+              'encoding': 'auto'}
+    task = run_task(daemon, ResPullRunner, 'p', params)
+    folders = sorted(os.listdir(device.res_path))
+    chosen = task._folder_encoding
+    assert sorted(chosen) == folders
+    assert set(chosen.values()) <= {'none', 'gzip-fast'}
+    records = EncodingRecords()
+    assert {folder: records.get(device.serial, folder)
+            for folder in folders} == chosen
+
+    # 有效期内的记录直接复用，不再抽样
+    monkeypatch.setattr(android_task, 'negotiate', lambda *args, **kwargs:
+                        pytest.fail('negotiated again'))
+    task = run_task(daemon, ResPullRunner, 'q', params)
+    assert task._folder_encoding == chosen
@@ -0,0 +1,92 @@
+import csv
+import json
+import os
+
+import pytest
+
+from conftest import make_message_db
+from server.android.export import HtmlWriter, export_messages
+from server.android.pool import JobCancelled
+
+MESSAGES = [(1, 1, 0, 1500000000000, 'wxid_a', 'hello'),
+            (2, 1, 1, 1500000001000, 'wxid_a', 'hi'),
+            (3, 1, 0, 1500000002000, 'room@chatroom', 'wxid_b:\n<b>&'),
+            (4, 10000, 0, 0, 'wxid_a', '')]
+CONTACTS = [('wxid_a', 'Alice', 'alice'), ('wxid_b', '', 'bob')]
+
+
+@pytest.fixture
+def db(workdir):
+    return make_message_db('src.db', MESSAGES, CONTACTS,
+                           [('room@chatroom', 'room', 'wxid_a',
+                             'wxid_a;wxid_b')])
+
+
+def read_jsonl(path):
+    with open(path, encoding = 'utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_jsonl(db):
+    assert export_messages(db, 'out', 'jsonl') == 7
+    messages = read_jsonl('out/message.jsonl')
+    assert [m['msgId'] for m in messages] == [1, 2, 3, 4]
+    assert messages[0]['talkerName'] == 'Alice'
+    assert messages[0]['sender'] == 'wxid_a'
+    assert messages[1]['sender'] == ''
+    # 群聊消息去掉发送者前缀并关联发送者名称
+    assert messages[2]['content'] == '<b>&'
+    assert messages[2]['senderName'] == 'bob'
+    assert messages[3]['time'] == ''
+    assert len(read_jsonl('out/rcontact.jsonl')) == 2
+    assert not os.path.exists('out.tmp')
+
+
+def test_csv(db):
+    export_messages(db, 'out', 'csv', tables = ('message',))
+    with open('out/message.csv', encoding = 'utf-8-sig') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['msgId'] for row in rows] == ['1', '2', '3', '4']
+    assert os.listdir('out') == ['message.csv']
+
+
+def test_html_keeps_falsy_values(db):
+    export_messages(db, 'out', 'html', tables = ('message',))
+    pages = sorted(os.listdir('out/message'))
+    text = ''.join(open(f'out/message/{page}', encoding = 'utf-8').read()
+                   for page in pages)
+    # isSend为0的单元格不能被当作空值
+    assert '<td>0</td>' in text
+    assert '&lt;b&gt;&amp;' in text
+    index = open('out/index.html', encoding = 'utf-8').read()
+    assert 'Alice' in index and 'room@chatroom' in index
+
+
+def test_html_cell():
+    assert HtmlWriter._cell(0) == '0'
+    assert HtmlWriter._cell('') == ''
+    assert HtmlWriter._cell(None) == ''
+
+
+def test_html_pages_split_by_talker(workdir):
+    os.makedirs('out')
+    writer = HtmlWriter('out', page_rows = 2)
+    writer.begin('message', ['talker', 'content'])
+    for i in range(5):
+        writer.write({'talker': 'wxid_a', 'talkerName': '', 'content': i})
+    writer.write({'talker': 'wxid_b', 'talkerName': 'Bob', 'content': 0})
+    writer.end()
+    writer.close()
+    assert sorted(os.listdir('out/message')) ==\
+        [f'{page:05d}.html' for page in range(1, 5)]
+    index = open('out/index.html', encoding = 'utf-8').read()
+    assert index.count('wxid_a') == 3 and index.count('Bob') == 1
+
+
+def test_cancel_keeps_previous_export(db):
+    export_messages(db, 'out', 'jsonl')
+    with pytest.raises(JobCancelled):
+        export_messages(db, 'out', 'jsonl', batch_rows = 1,
+                        cancelled = lambda: True)
+    assert len(read_jsonl('out/message.jsonl')) == 4
+    assert not os.path.exists('out.tmp')
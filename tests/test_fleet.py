@@ -0,0 +1,77 @@
+import pytest
+
+from conftest import wait_until
+
+from server.android.task import _device_slot_keys
+from server.task import TaskDaemon
+from test_daemon import Job
+
+
+@pytest.fixture
+def scheduler():
+    daemon = TaskDaemon(slot_limits = {'fleet': 3, 'device': 1, 'bus': 2})
+    daemon.daemon = True
+    daemon.start()
+    yield daemon
+    daemon.exit()
+
+
+def add(daemon, name, serial, bus):
+    with daemon._condition:
+        assert daemon.add_task(Job, name, params = {
+            'slots': _device_slot_keys(serial, bus)})
+        return daemon._tasks[name]
+
+
+def test_slot_keys():
+    assert _device_slot_keys('a', '1') ==\
+        [('fleet', ''), ('device', 'a'), ('bus', '1')]
+    assert _device_slot_keys('a', None) == [('fleet', ''), ('device', 'a')]
+
+
+def test_one_task_per_device(scheduler):
+    first = add(scheduler, 'a1', 'a', '1')
+    second = add(scheduler, 'a2', 'a', '1')
+    other = add(scheduler, 'b1', 'b', '1')
+    wait_until(lambda: first.started_at and other.started_at)
+    assert second.started_at is None
+    assert second in scheduler._waiting
+    first.release.set()
+    wait_until(lambda: second.started_at)
+    assert second.started_at >= first.started_at
+
+
+def test_bus_and_fleet_limits(scheduler):
+    tasks = [add(scheduler, f'{serial}', serial, bus) for serial, bus
+             in [('a', '1'), ('b', '1'), ('c', '1'), ('d', '2'), ('e', '3')]]
+    a, b, c, d, e = tasks
+    wait_until(lambda: a.started_at and b.started_at and d.started_at)
+    # c等总线1的名额，e等全局名额
+    assert c.started_at is None and e.started_at is None
+    d.release.set()
+    wait_until(lambda: e.started_at)
+    assert c.started_at is None
+    a.release.set()
+    wait_until(lambda: c.started_at)
+    assert scheduler._slots[('bus', '1')] == 2
+
+
+def test_killed_waiting_task_never_starts(scheduler):
+    first = add(scheduler, 'a1', 'a', None)
+    second = add(scheduler, 'a2', 'a', None)
+    wait_until(lambda: first.started_at)
+    assert scheduler.kill_task('a2')
+    first.release.set()
+    wait_until(lambda: not scheduler.has_task('a1'))
+    assert second.started_at is None
+    assert not scheduler._slots
+
+
+def test_devices_are_listed_with_bus(daemon, fake_adb):
+    device = fake_adb[0]
+    success, devices, _ = daemon.client.cmd_list_devices()
+    assert success
+    assert [(item['serial'], item['bus']) for item in devices] ==\
+        [(device.serial, device.bus)]
+    assert daemon.client.device(device.serial).serial == device.serial
+    assert daemon.client.device('missing') is None
@@ -0,0 +1,38 @@
+import os
+import random
+
+from config import MM_RES_DIR
+from server.android.manifest import Inventory
+
+
+def test_inventory_groups_by_folder():
+    inventory = Inventory(['image2', 'voice2'])
+    inventory.add('image2/a', 10, 1)
+    inventory.add('image2/b/c', 20, 2)
+    inventory.add('voice2/d', 5, 3)
+    inventory.add('video/e', 100, 4)
+    assert len(inventory['image2']) == 2
+    assert inventory.folder_byte('image2') == 30
+    assert inventory.folder_byte('voice2') == 5
+    assert inventory.total_byte() == 35
+    assert inventory.total_files() == 3
+
+
+def test_inventory_scan(fake_adb, daemon):
+    from benchmarks.fakeadb import generate_res
+
+    device = fake_adb[0]
+    generate_res(device.res_path, 20, 256 * 1024, random.Random(1))
+    folders = sorted(os.listdir(device.res_path))
+    inventory = Inventory.scan(daemon.client.device(),
+                               f'{MM_RES_DIR}/{device.user}', folders)
+    expected = {}
+    for folder, _, names in os.walk(device.res_path):
+        for name in names:
+            path = f'{folder}/{name}'
+            expected[os.path.relpath(path, device.res_path)] =\
+                os.path.getsize(path)
+    assert inventory.total_files() == len(expected)
+    assert inventory.total_byte() == sum(expected.values())
+    for path, size in expected.items():
+        assert inventory[path.split('/', 1)[0]].get(path)[0] == size
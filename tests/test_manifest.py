@@ -0,0 +1,80 @@
+import os
+import random
+
+import pytest
+
+from conftest import run_task
+
+from server.android.manifest import Manifest
+
+
+def test_diff_reports_new_and_changed():
+    local = Manifest({'image2/a': (10, 1), 'image2/b': (20, 2),
+                      'voice2/c': (5, 3)})
+    remote = Manifest({'image2/a': (10, 1), 'image2/b': (21, 2),
+                       'voice2/c': (5, 4), 'video/d': (1, 1)})
+    assert sorted(local.diff(remote)) == ['image2/b', 'video/d', 'voice2/c']
+    assert Manifest().diff(remote) == list(dict(remote.items()))
+    assert remote.diff(local) == ['image2/b', 'voice2/c']
+
+
+def test_save_and_load(workdir):
+    manifest = Manifest()
+    manifest.update('image2/a', 10, 1)
+    manifest.update('image2/b', 20, 2)
+    manifest.remove('image2/b')
+    manifest.remove('missing')
+    manifest.save('manifest.json')
+    loaded = Manifest.load('manifest.json')
+    assert dict(loaded.items()) == {'image2/a': (10, 1)}
+    assert loaded.total_byte() == 10
+    assert not os.path.exists('manifest.json.tmp')
+
+
+@pytest.mark.parametrize('content', [
+    '', '{', '{"version": 0, "files": {}}', '{"version": 1}'])
+def test_load_broken_file(workdir, content):
+    with open('manifest.json', 'w') as f:
+        f.write(content)
+    assert len(Manifest.load('manifest.json')) == 0
+    assert len(Manifest.load('missing.json')) == 0
+
+
+def test_parse_line():
+    assert Manifest.parse_line('12 1600000000 image2/a b.jpg\n') ==\
+        ('image2/a b.jpg', 12, 1600000000)
+    assert Manifest.parse_line('stat: cannot stat\n') is None
+    assert Manifest.parse_line('\n') is None
+
+
+def test_incremental_pull_sends_only_changes(fake_adb, daemon,
+                                             monkeypatch):
+    from benchmarks.fakeadb import generate_res
+    from server.android import task as android_task
+    from server.android.task import ResPullRunner
+
+    device = fake_adb[0]
+    generate_res(device.res_path, 20, 256 * 1024, random.Random(1))
+    pushed = []
+    push_lines = android_task.push_lines
+
+    def recording(device, lines, *args, **kwargs):
+        pushed.extend(lines)
+        return push_lines(device, lines, *args, **kwargs)
+
+    monkeypatch.setattr(android_task, 'push_lines', recording)
+    params = {'user': device.user, 'incremental': True, 'store': False,
+              'encoding': 'gzip'}
+    run_task(daemon, ResPullRunner, 'p', params)
+    assert len(pushed) == 20
+    assert len(Manifest.load('data/p/manifest.json')) == 20
+
+    changed = sorted(pushed)[3]
+    with open(f'{device.res_path}/{changed}', 'ab') as f:
+        f.write(b'more')
+    del pushed[:]
+    run_task(daemon, ResPullRunner, 'p', params)
+    assert pushed == [changed]
+    with open(f'{device.res_path}/{changed}', 'rb') as f:
+        with open(f'data/p/Resource/{changed}', 'rb') as g:
+            assert f.read() == g.read()
@@ -0,0 +1,92 @@
+import pytest
+
+from server import metrics
+from server.metrics import MetricsRegistry
+
+
+def test_render_exposition_format():
+    registry = MetricsRegistry()
+    counter = registry.counter('c_total', 'A counter', ('task',))
+    registry.gauge('g', 'A gauge',
+                   collect = lambda: {(): 3})
+    counter.inc(task = 'a')
+    counter.inc(2, task = 'b "x"\n')
+    counter.inc(task = 'a')
+    assert registry.render() == (
+        '# HELP c_total A counter\n'
+        '# TYPE c_total counter\n'
+        'c_total{task="a"} 2\n'
+        'c_total{task="b \\"x\\"\\n"} 2\n'
+        '# HELP g A gauge\n'
+        '# TYPE g gauge\n'
+        'g 3\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('h_seconds', 'A histogram', ('kind',),
+                                   buckets = (1, 0.1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, kind = 'x')
+    lines = registry.render().splitlines()[2:]
+    assert lines == ['h_seconds_bucket{kind="x",le="0.1"} 1',
+                     'h_seconds_bucket{kind="x",le="1"} 2',
+                     'h_seconds_bucket{kind="x",le="+Inf"} 3',
+                     'h_seconds_sum{kind="x"} 5.55',
+                     'h_seconds_count{kind="x"} 3']
+    assert registry.snapshot() == {'h_seconds': [
+        {'labels': {'kind': 'x', 'stat': 'sum'}, 'value': 5.55},
+        {'labels': {'kind': 'x', 'stat': 'count'}, 'value': 3}]}
+
+
+def test_failed_collect_is_skipped():
+    registry = MetricsRegistry()
+    registry.gauge('g', 'A gauge', collect = lambda: 1 / 0)
+    assert registry.render() == '# HELP g A gauge\n# TYPE g gauge\n'
+
+
+def test_duplicate_name_is_rejected():
+    registry = MetricsRegistry()
+    registry.counter('c', 'A counter')
+    with pytest.raises(AssertionError):
+        registry.counter('c', 'Again')
+
+
+def test_remove_by_label():
+    registry = MetricsRegistry()
+    gauge = registry.gauge('g', 'A gauge', ('task', 'kind'))
+    other = registry.gauge('o', 'Other gauge', ('state',))
+    gauge.set(1, task = 'a', kind = 'x')
+    gauge.set(2, task = 'b', kind = 'x')
+    other.set(3, state = 'a')
+    registry.remove(task = 'a')
+    assert [value for _, _, value in gauge.samples()] == [2]
+    assert [value for _, _, value in other.samples()] == [3]
+
+
+def test_transfer_rates_are_forgotten():
+    metrics.observe_transfer('test%20task', 'resource', 100, 2)
+    metrics.observe_transfer('test task', 'resource', 50, 1)
+
+    def value(metric):
+        return {dict(pairs)['task']: value
+                for _, pairs, value in metric.samples()
+                if dict(pairs)['kind'] == 'resource'}.get('test task')
+
+    assert value(metrics.transfer_bytes) == 150
+    assert value(metrics.transfer_files) == 3
+    assert value(metrics.transfer_bytes_rate) is not None
+    metrics.forget_task('test task')
+    assert value(metrics.transfer_bytes_rate) is None
+    assert value(metrics.transfer_bytes) == 150
+
+
+def test_metrics_endpoint():
+    pytest.importorskip('flask_bootstrap')
+    from app import app
+
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert '# TYPE wechatbackup_task_stage_seconds histogram' in\
+        response.get_data(as_text = True)
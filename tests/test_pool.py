@@ -0,0 +1,66 @@
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import ROOT, make_message_db
+from server.android.export import export_messages
+from server.android.pool import JobCancelled, ProcessPool, _run_job,\
+    interrupt_handler
+
+
+class _State(dict):
+    pass
+
+
+def _count(progress, cancelled, total = 3):
+    for done in range(1, total + 1):
+        progress(done, total)
+    return total
+
+
+def test_run_job_reports_progress():
+    state = _State()
+    assert _run_job(_count, (), {}, state, threading.Event()) == 3
+    assert state['progress'] == (3, 3)
+
+
+def test_run_job_cancelled_by_progress():
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(JobCancelled):
+        _run_job(_count, (), {}, _State(), cancel)
+
+
+def test_interrupt_handler_stops_statement():
+    cancelled = threading.Event()
+    conn = sqlite3.connect(':memory:')
+    conn.set_progress_handler(interrupt_handler(cancelled.is_set, 0), 100)
+    cancelled.set()
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL "
+                     "SELECT i + 1 FROM n) SELECT count(*) FROM n;")
+
+
+def test_workers_do_not_create_the_device_client():
+    code = ("import threading, server.android.device as device; "
+            "print('_client' in vars(device), threading.active_count())")
+    output = subprocess.run([sys.executable, '-c', code], cwd = ROOT,
+                            capture_output = True, text = True,
+                            check = True).stdout.split()
+    assert output == ['False', '1']
+
+
+def test_process_pool_runs_job(workdir):
+    make_message_db('src.db', [(1, 1, 1, 1000, 'a', 'hi')])
+    pool = ProcessPool(workers = 1)
+    try:
+        job = pool.submit(export_messages, str(workdir / 'src.db'),
+                          str(workdir / 'out'), 'jsonl')
+        assert job.wait(60)
+        assert job.result() == 1
+        assert job.progress() == (1, 1)
+    finally:
+        pool.shutdown()
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from conftest import run_task
+
+pytest.importorskip('adb')
+
+from benchmarks.fakeadb import generate_res  # noqa: E402
+from config import RES_STORE_MIN_BYTE  # noqa: E402
+from server.android import store, task as android_task  # noqa: E402
+from server.android.task import ResPullRunner  # noqa: E402
+
+
+@pytest.fixture
+def device(fake_adb):
+    device = fake_adb[0]
+    generate_res(device.res_path, 30, 2 * 1024 * 1024, random.Random(1))
+    return device
+
+
+def pull(daemon, device, name = 'p', **params):
+    params.setdefault('incremental', False)
+    params.setdefault('store', False)
+    return run_task(daemon, ResPullRunner, name,
+                    dict(params, user = device.user, encoding = 'gzip'))
+
+
+def tree(root):
+    files = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            path = f'{folder}/{name}'
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def test_pull_files(daemon, device):
+    task = pull(daemon, device)
+    assert not task.is_pull_error()
+    assert task.progress()['progress'] == 1
+    assert tree('data/p/Resource') == tree(device.res_path)
+
+
+def test_pull_error_is_reported(daemon, device, monkeypatch):
+    def scan(*args, **kwargs):
+        raise OSError('device gone')
+
+    monkeypatch.setattr(android_task.Inventory, 'scan', scan)
+    task = pull(daemon, device)
+    assert task.is_pull_error()
+    assert task.progress()['progress'] == -1
+    assert not daemon.client.alive_check_resource_progress(
+        'p', progress = task.progress)
+
+
+def stored(root = 'data/.store'):
+    blobs = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            blobs[os.path.basename(folder) + name] = f'{folder}/{name}'
+    return blobs
+
+
+def large_files(root):
+    return {path: data for path, data in tree(root).items()
+            if len(data) >= RES_STORE_MIN_BYTE}
+
+
+def test_store_is_filled_without_rereading(daemon, device, monkeypatch):
+    hashed = []
+    monkeypatch.setattr(android_task, 'remote_md5',
+                        lambda *args, **kwargs: hashed.append(args) or {})
+    monkeypatch.setattr(store, 'file_md5', lambda path: pytest.fail(
+        f'{path} read back for hashing'))
+    pull(daemon, device, store = True)
+    # 存储为空时不在设备上计算md5
+    assert hashed == []
+    expected = {hashlib.md5(data).hexdigest()
+                for data in large_files(device.res_path).values()}
+    assert expected and set(stored()) == expected
+
+
+def test_store_links_known_content(daemon, device):
+    pull(daemon, device, 'a', store = True)
+    task = pull(daemon, device, 'b', store = True)
+    assert task.progress()['linked_files'] ==\
+        len(large_files(device.res_path))
+    assert tree('data/b/Resource') == tree(device.res_path)
+
+
+def test_pull_does_not_write_through_store_links(daemon, device):
+    pull(daemon, device, store = True)
+    for path in large_files(device.res_path):
+        with open(f'{device.res_path}/{path}', 'wb') as f:
+            f.write(os.urandom(RES_STORE_MIN_BYTE))
+    pull(daemon, device, store = False)
+    assert tree('data/p/Resource') == tree(device.res_path)
+    for digest, path in stored().items():
+        with open(path, 'rb') as f:
+            assert hashlib.md5(f.read()).hexdigest() == digest
+
+
+def record_shell(daemon, monkeypatch):
+    commands = []
+    device_class = type(daemon.client.device())
+    shell = device_class.shell
+
+    def recording(self, cmd, *args, **kwargs):
+        commands.append(cmd)
+        return shell(self, cmd, *args, **kwargs)
+
+    monkeypatch.setattr(device_class, 'shell', recording)
+    return commands
+
+
+def test_stream_matches_base64(daemon, device, monkeypatch):
+    commands = record_shell(daemon, monkeypatch)
+    pull(daemon, device, 's')
+    # 流模式不在设备上编码base64，也不经shell缓冲tar
+    assert commands and not [cmd for cmd in commands
+                             if 'base64' in cmd or 'tar' in cmd]
+    task = pull(daemon, device, 'b', mode = 'base64')
+    assert task.progress()['progress'] == 1
+    assert tree('data/s/Resource') == tree('data/b/Resource') ==\
+        tree(device.res_path)
+
+
+def test_shards_pulled_in_parallel(daemon, device, monkeypatch):
+    monkeypatch.setattr(android_task, 'RES_PULL_SHARD_FILES', 2)
+    threads = set()
+    pull_shard = ResPullRunner._pull_shard
+
+    def recording(self, folder, paths, *args):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        return pull_shard(self, folder, paths, *args)
+
+    monkeypatch.setattr(ResPullRunner, '_pull_shard', recording)
+    task = pull(daemon, device, workers = 3)
+    assert task.progress()['progress'] == 1
+    assert 1 < len(threads) <= 3
+    assert tree('data/p/Resource') == tree(device.res_path)
+
+
+def test_progress_counts_bytes_without_du(daemon, device, monkeypatch):
+    commands = record_shell(daemon, monkeypatch)
+    files = tree(device.res_path)
+    total = sum(len(data) for data in files.values())
+    task = pull(daemon, device, incremental = True)
+    assert not [cmd for cmd in commands if 'du ' in cmd]
+    data = task.progress()
+    assert data['files'] == len(files)
+    assert data['current'] == total // 1024
+    # 增量拉取没有变化时，已有字节数取自清单
+    task = pull(daemon, device, incremental = True)
+    data = task.progress()
+    assert data['files'] == 0
+    assert data['current'] == total // 1024
@@ -0,0 +1,72 @@
+import pytest
+
+from conftest import make_message_db
+
+from server.android.pool import JobCancelled
+from server.android.search import build_index, search
+
+MESSAGES = [
+    (1, 1, 0, 300, 'alice', '今天天气不错'),
+    (2, 1, 1, 100, 'alice', '你好，Hello'),
+    (3, 1, 0, 200, 'bob', '天气预报说明天下雨'),
+    (4, 1, 1, 200, 'bob', '好的'),
+    (5, 1, 0, 400, 'alice', None),
+    (6, 1, 0, 500, 'bob', 'HELLO world'),
+]
+
+
+@pytest.fixture
+def index(workdir):
+    src = make_message_db(str(workdir / 'MicroMsg.db'), MESSAGES)
+    dest = str(workdir / 'SearchMicroMsg.db')
+    steps = []
+    total = build_index(src, dest, batch_rows = 2,
+                        progress = lambda done, total: steps.append(done))
+    assert total == 5
+    assert steps == [2, 4, 5, 5]
+    return dest
+
+
+def ids(result):
+    return [item['msgId'] for item in result['items']]
+
+
+@pytest.mark.parametrize('keyword, expected', [
+    ('天', [1, 3]),
+    ('天气', [1, 3]),
+    ('天气不错', [1]),
+    ('好', [4, 2]),
+    ('he', [6, 2]),
+    ('HELLO', [6, 2]),
+    ('，H', [2]),
+    ('雪', []),
+])
+def test_search_by_length(index, keyword, expected):
+    result = search(index, keyword)
+    assert ids(result) == expected
+    assert result['total'] == len(expected)
+
+
+def test_search_orders_by_time(index):
+    items = search(index, 'l')['items']
+    assert [item['createTime'] for item in items] == [500, 100]
+    # 同一时间的消息按msgId倒序
+    assert ids(search(index, '的')) == [4]
+    assert ids(search(index, '天')) == [1, 3]
+
+
+def test_search_talker_and_pages(index):
+    assert ids(search(index, '天', talker = 'bob')) == [3]
+    assert ids(search(index, 'hel', talker = 'alice')) == [2]
+    first = search(index, '天', page = 1, page_size = 1)
+    second = search(index, '天', page = 2, page_size = 1)
+    assert first['total'] == second['total'] == 2
+    assert ids(first) + ids(second) == [1, 3]
+    assert ids(search(index, '天', page = 3, page_size = 1)) == []
+
+
+def test_cancelled_build_keeps_old_index(index, workdir):
+    src = str(workdir / 'MicroMsg.db')
+    with pytest.raises(JobCancelled):
+        build_index(src, index, batch_rows = 1, cancelled = lambda: True)
+    assert ids(search(index, '好的')) == [4]
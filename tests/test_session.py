@@ -0,0 +1,72 @@
+import pytest
+
+from conftest import wait_until
+
+pytest.importorskip('adb')
+
+from server.android.session import DeviceSession, SessionCache  # noqa: E402
+
+
+class Loader:
+    def __init__(self, *values):
+        self.values = list(values)
+        self.calls = 0
+
+    def __call__(self, device):
+        self.calls = self.calls + 1
+        value = self.values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def test_session_caches_until_expired():
+    session = DeviceSession(None, 'a')
+    loader = Loader('x', 'y', 'z')
+    assert session.get('k', loader) == 'x'
+    assert session.get('k', loader) == 'x'
+    assert loader.calls == 1
+    session.invalidate('k')
+    assert session.get('k', loader, ttl = 0) == 'y'
+    # 有效期为0的值下次读取时重新查询
+    assert session.get('k', loader) == 'z'
+    assert loader.calls == 3
+
+
+def test_session_does_not_cache_errors():
+    session = DeviceSession(None, 'a')
+    loader = Loader(OSError('offline'), 'x')
+    with pytest.raises(OSError):
+        session.get('k', loader)
+    assert session.get('k', loader) == 'x'
+    session.invalidate()
+    assert session._values == {}
+
+
+def test_update_keeps_and_replaces_sessions():
+    cache = SessionCache(None)
+    cache._update([('a', 'device'), ('b', 'unauthorized')])
+    a, b = cache._sessions['a'], cache._sessions['b']
+    cache._update([('b', 'device'), ('a', 'device'), ('c', None)])
+    assert list(cache._sessions) == ['b', 'a', 'c']
+    assert cache._sessions['a'] is a
+    assert cache._sessions['b'] is not b
+    assert cache._sessions['b'].state == 'device'
+    # 按有效期查询时没有状态，不作废已有的会话
+    a = cache._sessions['a']
+    cache._update([('a', None)])
+    assert list(cache._sessions) == ['a'] and cache._sessions['a'] is a
+
+
+def test_tracking_replaces_device_queries(daemon, fake_adb, monkeypatch):
+    device = fake_adb[0]
+    sessions = daemon.client._sessions
+    assert sessions.session().serial == device.serial
+    wait_until(sessions._tracking.is_set)
+    calls = []
+    monkeypatch.setattr(sessions._client, 'devices',
+                        lambda: calls.append(1) or [])
+    monkeypatch.setattr(sessions, '_expire', 0)
+    assert sessions.session(device.serial).serial == device.serial
+    assert sessions.session('missing') is None
+    assert calls == []
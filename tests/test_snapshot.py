@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+import pytest
+
+from server.android.snapshot import Snapshots
+
+BLOCK = 4
+
+
+def save(snapshots, data):
+    blocks = [snapshots.put_block(data[i:i + BLOCK])
+              for i in range(0, len(data), BLOCK)]
+    return snapshots.save(blocks, len(data), 1)
+
+
+def block_files(root):
+    return sum(len(files) for _, _, files in os.walk(f'{root}/blocks'))
+
+
+def test_save_and_restore(workdir):
+    snapshots = Snapshots('snapshots', BLOCK)
+    first = save(snapshots, b'aaaabbbbcc')
+    second = save(snapshots, b'aaaaxxxxcc')
+    assert snapshots.names() == [first, second]
+    assert first < second
+    # 未变化的块只保存一份
+    assert block_files('snapshots') == 4
+    md5 = hashlib.md5()
+    assert snapshots.restore(first, 'db', md5 = md5) == 10
+    with open('db', 'rb') as f:
+        assert f.read() == b'aaaabbbbcc'
+    assert md5.hexdigest() == hashlib.md5(b'aaaabbbbcc').hexdigest()
+    assert not os.path.exists('db.tmp')
+    snapshots.restore(second, 'db')
+    with open('db', 'rb') as f:
+        assert f.read() == b'aaaaxxxxcc'
+
+
+def test_assemble_checks_size(workdir):
+    snapshots = Snapshots('snapshots', BLOCK)
+    blocks = [snapshots.put_block(b'aaaa')]
+    steps = []
+    assert snapshots.assemble(blocks, 4, 'db', progress = steps.append) == 4
+    assert steps == [4]
+    with pytest.raises(OSError):
+        snapshots.assemble(blocks, 5, 'db')
+
+
+def test_prune_keeps_recent_blocks(workdir):
+    snapshots = Snapshots('snapshots', BLOCK)
+    save(snapshots, b'aaaabbbb')
+    save(snapshots, b'aaaacccc')
+    last = save(snapshots, b'aaaadddd')
+    assert snapshots.prune(1) == 2
+    assert snapshots.names() == [last]
+    assert block_files('snapshots') == 2
+    snapshots.restore(last, 'db')
+    with open('db', 'rb') as f:
+        assert f.read() == b'aaaadddd'
+
+
+def test_missing_root_has_no_snapshots(workdir):
+    assert Snapshots('missing', BLOCK).names() == []
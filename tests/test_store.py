@@ -0,0 +1,53 @@
+import hashlib
+import os
+
+from server.android.store import BlobStore
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_add_links_duplicates(workdir):
+    store = BlobStore('store')
+    assert store.is_empty()
+    write('a/x', b'same')
+    write('b/y', b'same')
+    digest = store.add('a/x')
+    assert digest == hashlib.md5(b'same').hexdigest()
+    assert not store.is_empty()
+    assert store.add('b/y') == digest
+    assert os.path.samefile('a/x', 'b/y')
+    assert os.path.samefile('a/x', store.path(digest))
+
+
+def test_add_uses_given_digest(workdir):
+    store = BlobStore('store')
+    write('a/x', b'data')
+    digest = hashlib.md5(b'data').hexdigest()
+    assert store.add('a/x', digest) == digest
+    assert store.has(digest)
+
+
+def test_link_replaces_without_touching_blob(workdir):
+    store = BlobStore('store')
+    digest = store.put(b'blob')
+    write('a/x', b'old')
+    store.link(digest, 'a/x')
+    assert read('a/x') == b'blob'
+    store.link(store.put(b'other'), 'a/x')
+    assert read(store.path(digest)) == b'blob'
+
+
+def test_is_empty_after_prune(workdir):
+    store = BlobStore('store')
+    store.put(b'orphan')
+    assert store.prune() == 1
+    assert store.is_empty()
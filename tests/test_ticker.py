@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from conftest import wait_until
+
+from server.android import device as channel_device
+from server.task import ProgressTicker, TaskDaemon
+
+
+class Client:
+    """按名称返回预设进度的设备"""
+
+    def __init__(self):
+        self.data = {}
+        self.alive = {}
+        self.threads = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def cmd_check(self, name, **kwargs):
+        self.threads.append(threading.current_thread())
+        self.release.wait(10)
+        data = self.data[name]
+        if isinstance(data, Exception):
+            raise data
+        return True, dict(data), None
+
+    def alive_check(self, name, **kwargs):
+        return self.alive.get(name, True)
+
+
+@pytest.fixture
+def ticker(monkeypatch):
+    client = Client()
+    monkeypatch.setattr(channel_device, '_client', client, raising = False)
+    daemon = TaskDaemon()
+    daemon.daemon = True
+    daemon.start()
+    emitted = []
+    ticker = ProgressTicker(daemon, lambda channel, items: emitted.extend(
+        (channel, item) for item in items), interval = 0.02)
+    ticker.client, ticker.emitted = client, emitted
+    yield ticker
+    client.release.set()
+    daemon.exit()
+
+
+def items(ticker, name):
+    return [item for _, item in list(ticker.emitted) if item[1] == name]
+
+
+def test_only_changes_are_emitted(ticker):
+    client = ticker.client
+    client.data['a'] = {'progress': 0, 'byte': 1}
+    assert ticker.register('a', 'check')
+    wait_until(lambda: items(ticker, 'a'))
+    client.data['a'] = {'progress': 0.5}
+    wait_until(lambda: len(items(ticker, 'a')) == 2)
+    client.alive['a'] = False
+    wait_until(lambda: not ticker._ticking)
+    assert items(ticker, 'a') == [
+        ('check', 'a', True, {'progress': 0, 'byte': 1}, None),
+        ('check', 'a', True, {'progress': 0.5, 'byte': None}, None)]
+    assert ticker.emitted[0][0] == 'android'
+
+
+def test_failed_source_reports_error(ticker):
+    ticker.client.data['a'] = ValueError('gone')
+    ticker.client.data['b'] = {'progress': 1}
+    ticker.client.alive['b'] = False
+    assert ticker.register('a', 'check')
+    assert ticker.register('b', 'check')
+    wait_until(lambda: not ticker._ticking)
+    (command, name, success, data, message), = items(ticker, 'a')
+    assert (command, name, success, data) == ('check', 'a', False, None)
+    assert 'gone' in message
+    assert items(ticker, 'b') == [('check', 'b', True, {'progress': 1},
+                                   None)]
+    assert ticker._sources == {}
+
+
+def test_poll_runs_off_daemon_thread(ticker):
+    client = ticker.client
+    client.data['a'] = {'progress': 0}
+    client.release.clear()
+    assert ticker.register('a', 'check')
+    wait_until(lambda: client.threads)
+    # 轮询阻塞时守护线程仍然执行其他调度
+    ran = threading.Event()
+    ticker._daemon.call_later(0, ran.set)
+    assert ran.wait(2)
+    assert client.threads[0] is not ticker._daemon
+    assert items(ticker, 'a') == []
+    client.release.set()
+    wait_until(lambda: items(ticker, 'a'))
+
+
+def test_unknown_command_is_not_registered(ticker):
+    assert not ticker.register('a', 'missing')
+    assert not ticker._ticking